@@ -4,4 +4,5 @@ from crew_algorithms.auto_encoder.model import (
     Encoder,
     Encoder_Nature,
 )
+from crew_algorithms.auto_encoder.inference import FrozenEncoder  # noqa: F401
 from crew_algorithms.auto_encoder.transforms import EncoderTransform  # noqa: F401
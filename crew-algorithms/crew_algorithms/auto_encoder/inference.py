@@ -0,0 +1,90 @@
+import copy
+import hashlib
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from crew_algorithms.utils.model_utils import fold_batch_norm, pixels_to_float
+
+
+class FrozenEncoder(nn.Module):
+    """Runs a trained encoder for inference only.
+
+    The batch norms of the encoder are folded into its convolutions and the
+    weights are kept in channels last layout. Each call flattens the leading
+    dimensions of the frames into a single batch, so that all parallel
+    environments and agents are encoded at once, and runs in inference mode.
+
+    The features of the most recent frames are kept in an LRU cache keyed by
+    a hash of the frame, so that repeated frames, like those of a paused
+    game, are not encoded again.
+
+    Args:
+        encoder: The trained encoder. It is copied, the encoder itself is not
+            modified.
+        cache_size: The number of frames whose features are cached, 0 to
+            disable the cache.
+    """
+
+    def __init__(self, encoder: nn.Module, cache_size: int = 1024):
+        super().__init__()
+        self.encoder = fold_batch_norm(copy.deepcopy(encoder).eval())
+        self.encoder.requires_grad_(False)
+        self.encoder.to(memory_format=torch.channels_last)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def train(self, mode: bool = True) -> "FrozenEncoder":
+        # The folded batch norms only hold in eval mode.
+        return super().train(False)
+
+    def forward(self, frames: torch.Tensor) -> torch.Tensor:
+        """Encodes a batch of frames.
+
+        Args:
+            frames: The frames, with shape `[..., C, H, W]`.
+
+        Returns:
+            The flattened features, with shape `[..., D]`.
+        """
+        batch_shape = frames.shape[:-3]
+        frames = frames.reshape(-1, *frames.shape[-3:])
+        if self.cache_size == 0:
+            # Cloned out of inference mode, so they can be used with autograd.
+            features = self._encode(frames).clone()
+        else:
+            features = self._encode_cached(frames)
+        return features.view(*batch_shape, -1)
+
+    def clear_cache(self) -> None:
+        self._cache.clear()
+
+    def _apply(self, fn, *args, **kwargs):
+        # Cached features would be left on the previous device or dtype.
+        self.clear_cache()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _encode(self, frames: torch.Tensor) -> torch.Tensor:
+        device = next(self.encoder.parameters()).device
+        with torch.inference_mode():
+            frames = pixels_to_float(frames.to(device))
+            frames = frames.contiguous(memory_format=torch.channels_last)
+            return self.encoder(frames).flatten(1)
+
+    def _encode_cached(self, frames: torch.Tensor) -> torch.Tensor:
+        pixels = frames.detach().cpu().contiguous().numpy()
+        keys = [hashlib.blake2b(frame, digest_size=16).digest() for frame in pixels]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            else:
+                missing.setdefault(key, i)
+        if missing:
+            encoded = self._encode(frames[list(missing.values())])
+            for key, features in zip(missing, encoded):
+                self._cache[key] = features
+        features = torch.stack([self._cache[key] for key in keys])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return features
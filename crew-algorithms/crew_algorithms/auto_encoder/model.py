@@ -1,18 +1,57 @@
 import random
+import threading
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
+from crew_algorithms.utils.augmentation import BatchedAugmentation
 from crew_algorithms.utils.model_utils import (
     conv2d_bn_relu,
     deconv_relu,
     deconv_sigmoid,
+    pixels_to_float,
 )
 from PIL import Image
 from torchvision.models import mobilenet_v3_small, resnet18
-from torchvision.transforms import RandomAffine, ToTensor, v2
+from torchvision.transforms import RandomAffine, ToTensor
 
 random.seed(0)
 
+# The features computed by every `Encoder` while `cache_encoder_features` is
+# active, per thread so that background encoding does not use them.
+_cache = threading.local()
+
+
+def _frames_key(x: torch.Tensor) -> tuple:
+    return (x.data_ptr(), x.numel(), x.dtype, x._version)
+
+
+@contextmanager
+def cache_encoder_features(frozen_features=()):
+    """Encodes each batch of frames once per set of encoder weights.
+
+    Actor and critic share their `Encoder`, so a loss encodes the same
+    observations with the same weights several times. Inside this context
+    the features are reused, including their random shift. A reuse with
+    weights that do not require gradients, like the detached critic of the
+    actor loss, gets detached features, so that the gradients reach the
+    encoder through the same paths as without the cache.
+
+    Args:
+        frozen_features: Pairs of frames and their features, computed by the
+            frozen encoder. Encoder calls on these frames with weights that do
+            not require gradients return the features without encoding.
+    """
+    previous = getattr(_cache, "features", None), getattr(_cache, "frozen", None)
+    _cache.features = {}
+    _cache.frozen = {
+        _frames_key(frames): features for frames, features in frozen_features
+    }
+    try:
+        yield
+    finally:
+        _cache.features, _cache.frozen = previous
+
 
 class Encoder_Nature(nn.Module):
     def __init__(self, in_channels: int, embedding_dim: int = 128):
@@ -72,9 +111,12 @@ class Encoder(nn.Module):
     Args:
         in_channels: Number of input channels.
         embedding_dim: The size of the output embedding.
+        seed: The seed of the random shifts.
     """
 
-    def __init__(self, in_channels: int = 3, embedding_dim: int = 128):
+    def __init__(
+        self, in_channels: int = 3, embedding_dim: int = 128, seed: int | None = 0
+    ):
         super().__init__()
 
         self.cnn = nn.Sequential(
@@ -93,20 +135,48 @@ class Encoder(nn.Module):
         self.fc = nn.Sequential(
             nn.Linear(576, embedding_dim),
         )
+        self.augmentation = BatchedAugmentation(
+            shift=8, interpolation="nearest", seed=seed
+        )
 
     def forward(self, x):
         """Random shift augmentation is common practice in visual RL.
-        A random shift is only applied at training time, with the
-        same shift applied to all frames in the batch.
+        A random shift is only applied at training time, with its own
+        shift for every sample of the batch. The input is either a batch
+        of frames or of frame stacks, of shape (batch, stack, C, H, W),
+        whose frames share the shift of their sample.
         """
+        weight = self.cnn[0].weight
+        cache = getattr(_cache, "features", None)
+        # Tensors batched by vmap, like the weights of stacked Q-networks,
+        # have no storage to key the cache with.
+        is_batched = torch._C._functorch.is_functorch_wrapped_tensor
+        if cache is None or is_batched(x) or is_batched(weight):
+            return self._encode(x)
+
+        if not weight.requires_grad:
+            features = _cache.frozen.get(_frames_key(x))
+            if features is not None:
+                return features
+
+        key = (x.data_ptr(), x.shape, x.stride(), x.dtype, x._version)
+        key += (weight.data_ptr(), weight._version)
+        requires_grad = torch.is_grad_enabled() and weight.requires_grad
+        features = cache.get(key)
+        if features is None or (requires_grad and not features.requires_grad):
+            features = self._encode(x)
+            cache[key] = features
+        return features if requires_grad else features.detach()
+
+    def _encode(self, x):
+        x = pixels_to_float(x)
         if len(x.shape) < 4:
             x = x.unsqueeze(1)
-        if x.shape[0] > 1:
-            pix = 8
-            a, b = random.uniform(-pix, pix), random.uniform(-pix, pix)
-            x = v2.functional.affine(x, angle=0, translate=[a, b], scale=1, shear=0)
+        if self.training and x.shape[0] > 1:
+            # Frames stacked along dim 1 share the shift of their sample.
+            x = self.augmentation(x.flatten(1, -3)).view(x.shape)
 
-        x = self.cnn(x)
+        x = self.cnn(x.flatten(0, -4))
         x = self.fc(x)
         return x
 
@@ -1,6 +1,9 @@
+from functools import lru_cache
+from pathlib import Path
+
 import torch
-import torch.nn as nn
-from crew_algorithms.auto_encoder import Encoder_Nature
+from crew_algorithms.auto_encoder.inference import FrozenEncoder
+from crew_algorithms.auto_encoder.model import Encoder_Nature
 from tensordict import TensorDictBase
 from torchrl.data.tensor_specs import ContinuousBox, TensorSpec
 from torchrl.data.utils import DEVICE_TYPING
@@ -11,6 +14,41 @@ from torchrl.envs.transforms.transforms import (
 )
 from torchrl.envs.transforms.utils import _set_missing_tolerance
 
+WEIGHTS_DIR = Path(__file__).parent / "weights"
+
+
+@lru_cache
+def _load_state_dict(path: Path) -> dict:
+    # Loaded once per process, however many transforms use the weights.
+    return torch.load(path, map_location="cpu")
+
+
+def load_pretrained_encoder(
+    env_name: str, num_channels: int, outdim: int = 64
+) -> Encoder_Nature:
+    """Makes the encoder pretrained on an environment.
+
+    Args:
+        env_name: The name of the environment that the encoder was trained on.
+            Currently only supports 'bowling', other environments get a
+            randomly initialized encoder.
+        num_channels: The number of channels that will be fed to the encoder.
+        outdim: The dimension of the output vector.
+
+    Returns:
+        The encoder, in eval mode.
+    """
+    encoder = Encoder_Nature(num_channels, outdim)
+    if env_name == "bowling":
+        encoder.load_state_dict(_load_state_dict(WEIGHTS_DIR / "encoder_bowling.pth"))
+        print("Loaded bowling encoder")
+    else:
+        print(
+            "Currently only supports bowling encoder, "
+            "random initializaed encoder will be used."
+        )
+    return encoder.eval()
+
 
 class _EncoderNet(ObservationTransform):
     """A torchrl env transform that converts pixel inputs to encoded vectors.
@@ -23,6 +61,8 @@ class _EncoderNet(ObservationTransform):
             Currently only supports 'bowling'. (You can use __main__ to train encoders for other environments.)
         del_keys: Whether to delete the input keys after transformation.
         outdim: The dimension of the output vector.
+        cache_size: The number of frames whose encoded vectors are cached, 0 to
+            disable the cache.
     """
 
     def __init__(
@@ -33,40 +73,24 @@ class _EncoderNet(ObservationTransform):
         env_name: str = "bowling",
         del_keys: bool = True,
         outdim: int = 64,
+        cache_size: int = 0,
     ):
         super().__init__(in_keys=in_keys, out_keys=out_keys)
         self.outdim = outdim
-        self.encoder = Encoder_Nature(num_channels, self.outdim)
-        self.encoder.eval()
+        self.num_channels = num_channels
+        self.cache_size = cache_size
         self.del_keys = del_keys
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.env_name = env_name
+        self.load_weights()
 
     def load_weights(self):
-        """Loads the weights for the encoder.
-
-        Args:
-            env_name: Name of the environment to load weights for.
-        """
-
-        if self.env_name == "bowling":
-            state_dict = torch.load(
-                "crew_algorithms/auto_encoder/weights/encoder_bowling.pth"
-            )
-            print("Loaded bowling encoder")
-        else:
-            print(
-                "Currently only supports bowling encoder, random initializaed encoder will be used."
-            )
-            return
-
-        self.encoder.load_state_dict(state_dict)
+        """Loads the weights for the encoder of `env_name` and freezes it."""
+        encoder = load_pretrained_encoder(self.env_name, self.num_channels, self.outdim)
+        self.encoder = FrozenEncoder(encoder, self.cache_size).to(self.device)
 
     def _apply_transform(self, obs: torch.Tensor) -> torch.Tensor:
-        obs = obs.to(self.device)
-        out = self.encoder(obs).detach()
-        out = nn.Flatten()(out)
-        return out
+        return self.encoder(obs)
 
     def _reset(
         self, tensordict: TensorDictBase, tensordict_reset: TensorDictBase
@@ -97,6 +121,7 @@ class EncoderTransform(Compose):
         in_keys: list[str] | None = None,
         out_keys: list[str] | None = None,
         out_dim: int = 64,
+        cache_size: int = 0,
     ):
         """A torchrl compose transform that encodes raw observations into a smaller dimension by using a
         pretrained Encoder.
@@ -111,6 +136,11 @@ class EncoderTransform(Compose):
                 encoder.
             in_keys: The input keys to transform.
             out_keys: The keys where the output will be stored.
+            out_dim: The dimension of the encoded vectors.
+            cache_size: The number of frames whose encoded vectors are
+                cached, 0 to disable the cache. Hashing moves every frame
+                to the CPU, so the cache only pays off when frames repeat,
+                like while the game is paused.
         """
         self._device = None
         self._dtype = None
@@ -126,9 +156,8 @@ class EncoderTransform(Compose):
             del_keys=True,
             env_name=env_name,
             outdim=out_dim,
+            cache_size=cache_size,
         )
-
-        network.load_weights(env_name)
         transforms.append(network)
 
         super().__init__(*transforms)
@@ -0,0 +1,154 @@
+import hydra
+from attrs import define
+from crew_algorithms.envs.configs import EnvironmentConfig, register_env_configs
+from hydra.core.config_store import ConfigStore
+from omegaconf import MISSING
+
+
+@define(auto_attribs=True)
+class Config:
+    envs: EnvironmentConfig = MISSING
+    """Settings for the environment to use."""
+    agent_counts: list[int] = [1, 4, 16]
+    """Numbers of agents to benchmark the environment with."""
+    env_modes: list[str] = ["per_agent", "batched", "static"]
+    """Wrapper options to compare, see `crew_algorithms.benchmark.utils`."""
+    num_steps: int = 500
+    """Number of timed steps per measurement."""
+    warmup_steps: int = 20
+    """Number of untimed steps to run before each measurement."""
+    updater_modes: list[str] = []
+    """Updater modes to compare DDPG gradient steps with, see
+    `crew_algorithms.utils.updater`. The updater is not benchmarked if empty."""
+    updater_batch_size: int = 32
+    """Number of transitions per benchmarked gradient step."""
+    updater_steps: int = 20
+    """Number of timed gradient steps per updater mode."""
+    updater_warmup_steps: int = 2
+    """Number of untimed gradient steps to run before each measurement."""
+    from_states: bool = False
+    """Whether the benchmarked agent uses the vector observations."""
+    reuse_encoder_features: bool = False
+    """Whether the benchmarked loss reuses the shared encoder features."""
+    encoder_modes: list[str] = []
+    """Pretrained encoder inference paths to compare, see
+    `crew_algorithms.benchmark.utils`. The encoder is not benchmarked if empty."""
+    encoder_batch_sizes: list[int] = [1, 16]
+    """Numbers of frames encoded per step."""
+    encoder_steps: int = 200
+    """Number of timed steps per encoder measurement."""
+    preprocess_modes: list[str] = []
+    """Pixel preprocessing pipelines to compare, see
+    `crew_algorithms.benchmark.utils`. Not benchmarked if empty."""
+    preprocess_agent_counts: list[int] = [1, 16]
+    """Numbers of agents to benchmark the pixel preprocessing with."""
+    augment_modes: list[str] = []
+    """Per-sample random shift implementations to compare, see
+    `crew_algorithms.benchmark.utils`. Not benchmarked if empty."""
+    augment_batch_sizes: list[int] = [32, 256]
+    """Numbers of frame stacks augmented per step."""
+
+
+cs = ConfigStore.instance()
+cs.store(name="base_config", node=Config)
+register_env_configs()
+
+
+@hydra.main(version_base=None, config_path="../conf", config_name="benchmark")
+def benchmark(cfg: Config):
+    """Benchmarks the environment pipeline against the mock Unity environment.
+
+    Optionally also benchmarks the DDPG gradient step of each updater mode,
+    the pretrained encoder inference, the pixel preprocessing and the
+    random shift augmentation.
+    """
+    import torch
+    from crew_algorithms.benchmark.utils import (
+        ENV_MODES,
+        benchmark_augmentation,
+        benchmark_encoder,
+        benchmark_env,
+        benchmark_preprocessing,
+        benchmark_updater,
+        set_num_agents,
+    )
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    print(f"{'agents':>8}" + "".join(f"{mode:>12}" for mode in cfg.env_modes))
+    for num_agents in cfg.agent_counts:
+        set_num_agents(cfg.envs, num_agents)
+        row = f"{num_agents:>8}"
+        for mode in cfg.env_modes:
+            for key in ("batched_decode", "batched_actions", "static_buffers"):
+                setattr(cfg.envs, key, ENV_MODES[mode].get(key, False))
+            steps_per_sec = benchmark_env(
+                cfg.envs, cfg.num_steps, cfg.warmup_steps, device
+            )
+            row += f"{steps_per_sec:>12.1f}"
+        print(row)
+
+    if cfg.updater_modes:
+        set_num_agents(cfg.envs, 1)
+        print(f"{'updater':>12}{'steps/s':>12}")
+    for mode in cfg.updater_modes:
+        steps_per_sec = benchmark_updater(
+            cfg.envs,
+            mode,
+            cfg.updater_batch_size,
+            cfg.updater_steps,
+            cfg.updater_warmup_steps,
+            device,
+            cfg.from_states,
+            cfg.reuse_encoder_features,
+        )
+        print(f"{mode:>12}{steps_per_sec:>12.2f}")
+
+    if cfg.encoder_modes:
+        print(f"{'encoder':>12}{'batch':>8}{'ms/step':>12}{'frames/s':>12}")
+    for mode in cfg.encoder_modes:
+        for batch_size in cfg.encoder_batch_sizes:
+            seconds = benchmark_encoder(
+                cfg.envs,
+                mode,
+                batch_size,
+                cfg.encoder_steps,
+                cfg.warmup_steps,
+                device,
+            )
+            print(
+                f"{mode:>12}{batch_size:>8}{seconds * 1e3:>12.2f}"
+                f"{batch_size / seconds:>12.0f}"
+            )
+
+    if cfg.preprocess_modes:
+        print(f"{'agents':>8}" + "".join(f"{m:>12}" for m in cfg.preprocess_modes))
+        for num_agents in cfg.preprocess_agent_counts:
+            set_num_agents(cfg.envs, num_agents)
+            row = f"{num_agents:>8}"
+            for mode in cfg.preprocess_modes:
+                seconds = benchmark_preprocessing(
+                    cfg.envs, mode, cfg.num_steps, cfg.warmup_steps, device
+                )
+                row += f"{seconds * 1e3:>10.3f}ms"
+            print(row)
+
+    if cfg.augment_modes:
+        print(f"{'batch':>8}" + "".join(f"{m:>12}" for m in cfg.augment_modes))
+    for batch_size in cfg.augment_batch_sizes if cfg.augment_modes else []:
+        row = f"{batch_size:>8}"
+        for mode in cfg.augment_modes:
+            seconds = benchmark_augmentation(
+                cfg.envs,
+                mode,
+                batch_size,
+                cfg.encoder_steps,
+                cfg.warmup_steps,
+                device,
+            )
+            row += f"{seconds * 1e3:>10.3f}ms"
+        print(row)
+
+
+if __name__ == "__main__":
+    benchmark()
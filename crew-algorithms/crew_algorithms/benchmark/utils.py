@@ -0,0 +1,373 @@
+import time
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import torch
+from crew_algorithms.envs.configs import EnvironmentConfig
+from crew_algorithms.utils.rl_utils import make_base_env
+from crew_algorithms.utils.updater import LossUpdater
+from torchrl.envs.utils import step_mdp
+
+# Encoder inference paths compared by the encoder benchmark.
+ENCODER_MODES = ("eager", "frozen", "cache_miss", "cached")
+
+# Pixel preprocessing pipelines compared by the preprocessing benchmark.
+PREPROCESS_MODES = ("chained", "fused")
+
+# Per-sample random shift implementations compared by the augmentation
+# benchmark.
+AUGMENT_MODES = ("looped", "affine", "crop")
+
+# Wrapper options compared by the environment benchmark.
+ENV_MODES = {
+    "per_agent": {},
+    "batched": {"batched_decode": True, "batched_actions": True},
+    "static": {"static_buffers": True, "batched_actions": True},
+}
+
+
+def set_num_agents(env_cfg: EnvironmentConfig, num_agents: int) -> None:
+    """Sets the total number of agents of an environment configuration.
+
+    Multi-behavior environments split the agents evenly between behaviors.
+
+    Args:
+        env_cfg: The environment configuration to update.
+        num_agents: The total number of agents.
+    """
+    if hasattr(env_cfg, "num_hiders") and hasattr(env_cfg, "num_seekers"):
+        env_cfg.num_hiders = max(num_agents // 2, 1)
+        env_cfg.num_seekers = max(num_agents - env_cfg.num_hiders, 1)
+    else:
+        env_cfg.num_agents = num_agents
+
+
+def benchmark_env(
+    env_cfg: EnvironmentConfig, num_steps: int, warmup_steps: int, device: str
+) -> float:
+    """Measures how many steps per second the wrapped environment runs at.
+
+    Random actions are sampled from the action spec so that the measurement
+    only covers submitting actions and decoding the agent steps.
+
+    Args:
+        env_cfg: The environment configuration.
+        num_steps: The number of timed steps.
+        warmup_steps: The number of steps to run before timing.
+        device: The device to perform environment operations on.
+
+    Returns:
+        The number of environment steps per second.
+    """
+    env = make_base_env(env_cfg, device)
+    tensordict = env.reset()
+    for i in range(warmup_steps + num_steps):
+        if i == warmup_steps:
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        tensordict = env.rand_step(tensordict)
+        tensordict = step_mdp(tensordict)
+        if tensordict["agents", "done"].any():
+            tensordict = env.reset()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    env.close()
+    return num_steps / elapsed
+
+
+def benchmark_updater(
+    env_cfg: EnvironmentConfig,
+    mode: str,
+    batch_size: int,
+    num_steps: int,
+    warmup_steps: int,
+    device: str,
+    from_states: bool = False,
+    reuse_encoder_features: bool = False,
+) -> float:
+    """Measures how many DDPG gradient steps per second an updater mode runs.
+
+    The same batch, collected with random actions, is used for every step
+    so that the measurement only covers the update. The loss metrics are read
+    back once at the end, as the training loop does once per collector batch.
+
+    Args:
+        env_cfg: The environment configuration.
+        mode: The updater mode, see `crew_algorithms.utils.updater`.
+        batch_size: The number of transitions per gradient step.
+        num_steps: The number of timed gradient steps.
+        warmup_steps: The number of gradient steps to run before timing.
+        device: The device to train on.
+        from_states: Whether the agent uses the vector observations instead
+            of the visual ones.
+        reuse_encoder_features: Whether the loss encodes each batch of frames
+            once per set of encoder weights.
+
+    Returns:
+        The number of gradient steps per second.
+    """
+    from crew_algorithms.auto_encoder.model import cache_encoder_features
+    from crew_algorithms.ddpg.config import OptimizationConfig
+    from crew_algorithms.ddpg.utils import (
+        make_agent_continuous,
+        make_env,
+        make_loss_module,
+        make_optimizer,
+    )
+
+    torch.manual_seed(env_cfg.seed)
+    # The fields of the DDPG config that building the agent and loss reads.
+    cfg = SimpleNamespace(
+        envs=env_cfg,
+        from_states=from_states,
+        feedback_model=False,
+        history=False,
+        optimization=OptimizationConfig(updater=mode),
+    )
+    env = make_env(env_cfg, None, False, device)
+    model, _, _ = make_agent_continuous(env, cfg, device)
+    loss_module, target_net_updater = make_loss_module(cfg, env, model)
+    updater = LossUpdater(
+        loss_module,
+        make_optimizer(cfg, loss_module),
+        target_net_updater,
+        model.parameters(),
+        cfg.optimization.max_grad_norm,
+        loss_keys=("loss_actor", "loss_value"),
+        metric_keys={"actor_loss": "loss_actor", "q_loss": "loss_value"},
+        mode=mode,
+        loss_context=(
+            (lambda batch: cache_encoder_features())
+            if reuse_encoder_features
+            else nullcontext
+        ),
+    )
+    batch = env.rollout(batch_size, break_when_any_done=False).to(device)
+    env.close()
+
+    for i in range(warmup_steps + num_steps):
+        if i == warmup_steps:
+            updater.metrics()
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        updater.step(batch)
+    updater.metrics()
+    elapsed = time.perf_counter() - start
+    return num_steps / elapsed
+
+
+def benchmark_encoder(
+    env_cfg: EnvironmentConfig,
+    mode: str,
+    batch_size: int,
+    num_steps: int,
+    warmup_steps: int,
+    device: str,
+    frame_size: int = 128,
+) -> float:
+    """Measures how long the pretrained encoder takes to encode a step.
+
+    The "eager" mode runs the pretrained encoder as is, the "frozen" mode
+    runs it through `FrozenEncoder` without its cache, and the "cache_miss"
+    mode with its cache. All three encode new frames at every step. The
+    "cached" mode runs `FrozenEncoder` with its cache on the same frames at
+    every step, like while the game is paused.
+
+    Args:
+        env_cfg: The environment configuration.
+        mode: One of `ENCODER_MODES`.
+        batch_size: The number of frames encoded per step, one per
+            environment or agent.
+        num_steps: The number of timed steps.
+        warmup_steps: The number of steps to run before timing.
+        device: The device to encode on.
+        frame_size: The height and width of the frames.
+
+    Returns:
+        The number of seconds per step.
+    """
+    from crew_algorithms.auto_encoder.inference import FrozenEncoder
+    from crew_algorithms.auto_encoder.transforms import load_pretrained_encoder
+    from crew_algorithms.utils.model_utils import pixels_to_float
+
+    if mode not in ENCODER_MODES:
+        raise ValueError(
+            f"Unknown encoder mode {mode}, expected one of {ENCODER_MODES}."
+        )
+    encoder = load_pretrained_encoder(env_cfg.name, env_cfg.num_channels)
+    if mode == "eager":
+        encoder.to(device)
+
+        # The transform used to run the encoder this way at every step.
+        def encode(obs):
+            return torch.nn.Flatten()(encoder(pixels_to_float(obs.to(device))).detach())
+
+    else:
+        encode = FrozenEncoder(encoder, 0 if mode == "frozen" else 1024).to(device)
+
+    frames = torch.randint(
+        0,
+        256,
+        (8, batch_size, env_cfg.num_channels, frame_size, frame_size),
+        dtype=torch.uint8,
+    )
+    for i in range(warmup_steps + num_steps):
+        if i == warmup_steps:
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        if mode == "cached":
+            encode(frames[0])
+        else:
+            # The step is written in the first pixels, so no frame repeats.
+            step = frames[i % len(frames)]
+            step.view(batch_size, -1)[:, :2] = torch.tensor([i % 256, i // 256])
+            encode(step)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+def make_pixel_preprocessing(env_cfg: EnvironmentConfig, mode: str):
+    """Makes the transform that the agents preprocess their frames with.
+
+    Args:
+        env_cfg: The environment configuration.
+        mode: "chained" for the separate torchrl transforms, "fused" for
+            `PreprocessPixels`.
+
+    Returns:
+        The transform.
+    """
+    from crew_algorithms.utils.transforms import PreprocessPixels
+    from torchrl.envs.transforms.transforms import (
+        CatFrames,
+        CenterCrop,
+        Compose,
+        Resize,
+        ToTensorImage,
+    )
+
+    key = ("agents", "observation", "obs_0")
+    if mode == "fused":
+        return PreprocessPixels(
+            (env_cfg.crop_h, env_cfg.crop_w),
+            num_stacks=env_cfg.num_stacks,
+            dtype=torch.uint8 if env_cfg.uint8_pixels else torch.float32,
+            in_keys=[key],
+        )
+    if mode == "chained":
+        return Compose(
+            ToTensorImage(
+                in_keys=[key],
+                unsqueeze=True,
+                from_int=False if env_cfg.uint8_pixels else None,
+                dtype=torch.uint8 if env_cfg.uint8_pixels else None,
+            ),
+            CenterCrop(env_cfg.crop_h, env_cfg.crop_w, in_keys=[key]),
+            Resize(100, 100, in_keys=[key]),
+            CatFrames(N=env_cfg.num_stacks, dim=-3, in_keys=[key]),
+        )
+    raise ValueError(
+        f"Unknown preprocessing mode {mode}, expected one of {PREPROCESS_MODES}."
+    )
+
+
+def benchmark_preprocessing(
+    env_cfg: EnvironmentConfig,
+    mode: str,
+    num_steps: int,
+    warmup_steps: int,
+    device: str,
+) -> float:
+    """Measures how long preprocessing the frames of a step takes.
+
+    The raw steps are collected from the environment beforehand, so that the
+    measurement only covers the transforms.
+
+    Args:
+        env_cfg: The environment configuration.
+        mode: One of `PREPROCESS_MODES`.
+        num_steps: The number of timed steps.
+        warmup_steps: The number of steps to run before timing.
+        device: The device to perform environment operations on.
+
+    Returns:
+        The number of seconds per step.
+    """
+    from torchrl.envs.transforms.transforms import TransformedEnv
+
+    env = TransformedEnv(
+        make_base_env(env_cfg, device), make_pixel_preprocessing(env_cfg, mode)
+    )
+    steps = env.base_env.rollout(16, break_when_any_done=False)
+    env.reset()
+    for i in range(warmup_steps + num_steps):
+        if i == warmup_steps:
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        env.transform._call(steps[i % len(steps)]["next"].clone(False))
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    env.close()
+    return elapsed / num_steps
+
+
+def benchmark_augmentation(
+    env_cfg: EnvironmentConfig,
+    mode: str,
+    batch_size: int,
+    num_steps: int,
+    warmup_steps: int,
+    device: str,
+) -> float:
+    """Measures how long randomly shifting a batch of frame stacks takes.
+
+    Every sample gets its own shift of up to 8 pixels, like the `Encoder`
+    augmentation. The "looped" mode applies a torchvision `RandomAffine` to
+    every sample in turn, the other modes use `BatchedAugmentation`.
+
+    Args:
+        env_cfg: The environment configuration.
+        mode: One of `AUGMENT_MODES`.
+        batch_size: The number of frame stacks per step.
+        num_steps: The number of timed steps.
+        warmup_steps: The number of steps to run before timing.
+        device: The device to augment on.
+
+    Returns:
+        The number of seconds per step.
+    """
+    from crew_algorithms.utils.augmentation import BatchedAugmentation
+    from torchvision.transforms import RandomAffine
+
+    if mode not in AUGMENT_MODES:
+        raise ValueError(
+            f"Unknown augmentation mode {mode}, expected one of {AUGMENT_MODES}."
+        )
+    if mode == "looped":
+        shift = RandomAffine(degrees=0, translate=(0.08, 0.08))
+
+        def augment(frames):
+            return torch.stack([shift(sample) for sample in frames])
+
+    else:
+        augment = BatchedAugmentation(shift=8, mode=mode, seed=0)
+
+    frames = torch.rand(
+        batch_size, env_cfg.num_stacks * env_cfg.num_channels, 100, 100, device=device
+    )
+    for i in range(warmup_steps + num_steps):
+        if i == warmup_steps:
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        augment(frames)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
@@ -9,7 +9,6 @@ from crew_algorithms.envs.configs import EnvironmentConfig, register_env_configs
 from crew_algorithms.utils.wandb_utils import WandbConfig
 from hydra.core.config_store import ConfigStore
 from omegaconf import MISSING
-from tensordict import TensorDict
 from torch.optim import Adam
 from torchrl.trainers.helpers.collectors import OffPolicyCollectorConfig
 
@@ -30,6 +29,18 @@ class Config:
     """Batch size to use for training."""
     buffer_size: int = 15_000
     """Size of the replay buffer."""
+    dedup_frames: bool = False
+    """Whether to store each frame once and rebuild frame stacks at sample time"""
+    buffer_storage: str = "memmap"
+    """Where to keep the replay buffer, either "memmap" or "device" """
+    buffer_memory_budget: float = 4.0
+    """GB the device storage may use before falling back to memmap"""
+    prefetch_batches: int = 0
+    """Number of batches to sample ahead on a background thread, 0 to disable"""
+    pin_memory: bool = False
+    """Whether to stage prefetched batches in pinned memory"""
+    batches_per_sample: int = 1
+    """Number of batches gathered from the replay buffer at once"""
     num_envs: int = 1
     """Number of parallel environments to use."""
     seed: int = 42
@@ -40,6 +51,8 @@ class Config:
     """Whether to use trajectory feedback"""
     use_expert: bool = False
     """Whether to use expert data"""
+    expert_ratio: float = 0.5
+    """Fraction of each batch sampled from the expert data"""
     heuristic_feedback: bool = False
     """Whether to use heuristic feedback"""
     hf: bool = False
@@ -74,7 +87,7 @@ def ddpg(cfg: Config):
     import os
     import random
     import uuid
-    from collections import defaultdict, deque
+    from collections import deque
 
     import numpy as np
     import torch
@@ -84,23 +97,37 @@ def ddpg(cfg: Config):
         audio_feedback,
         combine_feedback_and_rewards,
         feedback_model_train_step,
+        freeze_encoder,
+        gather_history,
         get_time,
         gradient_weighted_average_transform,
         heuristic_feedback,
+        history_transform,
         human_delay_transform,
         load_training,
         make_agent,
         make_data_buffer,
         make_env,
+        make_loss_context,
         make_loss_module,
         make_optimizer,
+        make_prefetching_sampler,
         override_il_feedback,
         provide_learned_feedback,
         save_training,
+        uses_latent_replay,
         visualize,
     )
     from crew_algorithms.envs.channels import WrittenFeedbackChannel
+    from crew_algorithms.utils.episode_stats import EpisodeStatsTracker
+    from crew_algorithms.utils.feedback import (
+        HEURISTIC_FEEDBACK_KEY,
+        LEARNED_FEEDBACK_KEY,
+        FeedbackProviders,
+        not_computed,
+    )
     from crew_algorithms.utils.rl_utils import make_collector
+    from crew_algorithms.utils.updater import LossUpdater
     from sortedcontainers import SortedList
     from torchrl.record.loggers import get_logger
 
@@ -159,7 +186,7 @@ def ddpg(cfg: Config):
     loss_module, target_net_updater = make_loss_module(cfg, env, model)
     env.close()
 
-    prb, prb_e = make_data_buffer(cfg, run_name)
+    prb, prb_e = make_data_buffer(cfg, run_name, device)
     collected_frames = 0
     episode_success = []
     global_start_time = time()
@@ -176,7 +203,14 @@ def ddpg(cfg: Config):
             global_start_time,
             collected_frames,
         ) = load_training(
-            model, prb, loss_module, cfg.continue_training, global_start_time, 5, device
+            model,
+            prb,
+            loss_module,
+            cfg.continue_training,
+            global_start_time,
+            5,
+            device,
+            cfg.envs.obs_1_layout,
         )
         """Train for train_batches x frames_per_batch environment steps"""
         if feedback_model is not None:
@@ -192,25 +226,48 @@ def ddpg(cfg: Config):
         start_time=global_start_time,
     )
 
+    prb = make_prefetching_sampler(cfg, prb, prb_e, device)
     collector = make_collector(cfg.collector, env_fn, actor, device, cfg.num_envs)
     collector.set_seed(cfg.seed)
 
     """A short buffer later used for handling human feedback delay"""
     human_delay_buffer_td = None
 
-    """Dictionary to store episode rewards"""
-    episode_reward, episode_reward_hf = defaultdict(float), defaultdict(float)
+    """Per-episode rewards and their statistics over the last episodes"""
+    episode_stats = EpisodeStatsTracker(cfg.log_smoothing)
     """List to store human feedback and heuristic feedback values"""
     all_hf, all_heu = [], []
 
-    num_success, num_trajs, last_traj = 0, 0, 0
-    loss = None
-
-    """Heuristic feedback provider"""
-    heuristic = heuristic_feedback(
-        cfg.envs.target_img, 0.95, cfg.collector.frames_per_batch, device
-    )
+    num_success, num_trajs = 0, 0
+
+    """Fields split from obs_1"""
+    obs_1_field_keys = [
+        (*prefix, "agents", "observation", name)
+        for prefix in ((), ("next",))
+        for name in cfg.envs.obs_1_layout
+    ]
+
+    """Feedback providers, only computed for the batches that consume them"""
+    feedback_providers = FeedbackProviders()
+    if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
+        heuristic = heuristic_feedback(cfg.envs.target_img, 0.95, device)
+        feedback_providers.register(
+            HEURISTIC_FEEDBACK_KEY,
+            heuristic.provide_feedback,
+            default=not_computed(("next", "agents", "reward")),
+        )
     optimizer = make_optimizer(cfg, loss_module)
+    updater = LossUpdater(
+        loss_module,
+        optimizer,
+        target_net_updater,
+        model.parameters(),
+        cfg.optimization.max_grad_norm,
+        loss_keys=("loss_actor", "loss_value"),
+        metric_keys={"actor_loss": "loss_actor", "q_loss": "loss_value"},
+        mode=cfg.optimization.updater,
+        loss_context=make_loss_context(cfg, prb),
+    )
 
     if cfg.feedback_model:
         feedback_optimizer = Adam(feedback_model.parameters(), lr=1e-4)
@@ -232,6 +289,13 @@ def ddpg(cfg: Config):
             fd_model_loss, fd_val_loss, num_train, num_val = 0, 0, 0, 0
             for _ in range(20):
                 sampled_tensordict = prb.sample(batch_size=16).clone().to(device)
+                if cfg.history:
+                    sampled_tensordict.set(
+                        ("agents", "history"),
+                        gather_history(
+                            prb, sampled_tensordict["index"], cfg.envs.num_channels
+                        ).to(device),
+                    )
                 td = sampled_tensordict[
                     sampled_tensordict["next", "agents", "feedback"]
                     .squeeze(1)
@@ -299,6 +363,10 @@ def ddpg(cfg: Config):
 
         deploy_learned_feedback = True
         cfg.hf = False
+        feedback_providers.register(
+            LEARNED_FEEDBACK_KEY,
+            lambda batch: provide_learned_feedback(cfg.history, feedback_model, batch),
+        )
         print("Learned Feedback Deployed")
 
     if cfg.audio_feedback:
@@ -335,16 +403,12 @@ def ddpg(cfg: Config):
         current_frames = data.numel()
         collected_frames += current_frames
 
-        if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
-            data.set(
-                ("next", "agents", "heuristic_feedback"),
-                heuristic.provide_feedback(data),
-            )
+        feedback_providers.bind(data)
 
         if cfg.heuristic_feedback:
             data.set(
                 ("next", "agents", "feedback"),
-                data[("next", "agents", "heuristic_feedback")],
+                feedback_providers.get(HEURISTIC_FEEDBACK_KEY),
             )
         else:
             """Still intialize feedback field to zero"""
@@ -353,65 +417,45 @@ def ddpg(cfg: Config):
                 torch.zeros_like(data[("next", "agents", "reward")]).to(device),
             )
 
-        for j in range(len(data)):
-            time_stamp = data[("next", "agents", "observation", "obs_1")][
-                j, ..., -1, 1
-            ].item()
-            traj_j = data["agents", "observation", "obs_1"][j, ..., -1, 2].int().item()
-            episode_reward[traj_j] += data["next", "agents", "reward"][j].item()
+        time_stamp = data["next", "agents", "observation", "time"][-1].item()
+        for stats in episode_stats.update(
+            data["agents", "observation", "traj_id"],
+            data["next", "agents", "reward"],
+            data["agents", "observation", "feedback"] if cfg.hf else None,
+        ):
+            logger.log_scalar(
+                "avg_episode_reward", stats.avg_reward, step=collected_frames
+            )
+            local_logger.log(
+                x_axis="steps",
+                y_axis="avg_episode_reward",
+                x_value=collected_frames,
+                y_value=stats.avg_reward,
+                log_time=True,
+            )
 
             if cfg.hf:
-                episode_reward_hf[traj_j] += data["agents", "observation", "obs_1"][
-                    j, ..., -1, 0
-                ].item()
-
-            if traj_j > last_traj:
-                r_list = [episode_reward[ep] for ep in episode_reward]
-                avg_ep_r = np.array(
-                    r_list[max(0, len(r_list) - cfg.log_smoothing - 1) : -1]
-                ).mean()
-                logger.log_scalar("avg_episode_reward", avg_ep_r, step=collected_frames)
-                local_logger.log(
-                    x_axis="steps",
-                    y_axis="avg_episode_reward",
-                    x_value=collected_frames,
-                    y_value=avg_ep_r,
-                    log_time=True,
+                logger.log_scalar(
+                    "avg_episode_reward_hf", stats.avg_feedback, step=collected_frames
                 )
-
-                if cfg.hf:
-                    r_list_hf = [episode_reward_hf[ep] for ep in episode_reward_hf]
-                    avg_ep_r_hf = np.array(
-                        r_list_hf[max(0, len(r_list_hf) - cfg.log_smoothing - 1) : -1]
-                    ).mean()
-                    logger.log_scalar(
-                        "avg_episode_reward_hf", avg_ep_r_hf, step=collected_frames
-                    )
-                    local_logger.log(
-                        x_axis="steps",
-                        y_axis="avg_episode_reward_hf",
-                        x_value=collected_frames,
-                        y_value=avg_ep_r_hf,
-                        log_time=True,
-                    )
-
-                sr_list = [1 if episode_reward[ep] > 0 else 0 for ep in episode_reward]
-                avg_sr = np.array(
-                    sr_list[max(0, len(sr_list) - cfg.log_smoothing - 1) : -1]
-                ).mean()
-                logger.log_scalar("success_rate", avg_sr, step=collected_frames)
                 local_logger.log(
                     x_axis="steps",
-                    y_axis="success_rate",
+                    y_axis="avg_episode_reward_hf",
                     x_value=collected_frames,
-                    y_value=avg_sr,
+                    y_value=stats.avg_feedback,
                     log_time=True,
                 )
-                last_traj = traj_j
 
-        local_logger.data["all_rewards"] = {
-            k: round(v, 4) for k, v in episode_reward.items()
-        }
+            logger.log_scalar("success_rate", stats.success_rate, step=collected_frames)
+            local_logger.log(
+                x_axis="steps",
+                y_axis="success_rate",
+                x_value=collected_frames,
+                y_value=stats.success_rate,
+                log_time=True,
+            )
+
+        local_logger.data["all_rewards"] = episode_stats.all_rewards
         data.set(
             ("next", "agents", "reward"),
             data[("next", "agents", "reward")] * cfg.envs.scale_reward
@@ -420,29 +464,27 @@ def ddpg(cfg: Config):
 
         data["time_stamp"] = torch.tensor([round(time_stamp, 4)] * data.numel())
 
-        data["agents", "observation", "obs_1"][
-            data["agents", "observation", "obs_1"] == -9
-        ] = 0
-        data["next", "agents", "observation", "obs_1"][
-            data["next", "agents", "observation", "obs_1"] == -9
-        ] = 0
+        for key in obs_1_field_keys:
+            value = data.get(key)
+            value[value == -9] = 0
+
+        if cfg.hf and HEURISTIC_FEEDBACK_KEY in feedback_providers:
+            hf_values = data["agents", "observation", "feedback"]
+            all_hf.extend(hf_values.squeeze(1).squeeze(1).tolist())
+            all_heu.extend(
+                feedback_providers.get(HEURISTIC_FEEDBACK_KEY)
+                .squeeze(1)
+                .squeeze(1)
+                .tolist()
+            )
+        feedback_providers.fill()
 
         if cfg.hf:
-            if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
-                hf_values = data["agents", "observation", "obs_1"][..., -1, 0]
-                all_hf.extend(hf_values.squeeze(1).tolist())
-                all_heu.extend(
-                    data[("next", "agents", "heuristic_feedback")]
-                    .squeeze(1)
-                    .squeeze(1)
-                    .tolist()
-                )
-
             if human_delay_buffer_td is not None:
                 data = torch.cat([human_delay_buffer_td, data], dim=0)
 
             human_delay_td, human_delay_buffer_td = human_delay_transform(
-                data, ("agents", "observation", "obs_1"), cfg.envs.human_delay_steps
+                data, ("agents", "observation", "feedback"), cfg.envs.human_delay_steps
             )
 
             # grad_average_td = gradient_weighted_average_transform(
@@ -452,16 +494,14 @@ def ddpg(cfg: Config):
             il_feedback_td = grad_average_td
             il_feedback_td = override_il_feedback(
                 grad_average_td,
-                ("agents", "observation", "obs_1"),
-                ("agents", "observation", "obs_1"),
+                ("agents", "observation", "il_enabled"),
+                ("agents", "observation", "feedback"),
                 1,
             )
 
             il_feedback_td.set(
                 ("next", "agents", "feedback"),
-                il_feedback_td.get(("agents", "observation", "obs_1"))[
-                    ..., -1, 0
-                ].unsqueeze(dim=-1),
+                il_feedback_td.get(("agents", "observation", "feedback")),
             )  # write human feedback to feedback field
         else:
             il_feedback_td = data
@@ -478,52 +518,22 @@ def ddpg(cfg: Config):
 
             if i == 0:
                 last_data = combined_rewards[:6]
-            new_combined_rewards = torch.cat([last_data, combined_rewards], dim=0)
-            obs, actions, feedbacks = [], [], []
-
-            for _ in range(len(combined_rewards)):
-                """Use the last 6 frames for training + 1 next frame"""
-                o = new_combined_rewards.get(("agents", "observation", "obs_0"))[
-                    _ : _ + 7, 0, -3:, ...
-                ].reshape(-1, 100, 100)
-                a = new_combined_rewards.get(("agents", "action"))[
-                    _ : _ + 6, 0
-                ].reshape(-1, 2)
-                f = new_combined_rewards.get(("next", "agents", "feedback"))[
-                    _ : _ + 6, 0
-                ].reshape(-1, 1)
-                obs.append(o)
-                actions.append(a)
-                feedbacks.append(f)
-
-            obs = torch.stack(obs, dim=0)
-            actions = torch.stack(actions, dim=0)
-            feedbacks = torch.stack(feedbacks, dim=0)
-
-            history = TensorDict(
-                {
-                    "obs": obs.unsqueeze(1),
-                    "actions": actions.unsqueeze(1),
-                    "feedbacks": feedbacks.unsqueeze(1),
-                },
-                batch_size=combined_rewards.batch_size,
+            history, last_data = history_transform(
+                combined_rewards, last_data, cfg.envs.num_channels
             )
-            combined_rewards.set(("agents", "history"), history)
+            if deploy_learned_feedback and cfg.feedback_model:
+                combined_rewards.set(("agents", "history"), history)
 
         if deploy_learned_feedback and cfg.feedback_model:
-            print(
-                "Providing Learned Feedback:",
-                provide_learned_feedback(
-                    cfg.history, feedback_model, combined_rewards
-                ).sum(),
-            )
+            # The learned feedback is computed from the batch it is added to,
+            # with its history.
+            feedback_providers.bind(combined_rewards)
+            learned_feedback = feedback_providers.get(LEARNED_FEEDBACK_KEY)
+            print("Providing Learned Feedback:", learned_feedback.sum())
             combined_rewards.set(
                 ("next", "agents", "reward"),
                 combined_rewards.get(("next", "agents", "reward"))
-                + provide_learned_feedback(
-                    cfg.history, feedback_model, combined_rewards
-                )
-                * cfg.envs.dense_reward_scale,
+                + learned_feedback * cfg.envs.dense_reward_scale,
             )
 
         if i < cfg.visualize_batches:
@@ -539,10 +549,11 @@ def ddpg(cfg: Config):
             "Rewards:", combined_rewards.get(("next", "agents", "reward")).sum().item()
         )
         if len(combined_rewards) > 0:
-            prb.extend(combined_rewards.cpu())
+            # Histories are rebuilt from the stored transitions when sampled.
+            prb.extend(combined_rewards.exclude(("agents", "history")).cpu())
 
         total_collected_epochs = (
-            data[("agents", "observation", "obs_1")][..., -1, 2].int().max().item()
+            data["agents", "observation", "traj_id"].int().max().item()
         )
 
         print(
@@ -553,73 +564,40 @@ def ddpg(cfg: Config):
 
         t1, t2 = [], []
         if collected_frames >= cfg.collector.init_random_frames:
-            (
-                total_losses,
-                actor_losses,
-                q_losses,
-            ) = ([], [], [])
-
             for _ in range(
                 int(cfg.collector.frames_per_batch * (cfg.optimization.utd_ratio))
             ):
                 tic = time()
 
-                if cfg.audio_feedback:
-                    stream.get_sample()
+                # Expert transitions are mixed into the batch by the sampler.
+                sampled_tensordict = prb.sample()
 
-                if cfg.use_expert:
-                    sampled_expert = (
-                        prb_e.sample(batch_size=cfg.batch_size // 2).clone().to(device)
-                    )
-                    sampled_new = (
-                        prb.sample(batch_size=cfg.batch_size // 2).clone().to(device)
-                    )
-                    sampled_tensordict = torch.cat([sampled_expert, sampled_new], dim=0)
-                else:
-                    sampled_tensordict = prb.sample().clone().to(device)
-
-                loss_td = loss_module(sampled_tensordict)
-
-                actor_loss = loss_td["loss_actor"]
-                q_loss = loss_td["loss_value"]
-
-                optimizer.zero_grad()
-                loss = actor_loss + q_loss
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    model.parameters(), cfg.optimization.max_grad_norm
-                )
-                optimizer.step()
-
-                target_net_updater.step()
+                updater.step(sampled_tensordict)
                 t1.append(time() - tic)
                 if (_ + 1) % 1 == 0:
-                    if cfg.use_expert:
-                        sampled_expert = sampled_tensordict[:cfg.batch_size//2]
-                        sampled_new = sampled_tensordict[cfg.batch_size//2:]
-                        prb_e.update_tensordict_priority(sampled_expert)
-                        prb.update_tensordict_priority(sampled_new)
-                    else:
-                        prb.update_tensordict_priority(sampled_tensordict)
+                    prb.update_tensordict_priority(sampled_tensordict)
                 t2.append(time() - tic)
 
-                total_losses.append(loss.item())
-                actor_losses.append(actor_loss.item())
-                q_losses.append(q_loss.item())
+        if (
+            uses_latent_replay(cfg)
+            and not prb.active
+            and updater.num_updates >= cfg.optimization.freeze_encoder_after
+        ):
+            print("Freezing the encoder after %d updates" % updater.num_updates)
+            encoder = freeze_encoder(model, loss_module)
+            # Prefetched batches were sampled without embeddings.
+            for buffer in (prb, prb_e):
+                if buffer is not None:
+                    buffer.close()
+                    buffer.activate(encoder)
 
         metrics = {
             "collected_frames": collected_frames,
             "collected_traj": num_trajs,
             "time": time_stamp,
         }
-        if loss is not None:
-            metrics.update(
-                {
-                    "total_loss": np.mean(total_losses),
-                    "actor_loss": np.mean(actor_losses),
-                    "q_loss": np.mean(q_losses),
-                }
-            )
+        # Loss metrics are read back from the device once per collector batch.
+        metrics.update(updater.metrics())
 
         for key, value in metrics.items():
             logger.log_scalar(key, value, step=collected_frames)
@@ -651,6 +629,7 @@ def ddpg(cfg: Config):
                     i + 1,
                     cfg.collector.frames_per_batch,
                 )
+            prb.close()
             collector.shutdown()
             return 0
 
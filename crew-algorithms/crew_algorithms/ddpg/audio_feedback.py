@@ -1,65 +1,63 @@
 import os
 import wave
 
-import numpy as np
-import pyaudio
 import torch
+from crew_algorithms.utils.audio import AudioRingBuffer, MicrophoneSource
 
 
 class Audio_Streamer:
     """Class to stream audio from the microphone and save it to a file
 
+    The audio source calls back from its own thread with every captured
+    buffer, which is written into a ring buffer holding the last `seconds`
+    of audio, so that capturing adds no time to the training loop.
+
     Args:
         channels: Number of channels to record
         rate: Sampling rate
         frames_per_buffer: Number of frames per buffer
+        seconds: Number of seconds of audio kept
+        source: The audio source, a `MicrophoneSource` if None. A
+            `FakeAudioSource` streams without a microphone.
     """
 
-    def __init__(self, channels=1, rate=44100, frames_per_buffer=1024):
+    def __init__(
+        self, channels=1, rate=44100, frames_per_buffer=1024, seconds=60, source=None
+    ):
         self.channels = channels
         self.rate = rate
         self.frames_per_buffer = frames_per_buffer
-        self.buffer = []
+        self.ring = AudioRingBuffer(int(seconds * rate), channels, rate)
+        self.source = source or MicrophoneSource(channels, rate, frames_per_buffer)
+        self.saved_frames = 0
         os.makedirs("crew_algorithms/ddpg/audio", exist_ok=True)
 
     def start_streaming(self):
-        self.audio = pyaudio.PyAudio()
-        self.stream = self.audio.open(
-            format=pyaudio.paInt16,
-            channels=self.channels,
-            rate=self.rate,
-            input=True,
-            frames_per_buffer=self.frames_per_buffer,
-        )
-
-    def get_sample(self):
-        data = self.stream.read(self.frames_per_buffer, exception_on_overflow=False)
-        self.buffer.append(data)
+        self.source.start(self.ring.write)
 
     def stop_streaming(self):
-        self.stream.stop_streaming()
-        self.stream.close()
-        self.audio.terminate()
+        self.source.stop()
+
+    @property
+    def pending_frames(self):
+        """Number of frames captured since the last save"""
+        return min(self.ring.frames_written - self.saved_frames, self.ring.capacity)
+
+    def latest(self, seconds):
+        """Returns a view of the last `seconds` of int16 audio, without copying"""
+        return torch.from_numpy(self.ring.latest(int(seconds * self.rate)))
 
     def save_to_file(self, file_name):
+        end = self.ring.frames_written
         sound_file = wave.open("crew_algorithms/ddpg/audio/%s.wav" % file_name, "wb")
-        sound_file.setnchannels(1)
-        sound_file.setsampwidth(pyaudio.get_sample_size(pyaudio.paInt16))
-        sound_file.setframerate(44100)
-        sound_file.writeframes(b"".join(self.buffer))
+        sound_file.setnchannels(self.channels)
+        sound_file.setsampwidth(2)  # int16
+        sound_file.setframerate(self.rate)
+        sound_file.writeframes(self.ring.frames(self.saved_frames, end).tobytes())
         sound_file.close()
-        self.buffer = []
-
-    def to_torch_tensor(self):
-        final_buffer = []
-        for data in self.buffer:
-            npbuffer = np.frombuffer(data, dtype=np.int16).astype(np.float32)
-            npbuffer = npbuffer / 32768  # normalize between -1 and 1
-            npbuffer = np.reshape(npbuffer, (-1, 1))  # reshape to time-major frame
-            final_buffer.append(npbuffer)  # append to final buffer
+        self.saved_frames = end
 
-        # concatenate all the small buffers
-        final_buffer_np = np.concatenate(final_buffer)
-        # convert final numpy array to torch tensor
-        torchbuffer = torch.from_numpy(final_buffer_np).to("cuda")
-        return torchbuffer
+    def to_torch_tensor(self, device="cpu"):
+        """Returns the audio captured since the last save, normalized to [-1, 1]"""
+        frames = torch.from_numpy(self.ring.frames(self.saved_frames))
+        return frames.to(device, torch.float32) / 32768
@@ -31,13 +31,9 @@ class ImitationLearningWrapper(TensorDictModuleWrapper):
             action_key = self.action_key
 
         predicted_action = action_tensordict.get(action_key)
-        act_dims = predicted_action.shape[-1]
-
-        tensordict[self.il_enabled_key]
-
-        cond = tensordict[self.il_enabled_key][..., -1, 3].item()
-        """ For environments that don't support take control, dimensions 4: won't be used """
-        il_action = tensordict[self.il_action_key][..., -1, 4:4 + act_dims]
+        """ For environments that don't support take control, il_action is unused """
+        cond = tensordict.get(self.il_enabled_key)
+        il_action = tensordict.get(self.il_action_key)
 
         out = cond * il_action + (1 - cond) * predicted_action
 
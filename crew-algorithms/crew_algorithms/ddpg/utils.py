@@ -2,11 +2,12 @@ import math
 import os
 import pickle
 import re
+from contextlib import nullcontext
 from datetime import datetime
 
 import torch
 from crew_algorithms.auto_encoder import EncoderTransform
-from crew_algorithms.auto_encoder.model import Encoder, StateEncoder
+from crew_algorithms.auto_encoder.model import Encoder, cache_encoder_features
 from crew_algorithms.ddpg.imitation_learning import ImitationLearningWrapper
 from crew_algorithms.ddpg.policy import (
     ContinuousActorNet,
@@ -15,12 +16,33 @@ from crew_algorithms.ddpg.policy import (
 )
 from crew_algorithms.envs.channels import WrittenFeedbackChannel
 from crew_algorithms.envs.configs import EnvironmentConfig
+from crew_algorithms.utils.frame_features import TransitionFrameFeatures
+from crew_algorithms.utils.model_utils import pixels_to_float
+from crew_algorithms.utils.replay_buffers import (
+    DevicePrioritizedSampler,
+    DeviceTensorDictReplayBuffer,
+    DeviceTensorStorage,
+    FrameStackStorage,
+    LatentReplay,
+    PrefetchingSampler,
+    estimate_transition_bytes,
+    split_stored_vector,
+)
 from crew_algorithms.utils.rl_utils import make_base_env
+from crew_algorithms.utils.template_matching import TemplateMatcher
+from crew_algorithms.utils.transforms import (
+    PreprocessPixels,
+    SplitVector,
+    split_stacked_vector,
+)
+from crew_algorithms.utils.updater import (
+    ForeachSoftUpdate,
+    optimizer_kernel_kwargs,
+)
 from PIL import Image
 from tensordict import TensorDict
 from tensordict.nn import TensorDictModule
 from torch import nn, optim
-from torch.nn import functional as F
 from torchrl.data import (
     LazyMemmapStorage,
     TensorDictPrioritizedReplayBuffer,
@@ -30,11 +52,8 @@ from torchrl.data.replay_buffers.samplers import PrioritizedSampler
 from torchrl.data.tensor_specs import ContinuousBox
 from torchrl.envs.transforms.transforms import (
     CatFrames,
-    CenterCrop,
     Compose,
-    Resize,
     StepCounter,
-    ToTensorImage,
     TransformedEnv,
     UnsqueezeTransform,
 )
@@ -44,7 +63,7 @@ from torchrl.modules import (
     TanhModule,
     ValueOperator,
 )
-from torchrl.objectives import DDPGLoss, SoftUpdate
+from torchrl.objectives import DDPGLoss
 from torchvision import transforms
 from torchvision.utils import save_image
 
@@ -75,13 +94,18 @@ def make_env(
             use_written_feedback=written_feedback,
         ),
         Compose(
-            ToTensorImage(in_keys=[("agents", "observation", "obs_0")], unsqueeze=True),
-            CenterCrop(
-                cfg.crop_h, cfg.crop_w, in_keys=[("agents", "observation", "obs_0")]
+            PreprocessPixels(
+                (cfg.crop_h, cfg.crop_w),
+                # A pretrained encoder embeds single frames, stacked afterwards.
+                num_stacks=1 if cfg.pretrained_encoder else cfg.num_stacks,
+                dtype=torch.uint8 if cfg.uint8_pixels else torch.float32,
+                in_keys=[("agents", "observation", "obs_0")],
+            ),
+            SplitVector(
+                cfg.obs_1_layout, in_keys=[("agents", "observation", "obs_1")]
             ),
-            Resize(100, 100, in_keys=[("agents", "observation", "obs_0")]),
             UnsqueezeTransform(
-                unsqueeze_dim=-3, in_keys=[("agents", "observation", "obs_1")]
+                unsqueeze_dim=-3, in_keys=[("agents", "observation", "state")]
             ),
         ),
     )
@@ -93,18 +117,17 @@ def make_env(
                 num_channels=cfg.num_stacks * cfg.num_channels,
                 in_keys=[("agents", "observation", "obs_0")],
                 out_keys=[(("agents", "observation", "encoded_vec"))],
-                version="latest",
             )
         )
-
-    env.append_transform(
-        CatFrames(
-            N=cfg.num_stacks, dim=-3, in_keys=[("agents", "observation", "obs_0")]
+        env.append_transform(
+            CatFrames(
+                N=cfg.num_stacks, dim=-3, in_keys=[("agents", "observation", "obs_0")]
+            )
         )
-    )
+
     env.append_transform(
         CatFrames(
-            N=cfg.num_stacks, dim=-2, in_keys=[("agents", "observation", "obs_1")]
+            N=cfg.num_stacks, dim=-2, in_keys=[("agents", "observation", "state")]
         )
     )
     env.append_transform(StepCounter())
@@ -134,12 +157,11 @@ def make_agent_continuous(proof_env, cfg, device):
         encoder = nn.Identity()
         in_dims = 64 * cfg.envs.num_stacks + (cfg.envs.additional_in_keys != {})
     elif cfg.from_states:
-        in_keys = {("agents", "observation", "obs_1"): "obs"}
+        in_keys = {("agents", "observation", "state"): "obs"}
         in_keys.update(additional_in_keys)
-        encoder = StateEncoder(cfg.envs.state_start_dim, cfg.envs.state_end_dim)
-        in_dims = (
-            cfg.envs.state_end_dim - cfg.envs.state_start_dim
-        ) * cfg.envs.num_stacks + (cfg.envs.additional_in_keys != {})
+        encoder = nn.Identity()
+        state_spec = proof_env.observation_spec["agents", "observation", "state"]
+        in_dims = state_spec.shape[-2:].numel() + (cfg.envs.additional_in_keys != {})
     else:
         in_keys = {("agents", "observation", "obs_0"): "obs"}
         in_keys.update(additional_in_keys)
@@ -170,8 +192,8 @@ def make_agent_continuous(proof_env, cfg, device):
     actor = ImitationLearningWrapper(
         actor,
         action_key=("agents", "action"),
-        il_enabled_key=("agents", "observation", "obs_1"),
-        il_action_key=("agents", "observation", "obs_1"),
+        il_enabled_key=("agents", "observation", "il_enabled"),
+        il_action_key=("agents", "observation", "il_action"),
     )
 
     qvalue_net = ContinuousQValueNet(
@@ -219,18 +241,55 @@ def make_agent_continuous(proof_env, cfg, device):
     return model, actor_model_explore, feedback_model
 
 
-def make_data_buffer(cfg, run_name):
-    p_sampler = PrioritizedSampler(
-        max_capacity=cfg.buffer_size, alpha=0.7, beta=0.9, reduction="max"
-    )
+def make_data_buffer(cfg, run_name, device="cpu"):
+    if cfg.dedup_frames and (cfg.from_states or cfg.envs.pretrained_encoder):
+        raise ValueError(
+            "dedup_frames only supports stacked pixel observations, not "
+            "from_states or a pretrained encoder."
+        )
+    # Deduplicated frames are always kept in a memmap storage.
+    use_device = cfg.buffer_storage == "device" and not cfg.dedup_frames
+    if use_device:
+        footprint = cfg.buffer_size * estimate_transition_bytes(cfg.envs) / 2**30
+        if footprint > cfg.buffer_memory_budget:
+            print(
+                f"Replay buffer needs ~{footprint:.1f} GB, over the budget of "
+                f"{cfg.buffer_memory_budget} GB, falling back to memmap storage"
+            )
+            use_device = False
 
-    replay_buffer = TensorDictReplayBuffer(
+    if use_device:
+        p_sampler = DevicePrioritizedSampler(
+            max_capacity=cfg.buffer_size,
+            alpha=0.7,
+            beta=0.9,
+            reduction="max",
+            device=device,
+        )
+        storage = DeviceTensorStorage(cfg.buffer_size, device=device)
+        buffer_cls = DeviceTensorDictReplayBuffer
+    else:
+        p_sampler = PrioritizedSampler(
+            max_capacity=cfg.buffer_size, alpha=0.7, beta=0.9, reduction="max"
+        )
+        if cfg.dedup_frames:
+            storage = FrameStackStorage(
+                cfg.buffer_size,
+                cfg.envs.num_stacks,
+                scratch_dir="../Data/Buffer/prb_%s" % run_name,
+                device="cpu",
+            )
+        else:
+            storage = LazyMemmapStorage(
+                cfg.buffer_size,
+                scratch_dir="../Data/Buffer/prb_%s" % run_name,
+                device="cpu",
+            )
+        buffer_cls = TensorDictReplayBuffer
+
+    replay_buffer = buffer_cls(
         pin_memory=False,
-        storage=LazyMemmapStorage(
-            cfg.buffer_size,
-            scratch_dir="../Data/Buffer/prb_%s" % run_name,
-            device="cpu",
-        ),
+        storage=storage,
         batch_size=cfg.batch_size,
         sampler=p_sampler,
         priority_key=("agents", "priority_weight"),
@@ -247,13 +306,93 @@ def make_data_buffer(cfg, run_name):
             batch_size=cfg.batch_size,
             priority_key="rank_adjusted_td_error",
         )
-        replay_buffer_expert = load_prb(replay_buffer_expert)
+        replay_buffer_expert = load_prb(replay_buffer_expert, cfg.envs.obs_1_layout)
     else:
         replay_buffer_expert = None
 
+    if uses_latent_replay(cfg):
+        replay_buffer = LatentReplay(
+            replay_buffer, LATENT_FRAME_KEYS, cfg.envs.num_channels
+        )
+        if replay_buffer_expert is not None:
+            replay_buffer_expert = LatentReplay(
+                replay_buffer_expert, LATENT_FRAME_KEYS, cfg.envs.num_channels
+            )
+
     return replay_buffer, replay_buffer_expert
 
 
+def make_prefetching_sampler(cfg, replay_buffer, replay_buffer_expert, device):
+    """Wraps the replay buffers to sample training batches ahead of time.
+
+    The expert transitions, if any, make up `cfg.expert_ratio` of every batch.
+    """
+    return PrefetchingSampler(
+        replay_buffer,
+        num_batches=cfg.prefetch_batches,
+        batch_size=cfg.batch_size,
+        batches_per_sample=cfg.batches_per_sample,
+        device=device,
+        pin_memory=cfg.pin_memory,
+        expert_buffer=replay_buffer_expert,
+        expert_ratio=cfg.expert_ratio,
+    )
+
+
+LATENT_FRAME_KEYS = [
+    ("agents", "observation", "obs_0"),
+    ("next", "agents", "observation", "obs_0"),
+]
+
+
+def uses_latent_replay(cfg):
+    """Whether the pixel encoder is frozen and its embeddings replayed."""
+    return (
+        cfg.optimization.freeze_encoder_after > 0
+        and not cfg.from_states
+        and not cfg.envs.pretrained_encoder
+    )
+
+
+def freeze_encoder(model, loss_module):
+    """Freezes the shared pixel encoder of the actor and critic.
+
+    The encoder is put in eval mode and stops receiving gradients. The
+    encoder of the target critic is set to the frozen weights, so that the
+    embeddings of the frozen encoder serve the targets as well.
+
+    Returns:
+        The frozen encoder.
+    """
+    # The loss runs copies of the networks with the parameters of the model.
+    modules = [
+        *model.modules(),
+        *loss_module.actor_network.modules(),
+        *loss_module.value_network.modules(),
+    ]
+    for module in modules:
+        if isinstance(module, Encoder):
+            module.eval().requires_grad_(False)
+    targets = loss_module.target_value_network_params
+    for key, value in loss_module.value_network_params.items(True, True):
+        if any("encoder" in k for k in key):
+            targets.get(key).data.copy_(value.data)
+    return next(m for m in model.modules() if isinstance(m, Encoder))
+
+
+def make_loss_context(cfg, replay_buffer):
+    """Makes the context a batch of the replay buffer is run through the loss in."""
+
+    def loss_context(tensordict):
+        if uses_latent_replay(cfg) and replay_buffer.active:
+            return cache_encoder_features(replay_buffer.frame_features(tensordict))
+        if cfg.optimization.reuse_encoder_features:
+            return cache_encoder_features()
+        return nullcontext()
+
+    return loss_context
+
+
 def make_loss_module(cfg, env, model):
     """Make loss module and target network updater."""
     # Create DDPG loss
@@ -277,8 +416,11 @@ def make_loss_module(cfg, env, model):
         exit(0)
 
     loss_module.make_value_estimator(gamma=cfg.optimization.gamma)
-    target_net_updater = SoftUpdate(
-        loss_module, eps=cfg.optimization.target_update_polyak
+    target_net_updater = ForeachSoftUpdate(
+        loss_module,
+        eps=cfg.optimization.target_update_polyak,
+        mode=cfg.optimization.target_update,
+        interval=cfg.optimization.target_update_interval,
     )
     return loss_module, target_net_updater
 
@@ -288,6 +430,9 @@ def make_optimizer(cfg, loss_module):
         loss_module.parameters(),
         lr=cfg.optimization.lr,
         weight_decay=cfg.optimization.weight_decay,
+        **optimizer_kernel_kwargs(
+            cfg.optimization.updater, loss_module.parameters()
+        ),
     )
 
     return optimizer
@@ -346,20 +491,10 @@ def lr_scheduler(
     return optimizer_actor, optimizer_critic, phase
 
 
-def human_delay_transform(td, shift_key, N):
+def human_delay_transform(td, feedback_key, N):
     """ Shifts the human feedback by N steps """
-    data = td.get(shift_key)
-    human_feedback = data[..., -1, 0]
-
-    human_feedback_0 = (
-        torch.ones((N, *human_feedback.shape[1:]), device=human_feedback.device) * 0
-    )
-
-    human_feedback = torch.cat([human_feedback, human_feedback_0], 0)
-    human_feedback = human_feedback[N:]
-
-    data[..., -1, 0] = human_feedback
-    td.set(shift_key, data)
+    feedback = td.get(feedback_key)
+    td.set(feedback_key, torch.cat([feedback[N:], torch.zeros_like(feedback[:N])]))
     # Return the tensors with valid data and the tensors with placeholder separately
     return td[:-N], td[-N:]
 
@@ -402,18 +537,13 @@ def override_il_feedback(td, il_enabled_key, feedback_key, il_feedback):
     """ Sets feedback value of human controlled steps to il_feedback """
     # https://arxiv.org/pdf/1905.06750.pdf
     # https://arxiv.org/pdf/2108.04763.pdf
-    original_feedback = td.get(feedback_key)
-    feedback = original_feedback[..., -1, 0]
-
-    il_enabled = td.get(il_enabled_key)[..., -1, 3].bool()
-    feedback[il_enabled] = il_feedback
-    original_feedback[..., -1, 0] = feedback
-    td.set(feedback_key, original_feedback)
+    feedback = td.get(feedback_key)
+    feedback[td.get(il_enabled_key).bool()] = il_feedback
     return td
 
 
 def audio_feedback(stream, time_stamp, action_key, reward_key, prb):
-    if len(stream.buffer) < 128:
+    if stream.pending_frames < 128 * stream.frames_per_buffer:
         return prb
     effected_data_idx = prb["_data", "time_stamp"] > time_stamp - 3
 
@@ -557,7 +687,12 @@ def fill_prb(
             experiences = []
 
 
-def load_prb(prb, path="../Data/Offline/Replay_nodone", chunk_size=1024):
+# Key of the packed vector, which transitions stored before it was split in the
+# environment hold stacked whole.
+OBS_1_KEY = ("agents", "observation", "obs_1")
+
+
+def load_prb(prb, obs_1_layout, path="../Data/Offline/Replay_nodone", chunk_size=1024):
     from time import time
 
     tic = time()
@@ -568,7 +703,7 @@ def load_prb(prb, path="../Data/Offline/Replay_nodone", chunk_size=1024):
         for j in range(0, len(experiences), chunk_size):
             print("Loading Expert Experiences: %d/%d" % (j, len(experiences)), end="\r")
             e = torch.cat(experiences[j : j + chunk_size], dim=0)
-            prb.extend(e.cpu())
+            prb.extend(split_stacked_vector(e, OBS_1_KEY, obs_1_layout).cpu())
 
     print("Loading finished in %.1f seconds" % (time() - tic))
     return prb
@@ -580,19 +715,23 @@ def visualize(data, i, num_channels, fpb, hf=False, continuous=True):
         d = data["next", "agents", "done"][j].item()
 
         if hf:
-            r_hf = data["agents", "observation", "obs_1"][j][..., -1, 0].item()
+            r_hf = data["agents", "observation", "feedback"][j].item()
         else:
             r_hf = data["next", "agents", "feedback"][j].item()
 
         os.makedirs("visualize", exist_ok=True)
         save_image(
-            data["agents", "observation", "obs_0"][j, ..., -num_channels:, :, :],
+            pixels_to_float(
+                data["agents", "observation", "obs_0"][j, ..., -num_channels:, :, :]
+            ),
             "visualize/frame_%d_r%.2f_d%d_rhf%.2f.png" % (i * fpb + j, r, d, r_hf),
         )
         save_image(
-            data["next", "agents", "observation", "obs_0"][
-                j, ..., -num_channels:, :, :
-            ],
+            pixels_to_float(
+                data["next", "agents", "observation", "obs_0"][
+                    j, ..., -num_channels:, :, :
+                ]
+            ),
             "visualize/frame_%d_next.png" % (i * fpb + j),
         )
 
@@ -602,41 +741,36 @@ class heuristic_feedback:
     Args:
         template_path: The path to the template image of the treasure.
         threshold: The threshold for the treasure detection.
-        batch_size: The batch size of the model.
         device: The device to perform operations on.
     """
-    def __init__(self, template_path, threshold, batch_size, device):
+    def __init__(self, template_path, threshold, device):
         template = Image.open(template_path)
         self.totens = transforms.ToTensor()
         self.template = self.totens(template).unsqueeze(0).to(device) + 1e-6
 
         torch._assert(len(self.template.shape) == 4, "Template should be 4D")
-        self.template_morm = ((self.template**2).sum() ** 0.5).repeat(
-            batch_size, 1, 1, 1
-        )
-        self.one_kernel = torch.ones_like(self.template, device=device)
+        self.matcher = TemplateMatcher(self.template, threshold)
         self.threshold = threshold
+        self.frame_features = TransitionFrameFeatures(self._frame_features)
 
     def treasure_in_view(self, frame):
         torch._assert(len(frame.shape) == 4, "Frame should be 4D")
+        return self.matcher(frame + 1e-6)
 
-        frame = frame + 1e-6
-
-        brightness = F.conv2d(frame**2, self.one_kernel) ** 0.5
-        heat_map = F.conv2d(frame, self.template)
-        heat_map = heat_map / (brightness * self.template_morm)
-
-        out = (heat_map > self.threshold).sum(dim=(1, 2, 3)) > 0
-        return out
+    def _frame_features(self, frames):
+        frames = pixels_to_float(frames)
+        non_black = (frames > 0).float().sum(dim=(1, 2, 3))
+        return self.treasure_in_view(frames), non_black
 
     def moved_closer(self, td):
-        next_agent = td["next", "agents", "observation", "obs_1"][..., -1, 6:9]
-        next_treasure = td["next", "agents", "observation", "obs_1"][..., -1, 12:15]
+        # Copies, the heights are zeroed without modifying the observations.
+        next_agent = td["next", "agents", "observation", "agent_position"].clone()
+        next_treasure = td["next", "agents", "observation", "target_position"].clone()
         next_agent[..., 1], next_treasure[..., 1] = 0, 0
         next_distance = ((next_agent - next_treasure) ** 2).mean(dim=-1, keepdim=True)
 
-        current_agent = td["agents", "observation", "obs_1"][..., -1, 6:9]
-        current_treasure = td["agents", "observation", "obs_1"][..., -1, 12:15]
+        current_agent = td["agents", "observation", "agent_position"].clone()
+        current_treasure = td["agents", "observation", "target_position"].clone()
         current_agent[..., 1], current_treasure[..., 1] = 0, 0
         current_distance = ((current_agent - current_treasure) ** 2).mean(
             dim=-1, keepdim=True
@@ -645,33 +779,21 @@ class heuristic_feedback:
         r_dis = (current_distance - next_distance) / 10
         return r_dis.squeeze(-1).squeeze(-1)
 
-    def explored(self, f_current, f_next):
-        non_black_current = (f_current > 0).float().sum(dim=(1, 2, 3))
-        non_black_next = (f_next > 0).float().sum(dim=(1, 2, 3))
-        explored = (non_black_next - non_black_current - 300) / 1000
-        return explored
-
-    def treasure_appeared(self, f_current, f_next):
-        current_treasure = self.treasure_in_view(f_current)
-        next_treasure = self.treasure_in_view(f_next)
-        return (next_treasure & ~current_treasure).float() * 2 - 1
-
-    def get_treasure_in_view(self, f_current, f_next):
-        in_current = self.treasure_in_view(f_current)
-        in_next = self.treasure_in_view(f_next)
-        return in_current, in_next
+    def explored(self, non_black_current, non_black_next):
+        """Rewards the newly lit pixels, given the non-black pixel counts"""
+        return (non_black_next - non_black_current - 300) / 1000
 
     def provide_feedback(self, td):
         f_current = td.get(("agents", "observation", "obs_0")).squeeze(1)[:, -3:]
         f_next = td.get(("next", "agents", "observation", "obs_0")).squeeze(1)[:, -3:]
-
-        treasure_in_view, treasure_in_next = self.get_treasure_in_view(
-            f_current, f_next
-        )
+        # Each frame is only processed once, see `TransitionFrameFeatures`.
+        current_features, next_features = self.frame_features(f_current, f_next)
+        treasure_in_view, non_black_current = current_features
+        treasure_in_next, non_black_next = next_features
         treasure_not_in_view = ~treasure_in_view
 
         moved_closer = self.moved_closer(td)
-        explored = self.explored(f_current, f_next)
+        explored = self.explored(non_black_current, non_black_next)
 
         feedback = (
             treasure_in_view.float() * moved_closer
@@ -724,7 +846,9 @@ def save_training(
     prb.dumps("../Data/Saved_Training/%s/prb.pkl" % run_name)
 
 
-def load_training(model, prb, loss_module, run_name, global_start_time, iter, device):
+def load_training(
+    model, prb, loss_module, run_name, global_start_time, iter, device, obs_1_layout
+):
     model.load_state_dict(
         torch.load("../Data/Saved_Training/%s/weights_Iter_%d.pth" % (run_name, iter))
     )
@@ -732,6 +856,7 @@ def load_training(model, prb, loss_module, run_name, global_start_time, iter, de
         torch.load("../Data/Saved_Training/%s/loss_module_Iter_%d.pth" % (run_name, iter))
     )
     prb.loads("../Data/Saved_Training/%s/prb.pkl" % run_name)
+    split_stored_vector(prb, OBS_1_KEY, obs_1_layout)
 
     with open("../Data/Saved_Training/%s/meta.pkl" % run_name, "rb") as f:
         meta = pickle.load(f)
@@ -762,6 +887,75 @@ def load_training(model, prb, loss_module, run_name, global_start_time, iter, de
     )
 
 
+HISTORY_KEYS = (
+    ("agents", "observation", "obs_0"),
+    ("agents", "action"),
+    ("next", "agents", "feedback"),
+)
+
+
+def _history_from_windows(windows, num_channels):
+    """Builds the history from the 7 consecutive transitions ending at each sample.
+
+    The history holds the newest frame of all 7 transitions, and the actions
+    and feedbacks of the 6 transitions before the sample.
+    """
+    frames = windows.get(HISTORY_KEYS[0])[..., 0, -num_channels:, :, :]
+    actions = windows.get(HISTORY_KEYS[1])[:, :-1, 0]
+    feedbacks = windows.get(HISTORY_KEYS[2])[:, :-1, 0]
+    return TensorDict(
+        {
+            "obs": frames.flatten(1, 2).unsqueeze(1),  # [bs, 1, 3x7, 100, 100]
+            "actions": actions.unsqueeze(1),  # [bs, 1, 6, 2]
+            "feedbacks": feedbacks.unsqueeze(1),  # [bs, 1, 6, 1]
+        },
+        batch_size=windows.batch_size[:1],
+    )
+
+
+def history_transform(td, last_td, num_channels, history_len=7):
+    """Builds the feedback model history of every transition of a batch.
+
+    Windows over the batch are strided views of the batch prepended with
+    the last transitions of the previous one, so the only copy is the
+    output itself.
+
+    Returns:
+        The history of every transition and the transitions to carry over
+        to the next batch.
+    """
+    data = torch.cat([last_td.select(*HISTORY_KEYS), td.select(*HISTORY_KEYS)])
+    # unfold appends the window dimension last, move it next to the batch.
+    windows = data.apply(
+        lambda x: x.unfold(0, history_len, 1).movedim(-1, 1),
+        batch_size=[len(td), history_len],
+    )
+    return (
+        _history_from_windows(windows, num_channels),
+        data[-(history_len - 1) :],
+    )
+
+
+def gather_history(replay_buffer, index, num_channels, history_len=7):
+    """Rebuilds the history of sampled transitions from their storage index.
+
+    Transitions are written in the order they were collected, so the
+    transitions before a sample are the ones stored right before it. Windows
+    are taken relative to the write cursor of the storage, where the oldest
+    transition is once the buffer is full, and are padded with the oldest
+    stored transition instead of wrapping around to the newest ones.
+    """
+    max_size = replay_buffer._storage.max_size
+    cursor = replay_buffer._writer._cursor
+    # The age of every slot, from 0 for the slot the cursor points to.
+    age = (index.cpu() - cursor) % max_size
+    window = age.unsqueeze(-1) + torch.arange(1 - history_len, 1)
+    window = window.clamp_min(max_size - len(replay_buffer))
+    window = (window + cursor) % max_size
+    windows = replay_buffer[window.reshape(-1)].select(*HISTORY_KEYS)
+    return _history_from_windows(windows.reshape(*window.shape), num_channels)
+
+
 def feedback_model_train_step(history, model, data, optim, val=False):
     """Trains the feedback model for one step"""
     if history:
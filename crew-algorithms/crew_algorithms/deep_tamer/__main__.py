@@ -3,7 +3,6 @@ from collections import defaultdict
 from time import time
 
 import hydra
-import numpy as np
 from attrs import define
 from crew_algorithms.envs.configs import EnvironmentConfig, register_env_configs
 from crew_algorithms.utils.common_utils import get_time
@@ -67,6 +66,7 @@ def deep_tamer(cfg: Config):
     )
     from crew_algorithms.envs.channels import ToggleTimestepChannel
     from crew_algorithms.utils.common_utils import SortedItem
+    from crew_algorithms.utils.episode_stats import EpisodeStatsTracker
     from crew_algorithms.utils.rl_utils import log_policy, make_collector
     from torchrl.record.loggers import generate_exp_name, get_logger
 
@@ -106,12 +106,9 @@ def deep_tamer(cfg: Config):
     log_reward = defaultdict(float)
     log_feedback = defaultdict(float)
 
-    episode_reward= defaultdict(float)
-    last_traj_ID = 0
+    episode_stats = EpisodeStatsTracker(cfg.log_smoothing)
     collected_frames = 0
 
-    episode_success = []
-
     i = 0
     save_weights_timer = 0
 
@@ -121,45 +118,30 @@ def deep_tamer(cfg: Config):
 
     for data in collector:
         collected_frames += data.numel()
-        episode_success.extend(
-            data["next", "agents", "reward"][
-                data["next", "agents", "done"] == True
-            ].tolist()
-        )
+        for stats in episode_stats.update(
+            data["agents", "observation", "traj_id"],
+            data["next", "agents", "reward"],
+        ):
+            logger.log_scalar(
+                "avg_episode_reward", stats.avg_reward, step=collected_frames
+            )
+            if len(episode_stats.successes) > 10:
+                logger.log_scalar(
+                    "success_rate", stats.success_rate, step=collected_frames
+                )
+
         for single_data_view in data.unbind(0):
             single_data_view["feedback"] = single_data_view[
-                ("agents", "observation", "obs_1")
-            ][:, -1, 0:1]
-
-            start_time = single_data_view[("agents", "observation", "obs_1")][:, -1, 1]
-            end_time = single_data_view[("next", "agents", "observation", "obs_1")][
-                :, -1, 1
+                "agents", "observation", "feedback"
             ]
-            single_data_view["time"] = torch.cat([start_time, end_time], dim=-1)
-            traj_ID = single_data_view[("agents", "observation", "obs_1")][
-                :, -1, 2
-            ].item()
-            next_ID = single_data_view[("next", "agents", "observation", "obs_1")][
-                :, -1, 2
-            ].item()
 
-            episode_reward[traj_ID] += single_data_view[
-                "next", "agents", "reward"
+            start_time = single_data_view["agents", "observation", "time"][:, 0]
+            end_time = single_data_view["next", "agents", "observation", "time"][:, 0]
+            single_data_view["time"] = torch.cat([start_time, end_time], dim=-1)
+            traj_ID = single_data_view["agents", "observation", "traj_id"].item()
+            next_ID = single_data_view[
+                "next", "agents", "observation", "traj_id"
             ].item()
-            if traj_ID != last_traj_ID:
-                r_list = [episode_reward[ep] for ep in episode_reward]
-                avg_ep_r = np.array(
-                    r_list[max(0, len(r_list) - cfg.log_smoothing - 1) : -1]
-                ).mean()
-                logger.log_scalar("avg_episode_reward", avg_ep_r, step=collected_frames)
-
-                last_traj_ID = traj_ID
-
-            if len(episode_success) > 10:
-                avg_sr = sum(episode_success[-cfg.log_smoothing - 1 :]) / min(
-                    cfg.log_smoothing, len(episode_success)
-                )
-                logger.log_scalar("success_rate", avg_sr, step=collected_frames)
 
             i += 1
             single_data_view["feedback"] = single_data_view["feedback"].clamp(-1, 1)
@@ -70,7 +70,7 @@ class ContinuousActorNet(nn.Module):
         if self.num_channels is not None:
             obs = obs.view(
                 obs.shape[0], -1, self.num_channels, obs.shape[-2], obs.shape[-1]
-            ).view(-1, self.num_channels, obs.shape[-2], obs.shape[-1])
+            )
 
         obs = self.encoder(obs).flatten(1).view(bs, -1)
 
@@ -124,7 +124,7 @@ class ContinuousQValueNet(nn.Module):
         if self.num_channels is not None:
             obs = obs.view(
                 obs.shape[0], -1, self.num_channels, obs.shape[-2], obs.shape[-1]
-            ).view(-1, self.num_channels, obs.shape[-2], obs.shape[-1])
+            )
 
         obs = self.encoder(obs).flatten(1).view(bs, -1)
         while len(action.shape) > 2:
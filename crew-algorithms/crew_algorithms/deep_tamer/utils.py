@@ -3,7 +3,7 @@ from datetime import datetime
 from torchvision.utils import save_image
 import torch
 from crew_algorithms.auto_encoder import EncoderTransform
-from crew_algorithms.auto_encoder.model import Encoder, StateEncoder
+from crew_algorithms.auto_encoder.model import Encoder
 from crew_algorithms.deep_tamer.loss import TamerLoss
 from crew_algorithms.deep_tamer.policy import (
     ContinuousActorNet,
@@ -12,8 +12,14 @@ from crew_algorithms.deep_tamer.policy import (
 )
 from crew_algorithms.envs.channels import ToggleTimestepChannel
 from crew_algorithms.envs.configs import EnvironmentConfig
+from crew_algorithms.utils.model_utils import pixels_to_float
 from crew_algorithms.utils.rl_utils import make_base_env
-from crew_algorithms.utils.transforms import CatUnitySensorsAlongChannelDimTransform
+from crew_algorithms.utils.transforms import (
+    CatUnitySensorsAlongChannelDimTransform,
+    PreprocessPixels,
+    SplitVector,
+)
+from crew_algorithms.utils.updater import ForeachSoftUpdate
 from sortedcontainers import SortedList
 from tensordict.nn import TensorDictModule
 from torch import nn
@@ -26,9 +32,6 @@ from torchrl.data.tensor_specs import ContinuousBox, DiscreteTensorSpec
 from torchrl.envs import Compose, EnvBase, StepCounter, TransformedEnv
 from torchrl.envs.transforms.transforms import (
     CatFrames,
-    CenterCrop,
-    Resize,
-    ToTensorImage,
     UnsqueezeTransform,
 )
 from torchrl.modules import (
@@ -38,7 +41,6 @@ from torchrl.modules import (
     SafeSequential,
     TanhModule,
 )
-from torchrl.objectives import SoftUpdate
 from torchvision.utils import save_image
 
 
@@ -63,13 +65,16 @@ def make_env(
     env = TransformedEnv(
         make_base_env(cfg, device, toggle_timestep_channel=toggle_timestep_channel),
         Compose(
-            ToTensorImage(in_keys=[("agents", "observation", "obs_0")], unsqueeze=True),
-            CenterCrop(
-                cfg.crop_h, cfg.crop_w, in_keys=[("agents", "observation", "obs_0")]
+            PreprocessPixels(
+                (cfg.crop_h, cfg.crop_w),
+                # A pretrained encoder embeds single frames, stacked afterwards.
+                num_stacks=1 if cfg.pretrained_encoder else cfg.num_stacks,
+                dtype=torch.uint8 if cfg.uint8_pixels else torch.float32,
+                in_keys=[("agents", "observation", "obs_0")],
             ),
-            Resize(100, 100, in_keys=[("agents", "observation", "obs_0")]),
+            SplitVector(cfg.obs_1_layout, in_keys=[("agents", "observation", "obs_1")]),
             UnsqueezeTransform(
-                unsqueeze_dim=-3, in_keys=[("agents", "observation", "obs_1")]
+                unsqueeze_dim=-3, in_keys=[("agents", "observation", "state")]
             ),
         ),
     )
@@ -81,17 +86,17 @@ def make_env(
                 num_channels=cfg.num_stacks * cfg.num_channels,
                 in_keys=[("agents", "observation", "obs_0")],
                 out_keys=[(("agents", "observation", "encoded_vec"))],
-                version="latest",
             )
         )
-    env.append_transform(
-        CatFrames(
-            N=cfg.num_stacks, dim=-3, in_keys=[("agents", "observation", "obs_0")]
+        env.append_transform(
+            CatFrames(
+                N=cfg.num_stacks, dim=-3, in_keys=[("agents", "observation", "obs_0")]
+            )
         )
-    )
+
     env.append_transform(
         CatFrames(
-            N=cfg.num_stacks, dim=-2, in_keys=[("agents", "observation", "obs_1")]
+            N=cfg.num_stacks, dim=-2, in_keys=[("agents", "observation", "state")]
         )
     )
     env.append_transform(StepCounter())
@@ -119,12 +124,11 @@ def make_agent_continuous(proof_env, cfg, device):
         encoder = nn.Identity()
         in_dims = 64 * cfg.envs.num_stacks + (cfg.envs.additional_in_keys != {})
     elif cfg.from_states:
-        in_keys = {("agents", "observation", "obs_1"): "obs"}
+        in_keys = {("agents", "observation", "state"): "obs"}
         in_keys.update(additional_in_keys)
-        encoder = StateEncoder(cfg.envs.state_start_dim, cfg.envs.state_end_dim)
-        in_dims = (
-            cfg.envs.state_end_dim - cfg.envs.state_start_dim
-        ) * cfg.envs.num_stacks + (cfg.envs.additional_in_keys != {})
+        encoder = nn.Identity()
+        state_spec = proof_env.observation_spec["agents", "observation", "state"]
+        in_dims = state_spec.shape[-2:].numel() + (cfg.envs.additional_in_keys != {})
     else:
         in_keys = {("agents", "observation", "obs_0"): "obs"}
         in_keys.update(additional_in_keys)
@@ -252,7 +256,7 @@ def make_loss(model, device, credit_window_right=1.0):
         device=device,
     )
 
-    target_net_updater = SoftUpdate(loss, eps=0.995)
+    target_net_updater = ForeachSoftUpdate(loss, eps=0.995)
     return loss, target_net_updater
 
 
@@ -317,8 +321,8 @@ def step_policy(sampled_tensordict, loss_module, optim, target_net_updater):
 
 
 def visualize(data, i):
-    current_frame = data["agents", "observation", "obs_0"]
-    next_frame = data["next", "agents", "observation", "obs_0"]
+    current_frame = pixels_to_float(data["agents", "observation", "obs_0"])
+    next_frame = pixels_to_float(data["next", "agents", "observation", "obs_0"])
 
     name = datetime.now().strftime("%H%M%S")
     os.makedirs("visualize", exist_ok=True)
@@ -28,6 +28,21 @@ class EnvironmentConfig:
     shift_reward: float = 0.0
     dense_reward_scale: float = 1.0
     credit_window_right: float = 4.0
+    batched_decode: bool = False  # decode agent steps per behavior, not per agent
+    batched_actions: bool = False  # submit actions per behavior, not per agent
+    static_buffers: bool = False  # decode steps into a preallocated output
+    frame_skip: int = 1  # number of Unity steps each action is repeated for
+    uint8_pixels: bool = False  # keep visual observations as uint8 until sampled
+    mock: bool = False  # use a pure Python stand-in instead of the Unity build
+    mock_episode_length: int = 100  # number of steps per episode of the mock
+    # The [start, end) columns of the named fields packed in obs_1, only the
+    # "state" field is stacked
+    obs_1_layout: dict = {
+        "feedback": (0, 1),
+        "time": (1, 2),
+        "traj_id": (2, 3),
+        "il_enabled": (3, 4),
+    }
 
 
 @define(auto_attribs=True)
@@ -52,8 +67,6 @@ class BowlingConfig(EnvironmentConfig):
     no_graphics: bool = False
     time_scale: float = 1.0
     seed: int = 42
-    state_start_dim: int = 4
-    state_end_dim: int = 36
     pretrained_encoder: bool = False
     crop_h: int = 60
     crop_w: int = 120
@@ -63,6 +76,14 @@ class BowlingConfig(EnvironmentConfig):
     shift_reward: float = 0.0
     dense_reward_scale: float = 5.0
     credit_window_right: float = 4.0
+    obs_1_layout: dict = {
+        "feedback": (0, 1),
+        "time": (1, 2),
+        "traj_id": (2, 3),
+        "il_enabled": (3, 4),
+        "il_action": (4, 7),
+        "state": (4, 36),
+    }
 
 
 @define(auto_attribs=True)
@@ -88,8 +109,6 @@ class FindTreasureConfig(EnvironmentConfig):
     no_graphics: bool = False
     time_scale: float = 1.0
     seed: int = 42
-    state_start_dim: int = 5
-    state_end_dim: int = 9
     pretrained_encoder: bool = False
     additional_in_keys: dict = {"step_count": ("agents", "step_count")}
     crop_h: int = 100
@@ -101,6 +120,16 @@ class FindTreasureConfig(EnvironmentConfig):
     shift_reward: float = -1.0
     dense_reward_scale: float = 1.0
     credit_window_right: float = 1.0
+    obs_1_layout: dict = {
+        "feedback": (0, 1),
+        "time": (1, 2),
+        "traj_id": (2, 3),
+        "il_enabled": (3, 4),
+        "il_action": (4, 6),
+        "state": (5, 9),
+        "agent_position": (6, 9),
+        "target_position": (12, 15),
+    }
 
 
 @define(auto_attribs=True)
@@ -126,8 +155,6 @@ class HideAndSeek1V1Config(EnvironmentConfig):
     no_graphics: bool = False
     time_scale: float = 1.0
     seed: int = 42
-    state_start_dim: int = 5
-    state_end_dim: int = 9
     pretrained_encoder: bool = False
     additional_in_keys: dict = {"step_count": ("agents", "step_count")}
     crop_h: int = 100
@@ -139,6 +166,16 @@ class HideAndSeek1V1Config(EnvironmentConfig):
     shift_reward: float = -1.0
     dense_reward_scale: float = 1.0
     credit_window_right: float = 1.0
+    obs_1_layout: dict = {
+        "feedback": (0, 1),
+        "time": (1, 2),
+        "traj_id": (2, 3),
+        "il_enabled": (3, 4),
+        "il_action": (4, 6),
+        "state": (5, 9),
+        "agent_position": (6, 9),
+        "target_position": (12, 15),
+    }
 
 
 @define(auto_attribs=True)
@@ -165,8 +202,6 @@ class HideAndSeekConfig(EnvironmentConfig):
     no_graphics: bool = False
     time_scale: float = 1.0
     seed: int = 42
-    state_start_dim: int = 3
-    state_end_dim: int = 9
     pretrained_encoder: bool = False
     additional_in_keys: dict = {"step_count": ("agents", "step_count")}
     crop_h: int = 100
@@ -178,6 +213,14 @@ class HideAndSeekConfig(EnvironmentConfig):
     shift_reward: float = -1.0
     dense_reward_scale: float = 1.0
     credit_window_right: float = 1.0
+    obs_1_layout: dict = {
+        "feedback": (0, 1),
+        "time": (1, 2),
+        "traj_id": (2, 3),
+        "il_enabled": (3, 4),
+        "il_action": (4, 6),
+        "state": (3, 9),
+    }
 
     @property
     def num_player_args(self) -> list[str]:
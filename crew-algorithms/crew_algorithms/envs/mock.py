@@ -0,0 +1,269 @@
+from typing import NamedTuple
+
+import numpy as np
+from crew_algorithms.envs.configs import EnvironmentConfig
+from mlagents_envs.base_env import (
+    ActionSpec,
+    ActionTuple,
+    BaseEnv,
+    BehaviorMapping,
+    BehaviorSpec,
+    DecisionSteps,
+    DimensionProperty,
+    ObservationSpec,
+    ObservationType,
+    TerminalSteps,
+)
+from mlagents_envs.exception import UnityActionException
+
+
+class MockBehavior(NamedTuple):
+    """The observation and action layout of a single Unity behavior.
+
+    The packed `obs_1` vector always starts with the feedback, time,
+    trajectory ID and imitation learning flag columns that the Unity
+    agents write before their own state.
+    """
+
+    visual_shape: tuple[int, int, int]
+    vector_size: int
+    action_size: int
+    position_slice: slice | None = None
+
+
+# Layouts mirror the agent prefabs of the crew-dojo builds.
+BOWLING = MockBehavior((128, 128, 1), 35, 3)
+PLAYER = MockBehavior((128, 128, 3), 15, 2, slice(6, 9))
+HIDE_AND_SEEK = MockBehavior((128, 128, 3), 10, 2, slice(4, 7))
+
+
+def mock_behaviors(env_cfg: EnvironmentConfig) -> dict[str, tuple[MockBehavior, int]]:
+    """Maps each behavior name of an environment to its layout and agent count.
+
+    Args:
+        env_cfg: The environment configuration.
+
+    Returns:
+        The behaviors of the environment, in the order Unity registers them.
+    """
+    if env_cfg.name == "bowling":
+        return {"Bowling?team=0": (BOWLING, env_cfg.num_agents)}
+    elif env_cfg.name in ("find_treasure", "hide_and_seek_1v1"):
+        return {"Player?team=0": (PLAYER, env_cfg.num_agents)}
+    elif env_cfg.name == "hide_and_seek":
+        return {
+            "Hider?team=0": (HIDE_AND_SEEK, env_cfg.num_hiders),
+            "Seeker?team=0": (HIDE_AND_SEEK, env_cfg.num_seekers),
+        }
+    raise ValueError(f"No mock environment available for {env_cfg.name}.")
+
+
+class MockUnityEnvironment(BaseEnv):
+    """A pure Python stand-in for a CREW Unity build.
+
+    Reproduces the behavior specs of the Unity environments so that the
+    wrappers, transforms and algorithms can be run and profiled without
+    launching a build. Visual observations are drawn from a small bank of
+    random frames, positions follow the continuous actions and every agent
+    terminates after `episode_length` steps with a random sparse reward.
+    Agent IDs are contiguous across behaviors, starting at 0.
+
+    Args:
+        behaviors: Maps each behavior name to its layout and number of agents.
+        episode_length: The number of steps before an agent terminates.
+        time_step: The amount of game time that passes every step.
+        num_frames: The number of random frames to cycle through per behavior.
+        seed: The seed used to generate observations and rewards.
+    """
+
+    def __init__(
+        self,
+        behaviors: dict[str, tuple[MockBehavior, int]],
+        episode_length: int = 100,
+        time_step: float = 0.1,
+        num_frames: int = 16,
+        seed: int = 42,
+    ) -> None:
+        if episode_length < 1:
+            raise ValueError("episode_length must be a positive integer.")
+        self.episode_length = episode_length
+        self.time_step = time_step
+        self._rng = np.random.default_rng(seed)
+        self._layouts = {}
+        self._specs = {}
+        self._agent_ids = {}
+        self._frames = {}
+        next_agent_id = 0
+        for behavior_name, (layout, num_agents) in behaviors.items():
+            if num_agents < 1:
+                raise ValueError(f"{behavior_name} needs at least one agent.")
+            self._layouts[behavior_name] = layout
+            self._specs[behavior_name] = BehaviorSpec(
+                [
+                    ObservationSpec(
+                        layout.visual_shape,
+                        (DimensionProperty.NONE,) * 3,
+                        ObservationType.DEFAULT,
+                        "CameraSensor",
+                    ),
+                    ObservationSpec(
+                        (layout.vector_size,),
+                        (DimensionProperty.NONE,),
+                        ObservationType.DEFAULT,
+                        "VectorSensor_size" + str(layout.vector_size),
+                    ),
+                ],
+                ActionSpec.create_continuous(layout.action_size),
+            )
+            self._agent_ids[behavior_name] = np.arange(
+                next_agent_id, next_agent_id + num_agents, dtype=np.int32
+            )
+            self._frames[behavior_name] = self._rng.random(
+                (num_frames, *layout.visual_shape), dtype=np.float32
+            )
+            next_agent_id += num_agents
+        self._behavior_specs = BehaviorMapping(self._specs)
+        self._num_agents = next_agent_id
+        self._actions = {}
+        self._steps = {}
+        # Like in Unity, game time and trajectory IDs keep growing over resets.
+        self._time = 0.0
+        self._traj_ids = np.full(self._num_agents, -1, dtype=np.int64)
+        self.reset()
+
+    @classmethod
+    def from_config(cls, env_cfg: EnvironmentConfig) -> "MockUnityEnvironment":
+        """Creates the mock matching an environment configuration.
+
+        Args:
+            env_cfg: The environment configuration.
+
+        Returns:
+            The mock environment.
+        """
+        return cls(
+            mock_behaviors(env_cfg),
+            episode_length=env_cfg.mock_episode_length,
+            seed=env_cfg.seed,
+        )
+
+    @property
+    def behavior_specs(self) -> BehaviorMapping:
+        return self._behavior_specs
+
+    def reset(self) -> None:
+        self._step_count = np.zeros(self._num_agents, dtype=np.int64)
+        self._traj_ids += 1
+        self._positions = self._rng.uniform(-10, 10, (self._num_agents, 3))
+        self._positions[:, 1] = 0.0
+        self._states = {}
+        for behavior_name, agent_ids in self._agent_ids.items():
+            # Columns past the packed header hold per-episode state.
+            state = self._rng.random(
+                (len(agent_ids), self._layouts[behavior_name].vector_size),
+                dtype=np.float32,
+            )
+            state[:, :4] = 0.0
+            self._states[behavior_name] = state
+        self._terminated = np.zeros(self._num_agents, dtype=bool)
+        self._actions.clear()
+        self._make_steps()
+
+    def step(self) -> None:
+        self._time += self.time_step
+        for behavior_name in self._agent_ids:
+            action = self._actions.get(behavior_name)
+            decision_ids = self._steps[behavior_name][0].agent_id
+            if action is not None and action.continuous.shape[1] >= 2:
+                self._positions[decision_ids, 0] += (
+                    action.continuous[:, 0] * self.time_step
+                )
+                self._positions[decision_ids, 2] += (
+                    action.continuous[:, 1] * self.time_step
+                )
+        # Agents that terminated last step start a new trajectory.
+        self._traj_ids[self._terminated] += 1
+        self._step_count[self._terminated] = 0
+        self._step_count[~self._terminated] += 1
+        self._terminated = self._step_count >= self.episode_length
+        self._actions.clear()
+        self._make_steps()
+
+    def close(self) -> None:
+        self._steps.clear()
+
+    def set_actions(self, behavior_name: str, action: ActionTuple) -> None:
+        decision_steps, _ = self._get_cached_steps(behavior_name)
+        spec = self._specs[behavior_name].action_spec
+        self._actions[behavior_name] = spec._validate_action(
+            action, len(decision_steps), behavior_name
+        )
+
+    def set_action_for_agent(
+        self, behavior_name: str, agent_id: int, action: ActionTuple
+    ) -> None:
+        decision_steps, _ = self._get_cached_steps(behavior_name)
+        spec = self._specs[behavior_name].action_spec
+        action = spec._validate_action(action, 1, behavior_name)
+        if behavior_name not in self._actions:
+            self._actions[behavior_name] = spec.empty_action(len(decision_steps))
+        index = np.flatnonzero(decision_steps.agent_id == agent_id)
+        if len(index) == 0:
+            raise IndexError(
+                f"agent_id {agent_id} did not request a decision at the previous step"
+            )
+        self._actions[behavior_name].continuous[index[0]] = action.continuous[0]
+
+    def get_steps(self, behavior_name: str) -> tuple[DecisionSteps, TerminalSteps]:
+        return self._get_cached_steps(behavior_name)
+
+    def _get_cached_steps(
+        self, behavior_name: str
+    ) -> tuple[DecisionSteps, TerminalSteps]:
+        if behavior_name not in self._steps:
+            raise UnityActionException(
+                f"The group {behavior_name} does not correspond to an existing "
+                "agent group in the environment"
+            )
+        return self._steps[behavior_name]
+
+    def _make_steps(self) -> None:
+        for behavior_name, agent_ids in self._agent_ids.items():
+            terminated = self._terminated[agent_ids]
+            obs, reward = self._observe(behavior_name, agent_ids[~terminated])
+            decision_steps = DecisionSteps(
+                obs, reward, agent_ids[~terminated], None, *self._groups(obs)
+            )
+            obs, reward = self._observe(behavior_name, agent_ids[terminated])
+            reward[:] = self._rng.random(len(reward)) < 0.5
+            terminal_steps = TerminalSteps(
+                obs,
+                reward,
+                np.zeros(len(reward), dtype=bool),
+                agent_ids[terminated],
+                *self._groups(obs),
+            )
+            self._steps[behavior_name] = (decision_steps, terminal_steps)
+
+    def _observe(
+        self, behavior_name: str, agent_ids: np.ndarray
+    ) -> tuple[list[np.ndarray], np.ndarray]:
+        layout = self._layouts[behavior_name]
+        frames = self._frames[behavior_name]
+        rows = agent_ids - self._agent_ids[behavior_name][0]
+
+        visual = frames[(self._step_count[agent_ids] + agent_ids) % len(frames)]
+        vector = self._states[behavior_name][rows]
+        vector[:, 1] = self._time
+        vector[:, 2] = self._traj_ids[agent_ids]
+        if layout.position_slice is not None:
+            vector[:, layout.position_slice] = self._positions[agent_ids]
+        reward = np.zeros(len(agent_ids), dtype=np.float32)
+        return [visual, vector], reward
+
+    @staticmethod
+    def _groups(obs: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        num_agents = len(obs[0])
+        return np.zeros(num_agents, dtype=np.int32), np.zeros(
+            num_agents, dtype=np.float32
+        )
@@ -37,6 +37,8 @@ def _unity_to_torchrl_spec_transform(spec, dtype=None, device="cpu"):
         if not len(shape):
             shape = torch.Size([1])
         dtype = numpy_to_torch_dtype_dict[dtype]
+        if dtype == torch.uint8:
+            return BoundedTensorSpec(0, 255, shape, device=device, dtype=dtype)
         return UnboundedContinuousTensorSpec(shape=shape, device=device, dtype=dtype)
     elif isinstance(spec, ActionSpec):
         if spec.continuous_size == spec.discrete_size == 0:
@@ -65,9 +67,35 @@ def _unity_to_torchrl_spec_transform(spec, dtype=None, device="cpu"):
         raise TypeError(f"Unknown spec of type {type(spec)} passed")
 
 
+def _float_pixels_to_uint8(pixels: torch.Tensor) -> torch.Tensor:
+    """Maps the [0, 1] float pixels sent by Unity back to uint8."""
+    return pixels.mul(255).round_().to(torch.uint8)
+
+
 class UnityWrapper(_EnvWrapper):
     """Unity environment wrapper.
 
+    Args:
+        env: The Unity environment to wrap.
+        batched_decode: Whether to decode the steps of each behavior with one
+            tensor conversion per array scattered by agent id, rather than
+            building one TensorDict per agent.
+        batched_actions: Whether to convert the actions of all agents to numpy
+            once and submit them with one ``set_actions`` call per behavior,
+            rather than one ``set_action_for_agent`` call per agent.
+        static_buffers: Whether to allocate the ``agents`` step output and the
+            zero templates of missing agents once, and decode every step into
+            them in place. Steps are decoded per behavior as with
+            ``batched_decode``. Every step returns a copy of the buffer, so
+            that collectors and rollouts can keep the outputs of a batch.
+        frame_skip: The number of Unity steps each action is repeated for.
+            Rewards are summed over the repeated steps and only the last
+            observation is returned. Repeating stops early once an agent
+            reaches a terminal step.
+        uint8_pixels: Whether to report visual (3D) observations as uint8 in
+            [0, 255] instead of float32 in [0, 1], so that frames take a
+            quarter of the memory in transforms and replay buffers.
+
     Examples:
         >>> env = UnityWrapper(
         ...     UnityEnvironment(
@@ -83,13 +111,43 @@ class UnityWrapper(_EnvWrapper):
     git_url = "https://github.com/Unity-Technologies/ml-agents"
     libname = "mlagents_envs"
 
-    def __init__(self, env=None, **kwargs):
+    def __init__(
+        self,
+        env=None,
+        batched_decode: bool = False,
+        batched_actions: bool = False,
+        static_buffers: bool = False,
+        uint8_pixels: bool = False,
+        **kwargs,
+    ):
         if env is not None:
             kwargs["env"] = env
+        self.batched_decode = batched_decode
+        self.batched_actions = batched_actions
+        self.static_buffers = static_buffers
+        self.uint8_pixels = uint8_pixels
+        if kwargs.get("frame_skip", 1) < 1:
+            raise ValueError("frame_skip must be a positive integer.")
         super().__init__(**kwargs)
 
     def _init_env(self):
-        pass
+        if self.static_buffers:
+            self._make_static_buffers()
+
+    def _make_static_buffers(self):
+        """Allocates the ``agents`` step output once the specs are known.
+
+        The per-agent views of the buffer and of its zero template are resolved
+        here, so that no spec lookup or ``zero()`` call happens while stepping.
+        """
+        agents_td = self.observation_spec["agents"].zero()
+        agents_td.set("reward", self.reward_spec.zero())
+        agents_td.set("done", self.done_spec["agents", "done"].zero())
+        agents_td.set("valid_mask", self.valid_mask_spec["agents", "valid_mask"].zero())
+        self._agents_buffer = agents_td
+        self._agents_buffer_no_reward = agents_td.exclude("reward")
+        self._agent_buffers = agents_td.unbind(0)
+        self._agent_zeros = agents_td.clone().unbind(0)
 
     def _compute_num_agents(self, env):
         num_agents = 0
@@ -116,6 +174,7 @@ class UnityWrapper(_EnvWrapper):
         self.num_agents = self._compute_num_agents(env)
         self._agent_ids = torch.tensor(range(self.num_agents), dtype=torch.int)
         self._agent_id_to_behavior_name = {}
+        self._behavior_name_to_agent_ids = {}
         return env
 
     def _make_specs(self, env: BaseEnv) -> None:
@@ -134,7 +193,7 @@ class UnityWrapper(_EnvWrapper):
                     observation_specs[agent_id] = CompositeSpec(
                         {
                             f"obs_{i}": _unity_to_torchrl_spec_transform(
-                                spec, dtype=np.dtype("float32"), device=self.device
+                                spec, dtype=self._obs_dtype(spec), device=self.device
                             )
                             for i, spec in enumerate(
                                 behavior_unity_spec.observation_specs
@@ -156,6 +215,16 @@ class UnityWrapper(_EnvWrapper):
                         n=2, shape=[1], dtype=torch.bool, device=self.device
                     )
 
+        for behavior_name in env.behavior_specs.keys():
+            self._behavior_name_to_agent_ids[behavior_name] = np.array(
+                sorted(
+                    agent_id
+                    for agent_id, name in self._agent_id_to_behavior_name.items()
+                    if name == behavior_name
+                ),
+                dtype=np.int64,
+            )
+
         self.unbatched_action_spec = CompositeSpec(
             {"agents": CompositeSpec({"action": torch.stack(action_specs, dim=0)})}
         )
@@ -205,6 +274,11 @@ class UnityWrapper(_EnvWrapper):
 
         self.state_spec = self.observation_spec.clone()
 
+    def _obs_dtype(self, spec: ObservationSpec) -> np.dtype:
+        if self.uint8_pixels and len(spec.shape) == 3:
+            return np.dtype("uint8")
+        return np.dtype("float32")
+
     def __repr__(self) -> str:
         return (
             f"{self.__class__.__name__}(env={self._env}, batch_size={self.batch_size})"
@@ -216,19 +290,17 @@ class UnityWrapper(_EnvWrapper):
         env = kwargs["env"]
         if not isinstance(env, BaseEnv):
             raise TypeError("env is not of type 'mlagents_envs.base_env.BaseEnv'.")
-        if "frame_skip" in kwargs and kwargs["frame_skip"] != 1:
-            # FIXME: Add support for this.
-            raise ValueError(
-                "Currently, frame_skip is not supported for Unity environments."
-            )
 
     def agent_id_to_behavior_name(self, agent_id: int):
         return self._agent_id_to_behavior_name[agent_id]
 
     def read_obs(self, agent_id, obs):
-        return self.observation_spec["agents", "observation"][agent_id].encode(
-            {f"obs_{i}": observation for i, observation in enumerate(obs)},
-        )
+        obs_spec = self.observation_spec["agents", "observation"][agent_id]
+        obs = {f"obs_{i}": observation for i, observation in enumerate(obs)}
+        for key, observation in obs.items():
+            if obs_spec[key].dtype == torch.uint8:
+                obs[key] = _float_pixels_to_uint8(torch.from_numpy(observation))
+        return obs_spec.encode(obs)
 
     def read_reward(self, agent_id, reward):
         return self.reward_spec[agent_id].encode(reward)
@@ -247,7 +319,9 @@ class UnityWrapper(_EnvWrapper):
             }
         else:
             action = np.reshape(action, (1, np.prod(action.shape)))
+        return self._to_action_tuple(action)
 
+    def _to_action_tuple(self, action):
         if isinstance(self.action_spec, CompositeSpec):
             action = ActionTuple(action["continuous"], action["discrete"])
         elif isinstance(self.action_spec, DiscreteTensorSpec | MultiDiscreteTensorSpec):
@@ -262,6 +336,11 @@ class UnityWrapper(_EnvWrapper):
 
     def _get_next_tensordict(self, shape, is_reset=False):
         # print("Collector process: ", os.getpid())
+        if self.static_buffers:
+            return self._get_next_tensordict_static(is_reset=is_reset)
+        if self.batched_decode:
+            return self._get_next_tensordict_batched(is_reset=is_reset)
+
         agent_tds = [None] * self.num_agents
         seen_agent_ids = set()
 
@@ -319,21 +398,139 @@ class UnityWrapper(_EnvWrapper):
         # print(tensordict_out["agents", "done"])
         return tensordict_out
 
-    def _step(self, tensordict: TensorDictBase) -> TensorDictBase:
-        # print(tensordict)
-        # print('step')
+    def _get_next_tensordict_batched(self, is_reset=False):
+        """Decodes the steps of every behavior at once into new tensors."""
+        agents_td = self.observation_spec["agents"].zero()
+        if not is_reset:
+            agents_td.set("reward", self.reward_spec.zero())
+        agents_td.set("done", self.done_spec["agents", "done"].zero())
+        agents_td.set("valid_mask", self.valid_mask_spec["agents", "valid_mask"].zero())
+        self._scatter_steps(agents_td, is_reset=is_reset)
+        return TensorDict(source={"agents": agents_td}, batch_size=[])
+
+    def _get_next_tensordict_static(self, is_reset=False):
+        """Decodes the steps of every behavior into the preallocated buffer.
+
+        Agents without a step are reset from their cached zero template. The
+        buffer is copied on the way out because collectors and ``rollout`` keep
+        a reference to the output of every step until the batch is stacked.
+        """
+        valid_mask = self._agents_buffer.get("valid_mask")
+        valid_mask.fill_(False)
+        self._scatter_steps(self._agents_buffer, is_reset=is_reset)
+        if not valid_mask.all():
+            for agent_id in torch.nonzero(~valid_mask.view(-1)).view(-1).tolist():
+                self._agent_buffers[agent_id].update_(self._agent_zeros[agent_id])
+
+        if is_reset:
+            agents_td = self._agents_buffer_no_reward.clone()
+        else:
+            agents_td = self._agents_buffer.clone()
+        return TensorDict(source={"agents": agents_td}, batch_size=[])
+
+    def _scatter_steps(self, agents_td, is_reset=False):
+        """Writes the steps of every behavior into ``agents_td`` by agent id.
+
+        Each array of the ``DecisionSteps``/``TerminalSteps`` is converted with a
+        single ``torch.from_numpy`` and scattered into the output by agent id.
+        Terminal steps are written after decision steps, so an agent present in
+        both is reported as done, like in the per-agent path.
+        """
+        obs_td = agents_td.get("observation")
+        reward = None if is_reset else agents_td.get("reward")
+        done = agents_td.get("done")
+        valid_mask = agents_td.get("valid_mask")
+
+        # Unity calls go to ``self._env`` directly, attributes forwarded by the
+        # wrapper are looked up through ``dir`` on every access.
+        for behavior_name_ in self._env.behavior_specs.keys():
+            decision_steps, terminal_steps = self._env.get_steps(behavior_name_)
+            for i, steps in enumerate([decision_steps, terminal_steps]):
+                if not len(steps):
+                    continue
+                agent_ids = torch.from_numpy(steps.agent_id).long().to(self.device)
+                for j, observation in enumerate(steps.obs):
+                    out = obs_td.get(f"obs_{j}")
+                    observation = torch.from_numpy(observation)
+                    if out.dtype == torch.uint8:
+                        observation = _float_pixels_to_uint8(observation)
+                    out.index_copy_(
+                        0,
+                        agent_ids,
+                        observation.reshape(len(steps), *out.shape[1:]).to(
+                            self.device, out.dtype
+                        ),
+                    )
+                if reward is not None:
+                    reward.index_copy_(
+                        0,
+                        agent_ids,
+                        torch.from_numpy(steps.reward)
+                        .reshape(len(steps), *reward.shape[1:])
+                        .to(self.device, reward.dtype),
+                    )
+                done[agent_ids] = i == 1
+                valid_mask[agent_ids] = True
+
+    def _set_actions_batched(self, actions, eligible_agent_mask):
+        """Submits the actions of the eligible agents with one call per behavior.
+
+        The whole action tensor is converted to numpy once. ``set_actions``
+        expects the actions in the order of the ``DecisionSteps`` agent ids, so
+        the rows are gathered with those ids. If the agents requesting a decision
+        are not exactly the eligible agents of a behavior, that behavior falls
+        back to per-agent submission.
+        """
+        actions = self.action_spec.to_numpy(actions, safe=False)
+        if isinstance(actions, dict):
+            actions = {
+                k: np.reshape(v, (self.num_agents, -1)) for k, v in actions.items()
+            }
+        else:
+            actions = np.reshape(actions, (self.num_agents, -1))
+        eligible_agent_mask = eligible_agent_mask.numpy().reshape(self.num_agents)
+
+        for behavior_name, agent_ids in self._behavior_name_to_agent_ids.items():
+            eligible_agent_ids = agent_ids[eligible_agent_mask[agent_ids]]
+            decision_steps, _ = self._env.get_steps(behavior_name)
+            decision_agent_ids = decision_steps.agent_id.astype(np.int64)
+            if np.array_equal(np.sort(decision_agent_ids), eligible_agent_ids):
+                if len(decision_agent_ids):
+                    self._env.set_actions(
+                        behavior_name,
+                        self._select_actions(actions, decision_agent_ids),
+                    )
+            else:
+                for agent_id in eligible_agent_ids:
+                    self._env.set_action_for_agent(
+                        behavior_name,
+                        int(agent_id),
+                        self._select_actions(actions, [agent_id]),
+                    )
+
+    def _select_actions(self, actions, agent_ids):
+        if isinstance(actions, dict):
+            actions = {k: v[agent_ids] for k, v in actions.items()}
+        else:
+            actions = actions[agent_ids]
+        return self._to_action_tuple(actions)
+
+    def _eligible_agent_mask(self, tensordict):
         # FIXME: Figure out why tensordict["agents",
         # "valid_mask"] and tensordict["agents", "done"]
         # have different shapes which require us to squeeze.
-        eligible_agent_mask = torch.logical_and(
+        return torch.logical_and(
             torch.squeeze(tensordict["agents", "valid_mask"]),
             torch.logical_not(torch.squeeze(tensordict["agents", "done"])),
         ).cpu()
+
+    def _set_actions(self, actions, eligible_agent_mask):
+        if self.batched_actions:
+            self._set_actions_batched(actions, eligible_agent_mask)
+            return
+
         agent_ids = self._agent_ids[eligible_agent_mask]
-        try:
-            actions = tensordict["agents", "action"].unsqueeze(-1)[eligible_agent_mask]
-        except:
-            actions = tensordict["action"].unsqueeze(-1)[eligible_agent_mask]
+        actions = actions.unsqueeze(-1)[eligible_agent_mask]
         for action, agent_id in zip(actions, agent_ids):
             unity_action = self.read_action(action)
             # print(action)
@@ -343,9 +540,35 @@ class UnityWrapper(_EnvWrapper):
                 agent_id.item(),
                 unity_action,
             )
+
+    def _step(self, tensordict: TensorDictBase) -> TensorDictBase:
+        # print(tensordict)
+        # print('step')
+        eligible_agent_mask = self._eligible_agent_mask(tensordict)
+        try:
+            actions = tensordict["agents", "action"]
+        except:
+            actions = tensordict["action"]
+        self._set_actions(actions, eligible_agent_mask)
         self._env.step()
         tensordict_out = self._get_next_tensordict(shape=tensordict.shape)
 
+        if self.frame_skip > 1:
+            reward = tensordict_out.get(("agents", "reward")).clone()
+            done = tensordict_out.get(("agents", "done")).clone()
+            for _ in range(self.frame_skip - 1):
+                if done.any():
+                    break
+                # Agents that are not waiting for a decision keep no action.
+                eligible_agent_mask = self._eligible_agent_mask(tensordict_out)
+                self._set_actions(actions, eligible_agent_mask)
+                self._env.step()
+                tensordict_out = self._get_next_tensordict(shape=tensordict.shape)
+                reward += tensordict_out.get(("agents", "reward"))
+                done |= tensordict_out.get(("agents", "done"))
+            tensordict_out.set(("agents", "reward"), reward)
+            tensordict_out.set(("agents", "done"), done)
+
         # out = tensordict_out.set("next", tensordict_outself._get_next_tensordict())
         # print(out)
         return tensordict_out  # .select().set("next", tensordict_out)
@@ -31,6 +31,18 @@ class Config:
     """Batch size to use for training."""
     buffer_size: int = 15_000
     """Size of the replay buffer."""
+    dedup_frames: bool = False
+    """Whether to store each frame once and rebuild frame stacks at sample time"""
+    buffer_storage: str = "memmap"
+    """Where to keep the replay buffer, either "memmap" or "device" """
+    buffer_memory_budget: float = 4.0
+    """GB the device storage may use before falling back to memmap"""
+    prefetch_batches: int = 0
+    """Number of batches to sample ahead on a background thread, 0 to disable"""
+    pin_memory: bool = False
+    """Whether to stage prefetched batches in pinned memory"""
+    batches_per_sample: int = 1
+    """Number of batches gathered from the replay buffer at once"""
     num_envs: int = 1
     """Number of parallel environments to use."""
     seed: int = 42
@@ -41,6 +53,8 @@ class Config:
     """Whether to use trajectory feedback"""
     use_expert: bool = False
     """Whether to use expert data"""
+    expert_ratio: float = 0.5
+    """Fraction of each batch sampled from the expert data"""
     heuristic_feedback: bool = False
     """Whether to use heuristic feedback"""
     hf: bool = False
@@ -73,7 +87,7 @@ def sac(cfg: Config):
     import os
     import random
     import uuid
-    from collections import defaultdict, deque
+    from collections import deque
 
     import numpy as np
     import torch
@@ -84,6 +98,7 @@ def sac(cfg: Config):
         audio_feedback,
         combine_feedback_and_rewards,
         feedback_model_train_step,
+        freeze_encoder,
         get_time,
         gradient_weighted_average_transform,
         heuristic_feedback,
@@ -92,14 +107,24 @@ def sac(cfg: Config):
         make_agent,
         make_data_buffer,
         make_env,
+        make_loss_context,
         make_loss_module,
         make_optimizer,
+        make_prefetching_sampler,
         override_il_feedback,
         provide_learned_feedback,
         save_training,
+        uses_latent_replay,
         visualize,
     )
+    from crew_algorithms.utils.episode_stats import EpisodeStatsTracker
+    from crew_algorithms.utils.feedback import (
+        HEURISTIC_FEEDBACK_KEY,
+        FeedbackProviders,
+        not_computed,
+    )
     from crew_algorithms.utils.rl_utils import make_collector
+    from crew_algorithms.utils.updater import LossUpdater
     from sortedcontainers import SortedList
     from torchrl.record.loggers import get_logger
 
@@ -156,7 +181,7 @@ def sac(cfg: Config):
     loss_module, target_net_updater = make_loss_module(cfg, env, model)
     env.close()
 
-    prb, prb_e = make_data_buffer(cfg, run_name)
+    prb, prb_e = make_data_buffer(cfg, run_name, device)
     collected_frames = 0
     episode_success = []
     global_start_time = time()
@@ -166,25 +191,54 @@ def sac(cfg: Config):
         start_time=global_start_time,
     )
 
+    prb = make_prefetching_sampler(cfg, prb, prb_e, device)
     collector = make_collector(cfg.collector, env_fn, actor, device, cfg.num_envs)
     collector.set_seed(cfg.seed)
 
     """A short buffer later used for handling human feedback delay"""
     human_delay_buffer_td = None
 
-    """Dictionary to store episode rewards"""
-    episode_reward, episode_reward_hf = defaultdict(float), defaultdict(float)
+    """Per-episode rewards and their statistics over the last episodes"""
+    episode_stats = EpisodeStatsTracker(cfg.log_smoothing)
     """List to store human feedback and heuristic feedback values"""
     all_hf, all_heu = [], []
 
-    num_success, num_trajs, last_traj = 0, 0, 0
-    loss = None
-
-    """Heuristic feedback provider"""
-    heuristic = heuristic_feedback(
-        cfg.envs.target_img, 0.95, cfg.collector.frames_per_batch, device
-    )
+    num_success, num_trajs = 0, 0
+
+    """Fields split from obs_1"""
+    obs_1_field_keys = [
+        (*prefix, "agents", "observation", name)
+        for prefix in ((), ("next",))
+        for name in cfg.envs.obs_1_layout
+    ]
+
+    """Feedback providers, only computed for the batches that consume them"""
+    feedback_providers = FeedbackProviders()
+    if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
+        heuristic = heuristic_feedback(cfg.envs.target_img, 0.95, device)
+        feedback_providers.register(
+            HEURISTIC_FEEDBACK_KEY,
+            heuristic.provide_feedback,
+            default=not_computed(("next", "agents", "reward")),
+        )
     optimizer = make_optimizer(cfg, loss_module)
+    updater = LossUpdater(
+        loss_module,
+        optimizer,
+        target_net_updater,
+        model.parameters(),
+        cfg.optimization.max_grad_norm,
+        loss_keys=("loss_actor", "loss_qvalue", "loss_alpha"),
+        metric_keys={
+            "actor_loss": "loss_actor",
+            "q_loss": "loss_qvalue",
+            "alpha_loss": "loss_alpha",
+            "alpha": "alpha",
+            "entropy": "entropy",
+        },
+        mode=cfg.optimization.updater,
+        loss_context=make_loss_context(cfg, prb),
+    )
 
     deploy_learned_feedback = False
 
@@ -223,16 +277,12 @@ def sac(cfg: Config):
         current_frames = data.numel()
         collected_frames += current_frames
 
-        if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
-            data.set(
-                ("next", "agents", "heuristic_feedback"),
-                heuristic.provide_feedback(data),
-            )
+        feedback_providers.bind(data)
 
         if cfg.heuristic_feedback:
             data.set(
                 ("next", "agents", "feedback"),
-                data[("next", "agents", "heuristic_feedback")],
+                feedback_providers.get(HEURISTIC_FEEDBACK_KEY),
             )
         else:
             data.set(
@@ -240,65 +290,45 @@ def sac(cfg: Config):
                 torch.zeros_like(data[("next", "agents", "reward")]).to(device),
             )
 
-        for j in range(len(data)):
-            time_stamp = data[("next", "agents", "observation", "obs_1")][
-                j, ..., -1, 1
-            ].item()
-            traj_j = data["agents", "observation", "obs_1"][j, ..., -1, 2].int().item()
-            episode_reward[traj_j] += data["next", "agents", "reward"][j].item()
+        time_stamp = data["next", "agents", "observation", "time"][-1].item()
+        for stats in episode_stats.update(
+            data["agents", "observation", "traj_id"],
+            data["next", "agents", "reward"],
+            data["agents", "observation", "feedback"] if cfg.hf else None,
+        ):
+            logger.log_scalar(
+                "avg_episode_reward", stats.avg_reward, step=collected_frames
+            )
+            local_logger.log(
+                x_axis="steps",
+                y_axis="avg_episode_reward",
+                x_value=collected_frames,
+                y_value=stats.avg_reward,
+                log_time=True,
+            )
 
             if cfg.hf:
-                episode_reward_hf[traj_j] += data["agents", "observation", "obs_1"][
-                    j, ..., -1, 0
-                ].item()
-
-            if traj_j > last_traj:
-                r_list = [episode_reward[ep] for ep in episode_reward]
-                avg_ep_r = np.array(
-                    r_list[max(0, len(r_list) - cfg.log_smoothing - 1) : -1]
-                ).mean()
-                logger.log_scalar("avg_episode_reward", avg_ep_r, step=collected_frames)
-                local_logger.log(
-                    x_axis="steps",
-                    y_axis="avg_episode_reward",
-                    x_value=collected_frames,
-                    y_value=avg_ep_r,
-                    log_time=True,
+                logger.log_scalar(
+                    "avg_episode_reward_hf", stats.avg_feedback, step=collected_frames
                 )
-
-                if cfg.hf:
-                    r_list_hf = [episode_reward_hf[ep] for ep in episode_reward_hf]
-                    avg_ep_r_hf = np.array(
-                        r_list_hf[max(0, len(r_list_hf) - cfg.log_smoothing - 1) : -1]
-                    ).mean()
-                    logger.log_scalar(
-                        "avg_episode_reward_hf", avg_ep_r_hf, step=collected_frames
-                    )
-                    local_logger.log(
-                        x_axis="steps",
-                        y_axis="avg_episode_reward_hf",
-                        x_value=collected_frames,
-                        y_value=avg_ep_r_hf,
-                        log_time=True,
-                    )
-
-                sr_list = [1 if episode_reward[ep] > 0 else 0 for ep in episode_reward]
-                avg_sr = np.array(
-                    sr_list[max(0, len(sr_list) - cfg.log_smoothing - 1) : -1]
-                ).mean()
-                logger.log_scalar("success_rate", avg_sr, step=collected_frames)
                 local_logger.log(
                     x_axis="steps",
-                    y_axis="success_rate",
+                    y_axis="avg_episode_reward_hf",
                     x_value=collected_frames,
-                    y_value=avg_sr,
+                    y_value=stats.avg_feedback,
                     log_time=True,
                 )
-                last_traj = traj_j
 
-        local_logger.data["all_rewards"] = {
-            k: round(v, 4) for k, v in episode_reward.items()
-        }
+            logger.log_scalar("success_rate", stats.success_rate, step=collected_frames)
+            local_logger.log(
+                x_axis="steps",
+                y_axis="success_rate",
+                x_value=collected_frames,
+                y_value=stats.success_rate,
+                log_time=True,
+            )
+
+        local_logger.data["all_rewards"] = episode_stats.all_rewards
         data.set(
             ("next", "agents", "reward"),
             data[("next", "agents", "reward")] * cfg.envs.scale_reward
@@ -307,29 +337,27 @@ def sac(cfg: Config):
 
         data["time_stamp"] = torch.tensor([round(time_stamp, 4)] * data.numel())
 
-        data["agents", "observation", "obs_1"][
-            data["agents", "observation", "obs_1"] == -9
-        ] = 0
-        data["next", "agents", "observation", "obs_1"][
-            data["next", "agents", "observation", "obs_1"] == -9
-        ] = 0
+        for key in obs_1_field_keys:
+            value = data.get(key)
+            value[value == -9] = 0
+
+        if cfg.hf and HEURISTIC_FEEDBACK_KEY in feedback_providers:
+            hf_values = data["agents", "observation", "feedback"]
+            all_hf.extend(hf_values.squeeze(1).squeeze(1).tolist())
+            all_heu.extend(
+                feedback_providers.get(HEURISTIC_FEEDBACK_KEY)
+                .squeeze(1)
+                .squeeze(1)
+                .tolist()
+            )
+        feedback_providers.fill()
 
         if cfg.hf:
-            if cfg.envs.name in ["find_treasure", "hide_and_seek_1v1"]:
-                hf_values = data["agents", "observation", "obs_1"][..., -1, 0]
-                all_hf.extend(hf_values.squeeze(1).tolist())
-                all_heu.extend(
-                    data[("next", "agents", "heuristic_feedback")]
-                    .squeeze(1)
-                    .squeeze(1)
-                    .tolist()
-                )
-
             if human_delay_buffer_td is not None:
                 data = torch.cat([human_delay_buffer_td, data], dim=0)
 
             human_delay_td, human_delay_buffer_td = human_delay_transform(
-                data, ("agents", "observation", "obs_1"), cfg.envs.human_delay_steps
+                data, ("agents", "observation", "feedback"), cfg.envs.human_delay_steps
             )
 
             # grad_average_td = gradient_weighted_average_transform(
@@ -339,16 +367,14 @@ def sac(cfg: Config):
             il_feedback_td = grad_average_td
             il_feedback_td = override_il_feedback(
                 grad_average_td,
-                ("agents", "observation", "obs_1"),
-                ("agents", "observation", "obs_1"),
+                ("agents", "observation", "il_enabled"),
+                ("agents", "observation", "feedback"),
                 1,
             )
 
             il_feedback_td.set(
                 ("next", "agents", "feedback"),
-                il_feedback_td.get(("agents", "observation", "obs_1"))[
-                    ..., -1, 0
-                ].unsqueeze(dim=-1),
+                il_feedback_td.get(("agents", "observation", "feedback")),
             )  # write human feedback to feedback field
         else:
             il_feedback_td = data
@@ -368,7 +394,7 @@ def sac(cfg: Config):
             prb.extend(combined_rewards.cpu())
 
         total_collected_epochs = (
-            data[("agents", "observation", "obs_1")][..., -1, 2].int().max().item()
+            data["agents", "observation", "traj_id"].int().max().item()
         )
 
         print(
@@ -379,83 +405,40 @@ def sac(cfg: Config):
 
         t1, t2 = [], []
         if collected_frames >= cfg.collector.init_random_frames:
-            (
-                total_losses,
-                actor_losses,
-                q_losses,
-                alpha_losses,
-                alphas,
-                entropies,
-            ) = ([], [], [], [], [], [])
-
             for _ in range(
                 int(cfg.collector.frames_per_batch * (cfg.optimization.utd_ratio))
             ):
                 tic = time()
 
-                if cfg.audio_feedback:
-                    stream.get_sample()
-
-                if cfg.use_expert:
-                    sampled_expert = (
-                        prb_e.sample(batch_size=cfg.batch_size // 2).clone().to(device)
-                    )
-                    sampled_new = (
-                        prb.sample(batch_size=cfg.batch_size // 2).clone().to(device)
-                    )
-                    sampled_tensordict = torch.cat([sampled_expert, sampled_new], dim=0)
-                else:
-                    sampled_tensordict = prb.sample().clone().to(device)
-
-                loss_td = loss_module(sampled_tensordict)
-
-                actor_loss = loss_td["loss_actor"]
-                q_loss = loss_td["loss_qvalue"]
-                alpha_loss = loss_td["loss_alpha"]
-
-                optimizer.zero_grad()
-                loss = actor_loss + q_loss + alpha_loss
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    model.parameters(), cfg.optimization.max_grad_norm
-                )
-                optimizer.step()
+                # Expert transitions are mixed into the batch by the sampler.
+                sampled_tensordict = prb.sample()
 
-                target_net_updater.step()
+                updater.step(sampled_tensordict)
                 t1.append(time() - tic)
                 if (_ + 1) % 1 == 0:
-                    if cfg.use_expert:
-                        sampled_expert = sampled_tensordict[:cfg.batch_size//2]
-                        sampled_new = sampled_tensordict[cfg.batch_size//2:]
-                        prb_e.update_tensordict_priority(sampled_expert)
-                        prb.update_tensordict_priority(sampled_new)
-                    else:
-                        prb.update_tensordict_priority(sampled_tensordict)
+                    prb.update_tensordict_priority(sampled_tensordict)
                 t2.append(time() - tic)
 
-                total_losses.append(loss.item())
-                actor_losses.append(actor_loss.item())
-                q_losses.append(q_loss.item())
-                alpha_losses.append(alpha_loss.item())
-                alphas.append(loss_td["alpha"].item())
-                entropies.append(loss_td["entropy"].item())
+        if (
+            uses_latent_replay(cfg)
+            and not prb.active
+            and updater.num_updates >= cfg.optimization.freeze_encoder_after
+        ):
+            print("Freezing the encoder after %d updates" % updater.num_updates)
+            encoder = freeze_encoder(model, loss_module)
+            # Prefetched batches were sampled without embeddings.
+            for buffer in (prb, prb_e):
+                if buffer is not None:
+                    buffer.close()
+                    buffer.activate(encoder)
 
         metrics = {
             "collected_frames": collected_frames,
             "collected_traj": num_trajs,
             "time": time_stamp,
         }
-        if loss is not None:
-            metrics.update(
-                {
-                    "total_loss": np.mean(total_losses),
-                    "actor_loss": np.mean(actor_losses),
-                    "q_loss": np.mean(q_losses),
-                    "alpha_loss": np.mean(alpha_losses),
-                    "alpha": np.mean(alphas),
-                    "entropy": np.mean(entropies),
-                }
-            )
+        # Loss metrics are read back from the device once per collector batch.
+        metrics.update(updater.metrics())
 
         for key, value in metrics.items():
             logger.log_scalar(key, value, step=collected_frames)
@@ -487,6 +470,7 @@ def sac(cfg: Config):
                     i + 1,
                     cfg.collector.frames_per_batch,
                 )
+            prb.close()
             collector.shutdown()
             return 0
 
@@ -8,8 +8,13 @@ class OptimizationConfig:
     lr: float = 1e-4
     weight_decay: float = 0.0
     target_update_polyak: float = 0.995
+    target_update: str = "soft"
+    target_update_interval: int = 1
     target_entropy_weight: float = 0.2
     max_grad_norm: float = 1.0
+    updater: str = "eager"
+    reuse_encoder_features: bool = False
+    freeze_encoder_after: int = 0
     alpha_init: float = 0.1
     target_entropy: float = -6.0
 
@@ -51,7 +51,7 @@ class ContinuousActorNet(nn.Module):
         if self.num_channels is not None:
             obs = obs.view(
                 obs.shape[0], -1, self.num_channels, obs.shape[-2], obs.shape[-1]
-            ).view(-1, self.num_channels, obs.shape[-2], obs.shape[-1])
+            )
 
         obs = self.encoder(obs).flatten(1).view(bs, -1)
 
@@ -105,7 +105,7 @@ class ContinuousQValueNet(nn.Module):
         if self.num_channels is not None:
             obs = obs.view(
                 obs.shape[0], -1, self.num_channels, obs.shape[-2], obs.shape[-1]
-            ).view(-1, self.num_channels, obs.shape[-2], obs.shape[-1])
+            )
 
         obs = self.encoder(obs).flatten(1).view(bs, -1)
         while len(action.shape) > 2:
@@ -160,7 +160,7 @@ class FeedbackNet(nn.Module):
             obs = obs.squeeze(1)
         obs = obs.view(
             obs.shape[0], -1, self.num_channels, obs.shape[-2], obs.shape[-1]
-        ).view(-1, 3, obs.shape[-2], obs.shape[-1])
+        )
 
         obs = self.encoder(obs).flatten(1).view(bs, -1)
         action = action.view(bs, -1)
@@ -0,0 +1,214 @@
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+
+AudioCallback = Callable[[np.ndarray, float], None]
+
+
+class AudioRingBuffer:
+    """Keeps the most recent audio frames in a preallocated int16 buffer.
+
+    Every write is stored twice, `capacity` frames apart, so that the last
+    `capacity` frames always form a contiguous slice of the buffer and can be
+    read as a view without copying. The capture time of every written chunk
+    is kept alongside, to timestamp the frames.
+
+    Writes come from a single capture thread. A view returned by a read
+    aliases the buffer, it stays valid until its frames are overwritten,
+    `capacity` frames later, and should be copied to be kept longer.
+
+    Args:
+        capacity: The number of frames kept.
+        channels: The number of channels of every frame.
+        rate: The sampling rate, in frames per second.
+        max_chunks: The number of chunk timestamps kept.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        channels: int = 1,
+        rate: int = 44100,
+        max_chunks: int = 4096,
+    ):
+        self.capacity = capacity
+        self.channels = channels
+        self.rate = rate
+        self._data = np.zeros((2 * capacity, channels), dtype=np.int16)
+        self._chunk_ends = np.zeros(max_chunks, dtype=np.int64)
+        self._chunk_times = np.zeros(max_chunks, dtype=np.float64)
+        self._num_chunks = 0
+        self._frames_written = 0
+
+    @property
+    def frames_written(self) -> int:
+        """The number of frames written since the buffer was created."""
+        return self._frames_written
+
+    def write(self, frames: np.ndarray, timestamp: float) -> None:
+        """Appends a chunk of frames.
+
+        Args:
+            frames: The int16 frames, of shape (num_frames, channels) or
+                (num_frames * channels,) when interleaved.
+            timestamp: The time at which the last frame was captured.
+        """
+        frames = frames.reshape(-1, self.channels)
+        end = self._frames_written + len(frames)
+        # Only the last `capacity` frames of a longer chunk are kept.
+        frames = frames[-self.capacity :]
+        start = (end - len(frames)) % self.capacity
+        for offset in (start, start + self.capacity):
+            head = min(len(frames), 2 * self.capacity - offset)
+            self._data[offset : offset + head] = frames[:head]
+            self._data[: len(frames) - head] = frames[head:]
+        chunk = self._num_chunks % len(self._chunk_ends)
+        self._chunk_ends[chunk] = end
+        self._chunk_times[chunk] = timestamp
+        self._num_chunks += 1
+        # Published last, readers never see frames that are not written yet.
+        self._frames_written = end
+
+    def frames(self, start: int, end: int | None = None) -> np.ndarray:
+        """Returns a view of the frames within a range.
+
+        Args:
+            start: The index of the first frame, counted from the first frame
+                ever written. Frames that were overwritten are skipped.
+            end: The index after the last frame, defaults to the frames
+                written so far.
+
+        Returns:
+            The frames, of shape (num_frames, channels).
+        """
+        end = self._frames_written if end is None else end
+        start = max(start, end - self.capacity, 0)
+        stop = end % self.capacity + self.capacity
+        return self._data[stop - max(end - start, 0) : stop]
+
+    def latest(self, num_frames: int) -> np.ndarray:
+        """Returns a view of the most recent frames, see `frames`."""
+        end = self._frames_written
+        return self.frames(end - num_frames, end)
+
+    def frame_times(self, frames: np.ndarray) -> np.ndarray:
+        """Returns the capture time of frames.
+
+        The time of a frame is the time of its chunk, minus the duration of
+        the frames after it in the chunk. Frames older than the kept chunk
+        timestamps are extrapolated from the oldest one.
+
+        Args:
+            frames: The indices of the frames, counted from the first frame
+                ever written.
+
+        Returns:
+            The capture times of the frames.
+        """
+        size = len(self._chunk_ends)
+        num_chunks = min(self._num_chunks, size)
+        if num_chunks == 0:
+            raise RuntimeError("No audio was captured yet.")
+        oldest = self._num_chunks % size if self._num_chunks >= size else 0
+        ends = np.roll(self._chunk_ends[:num_chunks], -oldest)
+        times = np.roll(self._chunk_times[:num_chunks], -oldest)
+        chunks = np.searchsorted(ends, frames, side="right").clip(max=num_chunks - 1)
+        return times[chunks] - (ends[chunks] - 1 - np.asarray(frames)) / self.rate
+
+
+class MicrophoneSource:
+    """Captures audio from the default microphone with PyAudio.
+
+    PortAudio calls the callback from its own thread with every captured
+    buffer, so that capturing never blocks the caller.
+
+    Args:
+        channels: Number of channels to record
+        rate: Sampling rate
+        frames_per_buffer: Number of frames per buffer
+    """
+
+    def __init__(self, channels=1, rate=44100, frames_per_buffer=1024):
+        self.channels = channels
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+
+    def start(self, callback: AudioCallback) -> None:
+        # Imported here, so that the other sources work without PortAudio.
+        import pyaudio
+
+        def stream_callback(in_data, frame_count, time_info, status):
+            callback(np.frombuffer(in_data, dtype=np.int16), time.time())
+            return None, pyaudio.paContinue
+
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(
+            format=pyaudio.paInt16,
+            channels=self.channels,
+            rate=self.rate,
+            input=True,
+            frames_per_buffer=self.frames_per_buffer,
+            stream_callback=stream_callback,
+        )
+
+    def stop(self) -> None:
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+
+
+class FakeAudioSource:
+    """Plays samples in a loop at the sampling rate, in place of a microphone.
+
+    A thread calls the callback with every buffer of the samples at the pace
+    a microphone would, so that the capture can be run without one.
+
+    Args:
+        samples: The int16 samples to play, of shape (num_frames, channels).
+            Defaults to a 440 Hz tone.
+        channels: Number of channels to record
+        rate: Sampling rate
+        frames_per_buffer: Number of frames per buffer
+    """
+
+    def __init__(
+        self,
+        samples: np.ndarray | None = None,
+        channels=1,
+        rate=44100,
+        frames_per_buffer=1024,
+    ):
+        if samples is None:
+            tone = np.sin(2 * np.pi * 440 * np.arange(rate) / rate) * 0.1 * 32767
+            samples = np.repeat(tone.astype(np.int16)[:, None], channels, axis=1)
+        self.samples = samples.reshape(-1, channels)
+        self.channels = channels
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, callback: AudioCallback) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._play, args=(callback,), daemon=True
+        )
+        self._thread.start()
+
+    def _play(self, callback: AudioCallback) -> None:
+        position = 0
+        deadline = time.time()
+        while not self._stop.is_set():
+            index = np.arange(position, position + self.frames_per_buffer)
+            position += self.frames_per_buffer
+            deadline += self.frames_per_buffer / self.rate
+            if self._stop.wait(max(deadline - time.time(), 0)):
+                break
+            callback(self.samples[index % len(self.samples)], time.time())
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
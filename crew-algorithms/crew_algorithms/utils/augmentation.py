@@ -0,0 +1,195 @@
+import math
+from typing import Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+AUGMENTATION_MODES = ("affine", "crop")
+
+
+def affine_transform(
+    frames: torch.Tensor,
+    angles: torch.Tensor,
+    translations: torch.Tensor,
+    interpolation: str = "bilinear",
+) -> torch.Tensor:
+    """Rotates and translates every sample of a batch with a single grid sample.
+
+    Follows the conventions of the torchvision functional transforms: a
+    positive angle rotates counter-clockwise around the center of the frame,
+    a positive translation moves the content right and down, and pixels
+    outside of the frame are filled with zeros.
+
+    Args:
+        frames: The frames, of shape (batch, channels, height, width).
+        angles: The rotation of every sample in degrees, of shape (batch,).
+        translations: The (x, y) translation of every sample in pixels, of
+            shape (batch, 2).
+        interpolation: "bilinear" or "nearest".
+
+    Returns:
+        The transformed frames.
+    """
+    dtype = frames.dtype if frames.is_floating_point() else torch.float32
+    height, width = frames.shape[-2:]
+    rotation = torch.deg2rad(-angles.to(frames.device, dtype))
+    cos, sin = torch.cos(rotation), torch.sin(rotation)
+    tx, ty = translations.to(frames.device, dtype).unbind(-1)
+    # The inverse affine matrix of torchvision in pixels, rescaled to the
+    # normalized coordinates of `affine_grid`.
+    theta = torch.stack(
+        [
+            torch.stack(
+                [cos, sin * height / width, -(cos * tx + sin * ty) * 2 / width], -1
+            ),
+            torch.stack(
+                [-sin * width / height, cos, (sin * tx - cos * ty) * 2 / height], -1
+            ),
+        ],
+        -2,
+    )
+    grid = F.affine_grid(theta, frames.shape, align_corners=False)
+    out = F.grid_sample(
+        frames.to(dtype),
+        grid,
+        mode=interpolation,
+        padding_mode="zeros",
+        align_corners=False,
+    )
+    return out if frames.is_floating_point() else out.round().to(frames.dtype)
+
+
+def shift_crop(frames: torch.Tensor, shifts: torch.Tensor, pad: int) -> torch.Tensor:
+    """Shifts every sample of a batch by whole pixels with a single gather.
+
+    The frames are padded by repeating their border, then each sample is
+    cropped back to its original size at its own offset, as in DrQ.
+
+    Args:
+        frames: The frames, of shape (batch, channels, height, width).
+        shifts: The integer (x, y) shift of every sample, in [-pad, pad], of
+            shape (batch, 2).
+        pad: The number of pixels padded on each side.
+
+    Returns:
+        The shifted frames.
+    """
+    batch, channels, height, width = frames.shape
+    padded = F.pad(frames, (pad,) * 4, mode="replicate")
+    offsets = pad - shifts.to(frames.device, torch.long)
+    rows = offsets[:, 1, None] + torch.arange(height, device=frames.device)
+    cols = offsets[:, 0, None] + torch.arange(width, device=frames.device)
+    # The flat index of every output pixel in its padded frame.
+    index = (rows[:, :, None] * padded.shape[-1] + cols[:, None, :]).view(batch, 1, -1)
+    out = padded.flatten(2).gather(2, index.expand(-1, channels, -1))
+    return out.view(batch, channels, height, width)
+
+
+class BatchedAugmentation:
+    """Draws a random shift and rotation per sample and applies them at once.
+
+    The torchvision random transforms draw a single transform for a whole
+    batch. This draws the parameters of every sample on the CPU from its own
+    seeded generator, without torch random ops so that it can run inside
+    `vmap`, and applies them with one kernel on the device of the frames.
+
+    With the "affine" mode the frames are rotated and translated with
+    `affine_transform`. With the "crop" mode they are shifted by whole pixels
+    with `shift_crop`, which does not support rotations.
+
+    Args:
+        shift: The maximum translation in pixels along each axis.
+        translate: The maximum translation as a fraction of the width and
+            height, like `RandomAffine`. Exclusive with `shift`.
+        degrees: The maximum rotation in degrees, or a sequence of angles to
+            choose from.
+        mode: One of "affine" or "crop".
+        interpolation: The interpolation of the "affine" mode.
+        round_shifts: Whether to round the translations to whole pixels.
+        seed: The seed of the parameters.
+    """
+
+    def __init__(
+        self,
+        shift: float = 0.0,
+        translate: tuple[float, float] | None = None,
+        degrees: float | Sequence[float] = 0.0,
+        mode: str = "affine",
+        interpolation: str = "bilinear",
+        round_shifts: bool = False,
+        seed: int | None = None,
+    ):
+        if mode not in AUGMENTATION_MODES:
+            raise ValueError(
+                f"Unknown augmentation mode {mode}, expected one of "
+                f"{AUGMENTATION_MODES}."
+            )
+        if shift and translate is not None:
+            raise ValueError("shift and translate are mutually exclusive.")
+        if mode == "crop" and (degrees or translate is not None):
+            raise ValueError("The crop mode only supports whole pixel shifts.")
+        self.shift = shift
+        self.translate = translate
+        self.degrees = degrees
+        self.mode = mode
+        self.interpolation = interpolation
+        self.round_shifts = round_shifts or mode == "crop"
+        self.rng = np.random.default_rng(seed)
+
+    def sample(
+        self, batch_size: int, height: int, width: int
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Draws the angle and (x, y) translation of every sample.
+
+        Args:
+            batch_size: The number of samples.
+            height: The height of the frames.
+            width: The width of the frames.
+
+        Returns:
+            The angles in degrees and the translations in pixels.
+        """
+        if self.translate is not None:
+            max_shift = (self.translate[0] * width, self.translate[1] * height)
+        else:
+            max_shift = (self.shift, self.shift)
+        translations = self.rng.uniform(
+            np.negative(max_shift), max_shift, (batch_size, 2)
+        )
+        if self.round_shifts:
+            translations = np.round(translations)
+        if isinstance(self.degrees, Sequence):
+            angles = self.rng.choice(self.degrees, batch_size)
+        else:
+            angles = self.rng.uniform(-self.degrees, self.degrees, batch_size)
+        return (
+            torch.as_tensor(angles, dtype=torch.float32),
+            torch.as_tensor(translations, dtype=torch.float32),
+        )
+
+    def __call__(self, frames: torch.Tensor) -> torch.Tensor:
+        """Augments a batch of frames.
+
+        Args:
+            frames: The frames, of shape (*batch, channels, height, width).
+                Every element of the batch gets its own transform.
+
+        Returns:
+            The augmented frames.
+        """
+        batch_shape = frames.shape[:-3]
+        frames = frames.reshape(-1, *frames.shape[-3:])
+        angles, translations = self.sample(len(frames), *frames.shape[-2:])
+        if self.mode == "crop":
+            out = shift_crop(frames, translations, math.ceil(self.shift))
+        else:
+            out = affine_transform(frames, angles, translations, self.interpolation)
+        return out.view(*batch_shape, *out.shape[-3:])
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(shift={self.shift}, "
+            f"translate={self.translate}, degrees={self.degrees}, "
+            f"mode={self.mode})"
+        )
@@ -0,0 +1,126 @@
+from typing import NamedTuple
+
+import numpy as np
+import torch
+
+
+class RingWindow:
+    """A window over the most recent values of a stream with an O(1) mean.
+
+    Args:
+        size: The number of most recent values kept.
+    """
+
+    def __init__(self, size: int):
+        self._values = np.zeros(size)
+        self._next = 0
+        self._count = 0
+        self._sum = 0.0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float) -> None:
+        if self._count == len(self._values):
+            self._sum -= self._values[self._next]
+        else:
+            self._count += 1
+        self._values[self._next] = value
+        self._sum += value
+        self._next = (self._next + 1) % len(self._values)
+
+    def mean(self) -> float:
+        return self._sum / self._count if self._count else float("nan")
+
+
+class EpisodeStats(NamedTuple):
+    """Statistics over the most recent finished episodes."""
+
+    avg_reward: float
+    avg_feedback: float
+    success_rate: float
+
+
+class EpisodeStatsTracker:
+    """Tracks the reward and feedback of every episode across collector batches.
+
+    The values of a batch are summed per trajectory ID with a single segment
+    reduction. An episode is finished once a trajectory with a higher ID
+    starts, at which point its sums enter ring windows over the last
+    `window` finished episodes. An episode is successful if its reward sum
+    is positive.
+
+    Args:
+        window: The number of finished episodes the statistics are averaged
+            over.
+    """
+
+    def __init__(self, window: int = 100):
+        self.rewards = RingWindow(window)
+        self.feedback = RingWindow(window)
+        self.successes = RingWindow(window)
+        # The reward sum of every episode so far, rounded for logging.
+        self.all_rewards: dict[int, float] = {}
+        self._open: dict[int, list[float]] = {}
+        self._last_traj = 0
+
+    def update(
+        self,
+        traj_ids: torch.Tensor,
+        rewards: torch.Tensor,
+        feedback: torch.Tensor | None = None,
+    ) -> list[EpisodeStats]:
+        """Adds the transitions of a collector batch.
+
+        Args:
+            traj_ids: The trajectory ID of every transition.
+            rewards: The reward of every transition.
+            feedback: The feedback of every transition, if tracked.
+
+        Returns:
+            The statistics each time a new trajectory started in the batch,
+            over the episodes finished before it.
+        """
+        traj_ids, inverse = torch.unique(
+            traj_ids.reshape(-1).int(), return_inverse=True
+        )
+        values = torch.stack(
+            [
+                rewards.reshape(-1),
+                torch.zeros_like(rewards.reshape(-1))
+                if feedback is None
+                else feedback.reshape(-1),
+            ],
+            dim=-1,
+        )
+        sums = torch.zeros(
+            len(traj_ids), 2, dtype=torch.float64, device=values.device
+        ).index_add_(0, inverse, values.double())
+
+        stats = []
+        # IDs are sorted, so trajectories start in the order they were created.
+        for traj_id, (reward_sum, feedback_sum) in zip(
+            traj_ids.tolist(), sums.tolist()
+        ):
+            if traj_id > self._last_traj:
+                self._finish_before(traj_id)
+                stats.append(
+                    EpisodeStats(
+                        self.rewards.mean(),
+                        self.feedback.mean(),
+                        self.successes.mean(),
+                    )
+                )
+                self._last_traj = traj_id
+            episode = self._open.setdefault(traj_id, [0.0, 0.0])
+            episode[0] += reward_sum
+            episode[1] += feedback_sum
+            self.all_rewards[traj_id] = round(episode[0], 4)
+        return stats
+
+    def _finish_before(self, traj_id: int) -> None:
+        for finished in sorted(t for t in self._open if t < traj_id):
+            reward, feedback = self._open.pop(finished)
+            self.rewards.append(reward)
+            self.feedback.append(feedback)
+            self.successes.append(float(reward > 0))
@@ -0,0 +1,98 @@
+from typing import Callable
+
+import torch
+from tensordict import TensorDictBase
+from tensordict.utils import NestedKey, unravel_key
+
+HEURISTIC_FEEDBACK_KEY = ("next", "agents", "heuristic_feedback")
+LEARNED_FEEDBACK_KEY = ("next", "agents", "learned_feedback")
+
+FeedbackFn = Callable[[TensorDictBase], torch.Tensor]
+
+
+def not_computed(like: NestedKey) -> FeedbackFn:
+    """Returns a default marking feedback that was not computed.
+
+    Args:
+        like: The key of the batch entry the feedback is shaped like.
+
+    Returns:
+        A function filling a batch's entry shape with NaN.
+    """
+    return lambda batch: torch.full_like(batch[like], float("nan"))
+
+
+class FeedbackProviders:
+    """Computes the feedback of collected batches lazily.
+
+    Every provider declares the key of its feedback and how to compute it
+    from a batch. A feedback is only computed when a consumer first requests
+    it for the bound batch, and is then memoized until the next batch is
+    bound, so that runs which do not consume a feedback do not pay for it.
+    Providers must not modify the batch.
+
+    Feedback with a default is stored in the batch by `fill`, so that every
+    stored batch has the same layout whether or not it was requested. Use
+    `not_computed` as the default to tell unrequested feedback apart from
+    computed values.
+    """
+
+    def __init__(self):
+        self._providers: dict[NestedKey, tuple[FeedbackFn, FeedbackFn | None]] = {}
+        self._batch = None
+        self._values = {}
+
+    def register(
+        self, key: NestedKey, provide: FeedbackFn, default: FeedbackFn | None = None
+    ) -> None:
+        """Registers a feedback provider.
+
+        Args:
+            key: The key of the feedback.
+            provide: Computes the feedback of a batch.
+            default: Computes the value stored by `fill` when the feedback was
+                not requested. The feedback is not stored if None.
+        """
+        self._providers[unravel_key(key)] = (provide, default)
+
+    def __contains__(self, key: NestedKey) -> bool:
+        return unravel_key(key) in self._providers
+
+    def bind(self, batch: TensorDictBase) -> None:
+        """Sets the batch the feedback is computed from.
+
+        Args:
+            batch: The collected batch.
+        """
+        self._batch = batch
+        self._values.clear()
+
+    def get(self, key: NestedKey) -> torch.Tensor:
+        """Returns a feedback of the bound batch, computing it on first use.
+
+        Args:
+            key: The key of the feedback.
+
+        Returns:
+            The feedback.
+        """
+        key = unravel_key(key)
+        if key not in self._providers:
+            raise KeyError(f"No feedback provider registered for {key}.")
+        if self._batch is None:
+            raise RuntimeError("No batch is bound, call bind() first.")
+        value = self._values.get(key)
+        if value is None:
+            value = self._values[key] = self._providers[key][0](self._batch)
+        return value
+
+    def fill(self) -> None:
+        """Stores the feedback that has a default in the bound batch.
+
+        Should be called once all consumers of the batch ran. Requested
+        feedback is stored as computed, the rest gets its default.
+        """
+        for key, (_, default) in self._providers.items():
+            if default is not None:
+                value = self._values.get(key)
+                self._batch.set(key, default(self._batch) if value is None else value)
@@ -0,0 +1,71 @@
+from typing import Callable
+
+import torch
+
+Features = tuple[torch.Tensor, ...]
+
+
+class TransitionFrameFeatures:
+    """Computes the features of the frames of transitions once per frame.
+
+    Within a trajectory the next frame of a transition is the current frame
+    of the following one, and the last next frame of a collector batch is
+    the first current frame of the next batch. The current frames that are
+    equal to the previous next frame, including the one kept from the
+    previous batch, reuse its features. Only the remaining current frames
+    and the next frames are passed to `features`, in a single call.
+
+    Frames are compared rather than trajectory IDs, so that reused features
+    are always those of an identical frame.
+
+    Args:
+        features: Maps a batch of frames to per-frame feature tensors, whose
+            first dimension is the batch.
+    """
+
+    def __init__(self, features: Callable[[torch.Tensor], Features]):
+        self.features = features
+        self._last_frame = None
+        self._last_features = None
+
+    def reset(self) -> None:
+        """Forgets the last frame of the previous batch."""
+        self._last_frame = None
+        self._last_features = None
+
+    def __call__(
+        self, f_current: torch.Tensor, f_next: torch.Tensor
+    ) -> tuple[Features, Features]:
+        """Computes the features of the current and next frames of transitions.
+
+        Args:
+            f_current: The current frames of consecutive transitions.
+            f_next: The next frames of the same transitions.
+
+        Returns:
+            The features of the current frames and of the next frames.
+        """
+        shared = torch.zeros(len(f_current), dtype=torch.bool, device=f_next.device)
+        shared[1:] = (f_current[1:] == f_next[:-1]).flatten(1).all(dim=1)
+        if self._last_frame is not None and len(f_current):
+            shared[0] = self._last_frame.shape == f_current[0].shape and bool(
+                torch.equal(self._last_frame, f_current[0])
+            )
+        missing = (~shared).nonzero()[:, 0]
+
+        computed = self.features(torch.cat([f_current[missing], f_next]))
+        current_features, next_features = [], []
+        for feature in computed:
+            missing_feature, next_feature = feature.split([len(missing), len(f_next)])
+            # Shared frames take the features of the previous next frame.
+            current_feature = next_feature.roll(1, dims=0)
+            if len(shared) and shared[0]:
+                current_feature[0] = self._last_features[len(current_features)]
+            current_feature[missing] = missing_feature
+            current_features.append(current_feature)
+            next_features.append(next_feature)
+
+        if len(f_next):
+            self._last_frame = f_next[-1].clone()
+            self._last_features = tuple(feature[-1] for feature in next_features)
+        return tuple(current_features), tuple(next_features)
@@ -1,4 +1,20 @@
+import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def pixels_to_float(pixels: torch.Tensor) -> torch.Tensor:
+    """Converts uint8 pixels to floats in [0, 1], leaving float pixels as is.
+
+    Args:
+        pixels: The pixels to convert.
+
+    Returns:
+        The pixels as floats.
+    """
+    if pixels.dtype == torch.uint8:
+        return pixels.float().div_(255)
+    return pixels
 
 
 def conv2d_bn_relu(inch, outch, kernel_size, stride=1, padding=1):
@@ -47,3 +63,27 @@ def deconv_relu(inch, outch, kernel_size, stride=1, padding=1):
         nn.ReLU(),
     )
     return convlayer
+
+
+def fold_batch_norm(module: nn.Module) -> nn.Module:
+    """Folds every batch norm that follows a convolution into the convolution.
+
+    The folded convolutions use the running statistics of the batch norms,
+    which are replaced by identities, so the module must only be used in eval
+    mode afterwards.
+
+    Args:
+        module: The module to fold, in place.
+
+    Returns:
+        The folded module.
+    """
+    for child in module.children():
+        fold_batch_norm(child)
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(conv.eval(), bn.eval())
+                module[i + 1] = nn.Identity()
+    return module
@@ -0,0 +1,978 @@
+import json
+import queue
+import threading
+from pathlib import Path
+
+import torch
+from crew_algorithms.envs.configs import EnvironmentConfig
+from crew_algorithms.utils.transforms import split_stacked_vector
+from tensordict import MemoryMappedTensor, TensorDict, TensorDictBase
+from torchrl.data import (
+    LazyMemmapStorage,
+    LazyTensorStorage,
+    TensorDictReplayBuffer,
+    TensorStorage,
+)
+from torchrl.data.replay_buffers.samplers import PrioritizedSampler
+from torchrl.data.replay_buffers.utils import _reduce
+
+
+class FrameStackStorage(LazyMemmapStorage):
+    """A memmap storage that keeps every rendered frame of a stacked pixel key once.
+
+    `CatFrames` makes the stacked observation of a transition share all but
+    its newest frame with the previous transition of the same trajectory, and
+    the `next` observation share all but its newest frame with the current
+    one. Instead of storing both stacks, only the newest frames are written to
+    a ring of frames, each linked to the frame before it in its trajectory.
+    Consecutive transitions are detected with the trajectory ID and step count
+    keys. The stacks of the current and `next` observations are rebuilt by
+    gathering along these links at sample time. The first frame of a
+    trajectory links to itself, which reproduces the padding of `CatFrames`.
+
+    Args:
+        max_size: The maximum number of transitions in the storage.
+        num_stacks: The number of frames stacked in the pixel key.
+        frame_capacity: The number of frames kept in the ring. A transition
+            adds one frame when it continues the one written before it, and
+            up to `num_stacks + 1` frames after a gap, so the default of
+            `max_size * (num_stacks + 1)` never runs out. A smaller ring saves
+            memory but raises once the stored transitions need more frames.
+        pixel_key: The stacked pixel key, frames stacked along dim -3.
+        traj_key: The trajectory ID key written by the collector.
+        step_key: The step count key written by `StepCounter`.
+        scratch_dir: The directory to store the memmap files in.
+        device: The device of the sampled data.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        num_stacks: int,
+        frame_capacity: int | None = None,
+        pixel_key: tuple[str, ...] = ("agents", "observation", "obs_0"),
+        traj_key: tuple[str, ...] = ("collector", "traj_ids"),
+        step_key: tuple[str, ...] = ("agents", "step_count"),
+        scratch_dir: str | None = None,
+        device: str = "cpu",
+    ):
+        super().__init__(max_size, scratch_dir=scratch_dir, device=device)
+        if frame_capacity is None:
+            frame_capacity = max_size * (num_stacks + 1)
+        self.num_stacks = num_stacks
+        self.frame_capacity = frame_capacity + num_stacks
+        self.pixel_key = pixel_key
+        self.traj_key = traj_key
+        self.step_key = step_key
+        self.frames = LazyMemmapStorage(
+            self.frame_capacity,
+            scratch_dir=None if scratch_dir is None else Path(scratch_dir, "frames"),
+            device=device,
+        )
+        # The links are kept in memory, only the frames themselves are memmapped.
+        self._frame_serial = torch.full((self.frame_capacity,), -1, dtype=torch.long)
+        self._frame_prev = torch.zeros(self.frame_capacity, dtype=torch.long)
+        self._oldest_needed = torch.zeros(max_size, dtype=torch.long)
+        self._num_frames = 0
+        self._last_step = self._last_serial = None
+
+    def set(self, cursor, data: TensorDictBase):
+        if isinstance(cursor, int):
+            cursor, data = torch.tensor([cursor]), data.unsqueeze(0)
+        cursor = torch.as_tensor(cursor, dtype=torch.long).cpu()
+        prefix = ("_data",) if "_data" in data.keys() else ()
+        key = (*prefix, *self.pixel_key)
+        next_key = (*prefix, "next", *self.pixel_key)
+
+        pixels = data.get(key).cpu()
+        next_pixels = data.get(next_key).cpu()
+        num_channels = pixels.shape[-3] // self.num_stacks
+        traj_ids = (
+            data.get((*prefix, *self.traj_key)).reshape(len(data), -1)[:, 0].cpu()
+        )
+        steps = data.get((*prefix, *self.step_key)).reshape(len(data), -1)[:, 0].cpu()
+
+        # A transition continues the one written before it when both are
+        # consecutive steps of the same trajectory.
+        continues = torch.empty(len(data), dtype=torch.bool)
+        continues[0] = self._last_step == (int(traj_ids[0]), int(steps[0]) - 1)
+        continues[1:] = (traj_ids[1:] == traj_ids[:-1]) & (steps.diff() == 1)
+        # A new trajectory only needs its first frame, a gap in a trajectory
+        # needs the whole stack to be written. The newest frame of the next
+        # observation is always written.
+        num_new = torch.where(steps == 0, 1, self.num_stacks).masked_fill(continues, 0)
+        next_serials = self._num_frames + (num_new + 1).cumsum(0) - 1
+        last_serial = -1 if self._last_serial is None else self._last_serial
+        previous_next = torch.cat([torch.tensor([last_serial]), next_serials[:-1]])
+        current = torch.where(continues, previous_next, next_serials - 1)
+
+        # The newest frames of the stacks, numbered within their transition.
+        rows = torch.arange(len(data)).repeat_interleave(num_new)
+        offsets = torch.arange(len(rows)) - (num_new.cumsum(0) - num_new)[rows]
+        stack_serials = next_serials[rows] - num_new[rows] + offsets
+        stacks = pixels.unflatten(-3, (self.num_stacks, num_channels))
+        new_serials = torch.cat([stack_serials, next_serials])
+        new_prevs = torch.cat(
+            [torch.where(offsets == 0, stack_serials, stack_serials - 1), current]
+        )
+        frames = torch.cat(
+            [
+                stacks[rows, ..., self.num_stacks - num_new[rows] + offsets, :, :, :],
+                next_pixels[..., -num_channels:, :, :],
+            ]
+        )
+
+        serial = int(next_serials[-1]) + 1
+        slots = new_serials % self.frame_capacity
+        self._oldest_needed[cursor] = self._oldest_needed_serial(
+            current, new_serials, new_prevs
+        )
+        # Every transition needs frames at least as recent as the transitions
+        # written before it, so the least recently written one needs the
+        # oldest frame.
+        length = max(len(self), int(cursor.max()) + 1)
+        oldest = 0 if length < self.max_size else (int(cursor[-1]) + 1) % self.max_size
+        if self._oldest_needed[oldest] < serial - self.frame_capacity:
+            raise RuntimeError(
+                "The frame ring is too small for the stored transitions, "
+                "increase frame_capacity."
+            )
+        self.frames.set(slots, TensorDict({"pixels": frames}, [len(frames)]))
+        self._frame_serial[slots] = new_serials
+        self._frame_prev[slots] = new_prevs
+        self._num_frames = serial
+        self._last_step = (int(traj_ids[-1]), int(steps[-1]))
+        self._last_serial = serial - 1
+
+        data = data.exclude(key, next_key)
+        data.set((*prefix, "_frame_serials"), torch.stack([current, next_serials], -1))
+        super().set(cursor, data)
+
+    def _oldest_needed_serial(self, current, new_serials, new_prevs):
+        """Follows the links from the current frames back to the oldest needed."""
+        # The links of the new frames are looked up on their own, as they may
+        # replace links that are still followed.
+        prev = torch.empty_like(new_prevs)
+        prev[new_serials - self._num_frames] = new_prevs
+        for _ in range(self.num_stacks - 1):
+            current = torch.where(
+                current >= self._num_frames,
+                prev[(current - self._num_frames).clamp_min(0)],
+                self._frame_prev[current % self.frame_capacity],
+            )
+        return current
+
+    def get(self, index) -> TensorDictBase:
+        data = super().get(index)
+        prefix = ("_data",) if "_data" in data.keys() else ()
+        serials = data.get((*prefix, "_frame_serials"))
+
+        # Rebuild next, current, current - 1, ... and slice both stacks from it.
+        chain = [serials[..., 1]]
+        for _ in range(self.num_stacks):
+            chain.append(self._frame_prev[chain[-1] % self.frame_capacity])
+        chain = torch.stack(chain[::-1])
+        slots = chain % self.frame_capacity
+        if (self._frame_serial[slots] != chain).any():
+            raise RuntimeError("A sampled frame was overwritten in the frame ring.")
+        frames = self.frames.get(slots.reshape(-1)).get("pixels").to(self.device)
+        frames = frames.reshape(*slots.shape, *frames.shape[1:]).movedim(0, -4)
+        frames = frames.flatten(-4, -3)
+        num_channels = frames.shape[-3] // (self.num_stacks + 1)
+
+        data.set((*prefix, *self.pixel_key), frames[..., :-num_channels, :, :])
+        data.set((*prefix, "next", *self.pixel_key), frames[..., num_channels:, :, :])
+        return data.exclude((*prefix, "_frame_serials"))
+
+    def state_dict(self) -> dict:
+        state_dict = super().state_dict()
+        state_dict["frames"] = self.frames.state_dict()
+        state_dict["frame_links"] = self._frame_links()
+        return state_dict
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        state_dict = dict(state_dict)
+        self.frames.load_state_dict(state_dict.pop("frames"))
+        self._load_frame_links(state_dict.pop("frame_links"))
+        super().load_state_dict(state_dict)
+
+    def dumps(self, path):
+        super().dumps(path)
+        # The frames go next to the storage directory, as everything inside of
+        # it is loaded back as part of the transitions.
+        frames_path = self._frames_path(path)
+        self.frames.dumps(frames_path)
+        torch.save(self._frame_links(), frames_path / "frame_links.pt")
+
+    def loads(self, path):
+        super().loads(path)
+        frames_path = self._frames_path(path)
+        self.frames.loads(frames_path)
+        self._load_frame_links(torch.load(frames_path / "frame_links.pt"))
+
+    @staticmethod
+    def _frames_path(path) -> Path:
+        path = Path(path)
+        return path.with_name(f"{path.name}_frames")
+
+    def _frame_links(self) -> dict:
+        return {
+            "serial": self._frame_serial.clone(),
+            "prev": self._frame_prev.clone(),
+            "oldest_needed": self._oldest_needed.clone(),
+            "num_frames": self._num_frames,
+            "last_step": self._last_step,
+            "last_serial": self._last_serial,
+        }
+
+    def _load_frame_links(self, links: dict) -> None:
+        self._frame_serial.copy_(links["serial"])
+        self._frame_prev.copy_(links["prev"])
+        self._oldest_needed.copy_(links["oldest_needed"])
+        self._num_frames = links["num_frames"]
+        self._last_step = links["last_step"]
+        self._last_serial = links["last_serial"]
+
+
+def estimate_transition_bytes(env_cfg: EnvironmentConfig) -> int:
+    """Estimates the size of a stored transition of an environment.
+
+    Only the stacked pixels of the observation and of the `next` observation
+    are counted, the other entries of a transition are negligible next to
+    them.
+
+    Args:
+        env_cfg: The environment configuration.
+
+    Returns:
+        The estimated number of bytes per transition.
+    """
+    num_pixels = env_cfg.num_stacks * env_cfg.num_channels
+    num_pixels *= env_cfg.crop_h * env_cfg.crop_w
+    return 2 * num_pixels * (1 if env_cfg.uint8_pixels else 4)
+
+
+class DeviceTensorStorage(LazyTensorStorage):
+    """A tensor storage preallocated directly on its device.
+
+    Unlike `LazyTensorStorage`, the storage is not built on the CPU first and
+    then moved, so filling an accelerator does not need the same amount of
+    host memory on the side.
+
+    Args:
+        max_size: The maximum number of transitions in the storage.
+        device: The device to keep the transitions on.
+    """
+
+    def __init__(self, max_size: int, device: str = "cpu"):
+        super().__init__(max_size, device=torch.device(device))
+
+    def _init(self, data: TensorDictBase) -> None:
+        self._storage = data.apply(
+            lambda x: torch.zeros(
+                self.max_size, *x.shape, dtype=x.dtype, device=self.device
+            ),
+            batch_size=[self.max_size, *data.shape],
+        )
+        self.initialized = True
+
+
+class DevicePrioritizedSampler(PrioritizedSampler):
+    """A prioritized sampler keeping its priorities in a tensor on a device.
+
+    The segment trees of `PrioritizedSampler` live on the CPU, which forces
+    a round trip for every sampled batch and priority update of a storage on
+    an accelerator. Here indices are drawn by searching the cumulative sum
+    of the priorities instead, in a few kernels on the device of the
+    storage. This is linear in the size of the storage, which is cheap for
+    replay buffers that fit on a device. Saved samplers are interchangeable
+    with `PrioritizedSampler`.
+
+    Args:
+        max_capacity: The maximum number of transitions in the storage.
+        alpha: How much prioritization is used, 0 being uniform.
+        beta: The importance sampling exponent.
+        eps: The value added to the priorities so that none is zero.
+        dtype: The dtype of the priorities.
+        reduction: The reduction of multidimensional priorities.
+        device: The device to keep the priorities on.
+    """
+
+    def __init__(
+        self,
+        max_capacity: int,
+        alpha: float,
+        beta: float,
+        eps: float = 1e-8,
+        dtype: torch.dtype = torch.float,
+        reduction: str = "max",
+        device: str = "cpu",
+    ):
+        self.device = torch.device(device)
+        super().__init__(max_capacity, alpha, beta, eps, dtype, reduction)
+
+    def _init(self) -> None:
+        self._priority = torch.zeros(
+            self._max_capacity, dtype=self.dtype, device=self.device
+        )
+        # Kept on the device, so that updates do not synchronize with it.
+        self._max_priority = torch.ones((), dtype=self.dtype, device=self.device)
+
+    @property
+    def default_priority(self) -> torch.Tensor:
+        return (self._max_priority + self._eps).pow(self._alpha)
+
+    def sample(self, storage, batch_size: int) -> tuple[torch.Tensor, dict]:
+        if len(storage) == 0:
+            raise RuntimeError("Cannot sample from an empty storage.")
+        priority = self._priority[: len(storage)]
+        cumsum = priority.cumsum(0)
+        mass = torch.rand(batch_size, dtype=self.dtype, device=self.device)
+        index = torch.searchsorted(cumsum, mass * cumsum[-1], right=True)
+        index.clamp_max_(len(storage) - 1)
+        weight = (priority[index] / priority.min()).pow(-self._beta)
+        return index, {"_weight": weight}
+
+    def _add_or_extend(self, index) -> None:
+        index = torch.as_tensor(index, device=self.device)
+        self._priority[index] = self.default_priority
+
+    def update_priority(self, index, priority) -> None:
+        index = torch.as_tensor(index, device=self.device)
+        priority = torch.as_tensor(priority, dtype=self.dtype, device=self.device)
+        self._max_priority = torch.maximum(self._max_priority, priority.max())
+        self._priority[index] = (priority + self._eps).pow(self._alpha)
+
+    def state_dict(self) -> dict:
+        return {
+            "_alpha": self._alpha,
+            "_beta": self._beta,
+            "_eps": self._eps,
+            "_max_priority": self._max_priority.item(),
+            "_priority": self._priority.cpu(),
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self._alpha = state_dict["_alpha"]
+        self._beta = state_dict["_beta"]
+        self._eps = state_dict["_eps"]
+        self._max_priority.fill_(state_dict["_max_priority"])
+        self._priority.copy_(state_dict["_priority"])
+
+    def dumps(self, path) -> None:
+        # Same layout as `PrioritizedSampler`, where both trees hold the
+        # priorities of the leaves.
+        path = Path(path).absolute()
+        path.mkdir(exist_ok=True)
+        priority = self._priority.to("cpu", torch.float64)
+        for name in ("sumtree", "mintree"):
+            MemoryMappedTensor.from_tensor(
+                priority, filename=path / f"{name}.memmap", existsok=True
+            )
+        with open(path / "sampler_metadata.json", "w") as file:
+            json.dump(
+                {
+                    "_alpha": self._alpha,
+                    "_beta": self._beta,
+                    "_eps": self._eps,
+                    "_max_priority": self._max_priority.item(),
+                    "_max_capacity": self._max_capacity,
+                },
+                file,
+            )
+
+    def loads(self, path) -> None:
+        path = Path(path).absolute()
+        with open(path / "sampler_metadata.json", "r") as file:
+            metadata = json.load(file)
+        if metadata["_max_capacity"] != self._max_capacity:
+            raise RuntimeError(
+                f"max capacity of loaded metadata ({metadata['_max_capacity']}) "
+                f"differs from self._max_capacity ({self._max_capacity})."
+            )
+        self._alpha = metadata["_alpha"]
+        self._beta = metadata["_beta"]
+        self._eps = metadata["_eps"]
+        self._max_priority.fill_(metadata["_max_priority"])
+        priority = MemoryMappedTensor.from_filename(
+            shape=(self._max_capacity,),
+            dtype=torch.float64,
+            filename=path / "sumtree.memmap",
+        )
+        self._priority.copy_(priority)
+
+
+class DeviceTensorDictReplayBuffer(TensorDictReplayBuffer):
+    """A replay buffer building its priority vectors on the sampler's device.
+
+    `TensorDictReplayBuffer` turns the default priority into a Python float
+    and builds the priorities of extended and updated transitions on the
+    device of the data. With a `DevicePrioritizedSampler`, both stay on the
+    device of the sampler instead.
+    """
+
+    def _get_priority_vector(self, tensordict: TensorDictBase) -> torch.Tensor:
+        if "_data" in tensordict.keys():
+            tensordict = tensordict.get("_data")
+        priority = tensordict.get(self.priority_key, None)
+        if priority is None:
+            return self._sampler.default_priority.expand(tensordict.shape[0])
+        priority = priority.reshape(priority.shape[0], -1)
+        priority = _reduce(priority, self._sampler.reduction, dim=1)
+        return priority.to(self._sampler.device, non_blocking=True)
+
+
+def sample_into(
+    replay_buffer: TensorDictReplayBuffer, out: TensorDictBase
+) -> TensorDictBase:
+    """Samples transitions of a replay buffer into a preallocated TensorDict.
+
+    Only for replay buffers on a `LazyMemmapStorage`, see `gathers_into`.
+    Every stored entry is gathered with one row copy per transition, straight
+    from the memmap into `out`. This avoids both the element-wise kernel of
+    advanced indexing and the page faults of a freshly allocated output.
+
+    Args:
+        replay_buffer: The replay buffer to sample from.
+        out: The TensorDict to write the transitions to, of shape
+            [num_batches, batch_size], with the entries of a sampled batch.
+
+    Returns:
+        `out`, with the sampled transitions and their sampling info.
+    """
+    with replay_buffer._replay_lock:
+        index, info = replay_buffer._sampler.sample(replay_buffer._storage, out.numel())
+        index = torch.as_tensor(index).view(out.shape)
+        stored = replay_buffer._storage._storage.get("_data")
+        for key, value in stored.items(include_nested=True, leaves_only=True):
+            rows = out.get(key)
+            for batch, batch_index in enumerate(index):
+                torch.index_select(value, 0, batch_index, out=rows[batch])
+    out.set("index", index, inplace=True)
+    for key, value in info.items():
+        out.set(key, torch.as_tensor(value).view(out.shape), inplace=True)
+    return out
+
+
+def gathers_into(replay_buffer: "TensorDictReplayBuffer | LatentReplay") -> bool:
+    """Whether batches of a replay buffer can be sampled with `sample_into`."""
+    if isinstance(replay_buffer, LatentReplay):
+        replay_buffer = replay_buffer.replay_buffer
+    storage = replay_buffer._storage
+    return (
+        isinstance(storage, LazyMemmapStorage)
+        and not isinstance(storage, FrameStackStorage)
+        and not len(replay_buffer._transform)
+    )
+
+
+def split_stored_vector(
+    replay_buffer: "TensorDictReplayBuffer | LatentReplay",
+    in_key: tuple[str, ...],
+    layout: dict,
+    chunk_size: int = 1024,
+) -> None:
+    """Splits a vector stacked whole in a loaded replay buffer into its fields.
+
+    Replay buffers saved before the vector was split in the environment hold
+    it stacked, see `split_stacked_vector`. Their storage is rebuilt with the
+    fields instead, one chunk of transitions at a time so that the frames are
+    not all read at once. The sampler is left as is, the priorities still
+    match the transitions. Buffers without the vector are left untouched.
+
+    Args:
+        replay_buffer: The loaded replay buffer.
+        in_key: The key of the vector under the root and ``next``.
+        layout: Maps the name of every field to the [start, end) range of
+            its columns.
+        chunk_size: The number of transitions converted at once.
+    """
+    if isinstance(replay_buffer, LatentReplay):
+        replay_buffer = replay_buffer.replay_buffer
+    storage = replay_buffer._storage
+    if not getattr(storage, "initialized", False):
+        return
+    stored = storage._storage
+    if ("_data", *in_key) not in stored.keys(include_nested=True):
+        return
+    if not isinstance(storage, TensorStorage) or isinstance(storage, FrameStackStorage):
+        raise ValueError(
+            f"Cannot split {in_key} in a {type(storage).__name__}, only in a "
+            "tensor storage without frame deduplication."
+        )
+
+    length = len(storage)
+    storage._storage, storage.initialized = None, False
+    for start in range(0, length, chunk_size):
+        chunk = stored[start : min(start + chunk_size, length)]
+        split_stacked_vector(chunk.get("_data"), in_key, layout)
+        storage.set(torch.arange(start, start + len(chunk)), chunk)
+
+
+class PrefetchingSampler:
+    """Draws batches from a replay buffer ahead of time on a background thread.
+
+    Up to `num_batches` draws are kept in flight, so that reading from the
+    storage, gathering and collating the next batches overlap with the
+    gradient steps of the current one. Draws are optionally staged in pinned
+    memory, which lets the copy to `device` run asynchronously. With
+    `num_batches=0`, batches are drawn synchronously when requested.
+
+    Every draw samples the indices of `batches_per_sample` batches in a single
+    call to the sampler and gathers them from the storage at once, as a
+    `[batches_per_sample, batch_size]` TensorDict. `sample` hands out views of
+    it one batch at a time, so several gradient steps share the overhead of
+    one draw. Priorities are only refreshed between draws.
+
+    With an `expert_buffer`, the first `round(batch_size * expert_ratio)`
+    transitions of every batch are drawn from it and the others from the
+    replay buffer, in the same draw. `update_tensordict_priority` splits the
+    priorities of such batches between the two buffers.
+
+    On memmap storages, draws are gathered with `sample_into` into a ring of
+    `num_batches + 2` preallocated TensorDicts, which are reused from draw to
+    draw. Batches sampled to the CPU are views of these and are overwritten
+    `num_batches + 2` draws later, clone them to keep them longer.
+
+    A prefetched batch may be overwritten by `extend` before its priorities
+    come back. Every batch records the number of `extend` calls made before
+    it was drawn, and every storage index the `extend` call that last wrote
+    it, so priorities of transitions that were replaced in the meantime are
+    dropped instead of being assigned to their replacements. All other
+    attributes are forwarded to the wrapped replay buffer.
+
+    Args:
+        replay_buffer: The replay buffer to sample from.
+        num_batches: The number of draws to keep in flight.
+        batch_size: The size of the batches, defaults to the batch size of
+            the replay buffer.
+        batches_per_sample: The number of batches gathered in a single draw.
+        device: The device to move the sampled batches to.
+        pin_memory: Whether to stage the draws in pinned memory.
+        generation_key: The key the `extend` count of a batch is written to.
+        expert_buffer: A replay buffer of expert transitions to mix into every
+            batch, it is not extended through the sampler.
+        expert_ratio: The fraction of every batch drawn from `expert_buffer`.
+    """
+
+    def __init__(
+        self,
+        replay_buffer: TensorDictReplayBuffer,
+        num_batches: int = 2,
+        batch_size: int | None = None,
+        batches_per_sample: int = 1,
+        device: str = "cpu",
+        pin_memory: bool = False,
+        generation_key: str = "index_generation",
+        expert_buffer: TensorDictReplayBuffer | None = None,
+        expert_ratio: float = 0.0,
+    ):
+        self.replay_buffer = replay_buffer
+        self.num_batches = num_batches
+        self.batch_size = batch_size or replay_buffer._batch_size
+        self.batches_per_sample = batches_per_sample
+        self.device = torch.device(device)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.generation_key = generation_key
+        self.expert_buffer = expert_buffer
+        self.expert_batch_size = (
+            0 if expert_buffer is None else round(self.batch_size * expert_ratio)
+        )
+        self._sources = [
+            (buffer, size)
+            for buffer, size in [
+                (expert_buffer, self.expert_batch_size),
+                (replay_buffer, self.batch_size - self.expert_batch_size),
+            ]
+            if size > 0
+        ]
+        self._reuse_draws = all(gathers_into(buffer) for buffer, _ in self._sources)
+        self._draws = []
+        self._generation = 0
+        self._written_at = torch.zeros(
+            replay_buffer._storage.max_size, dtype=torch.long
+        )
+        self._batches = None
+        self._next_batch = 0
+        self._queue = queue.Queue(maxsize=max(num_batches, 1))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.replay_buffer, name)
+
+    def __len__(self) -> int:
+        return len(self.replay_buffer)
+
+    def __getitem__(self, index) -> TensorDictBase:
+        return self.replay_buffer[index]
+
+    def extend(self, data: TensorDictBase) -> torch.Tensor:
+        index = self.replay_buffer.extend(data)
+        self._generation += 1
+        self._written_at[index] = self._generation
+        return index
+
+    def sample(self, batch_size: int | None = None) -> TensorDictBase:
+        """Returns the next batch on `device`.
+
+        Args:
+            batch_size: The size of the batch. Batches of a size other than
+                `batch_size` are drawn synchronously on their own, from the
+                replay buffer only.
+
+        Returns:
+            The sampled batch, including its generation.
+        """
+        if batch_size not in (None, self.batch_size):
+            return self._to_device(self._draw(batch_size))
+        if self._batches is None or self._next_batch == len(self._batches):
+            self._batches = self.sample_batches()
+            self._next_batch = 0
+        batch = self._batches[self._next_batch]
+        self._next_batch += 1
+        return batch
+
+    def sample_batches(self) -> TensorDictBase:
+        """Returns the next draw of `batches_per_sample` batches on `device`.
+
+        Returns:
+            The sampled batches, stacked along the first dimension.
+        """
+        if self.num_batches == 0:
+            return self._to_device(self._draw(self.batch_size, self.batches_per_sample))
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._prefetch, daemon=True)
+            self._thread.start()
+        batches = self._queue.get()
+        if isinstance(batches, Exception):
+            self._thread = None
+            raise batches
+        return self._to_device(batches)
+
+    def update_tensordict_priority(self, data: TensorDictBase) -> None:
+        """Updates the priorities of sampled batches.
+
+        Args:
+            data: Batches returned by `sample` or `sample_batches`, with their
+                priorities set.
+        """
+        if self.expert_batch_size and data.shape[-1] == self.batch_size:
+            self.expert_buffer.update_tensordict_priority(
+                data[..., : self.expert_batch_size]
+            )
+            data = data[..., self.expert_batch_size :]
+        if self.generation_key not in data.keys():
+            self.replay_buffer.update_tensordict_priority(data)
+            return
+        data = data.select(
+            "index", self.generation_key, self.replay_buffer.priority_key, strict=False
+        ).reshape(-1)
+        written_at = self._written_at[data.get("index").cpu()]
+        current = written_at.to(data.device) <= data.get(self.generation_key)
+        if current.all():
+            self.replay_buffer.update_tensordict_priority(data)
+        elif current.any():
+            self.replay_buffer.update_tensordict_priority(data[current])
+
+    def close(self) -> None:
+        """Stops the background threads and discards the prefetched batches."""
+        self._batches = None
+        for buffer, _ in self._sources:
+            if isinstance(buffer, LatentReplay):
+                buffer.close()
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        # The entries of the draws change once a LatentReplay is activated.
+        self._draws = []
+
+    def _draw(self, batch_size: int, num_batches: int | None = None) -> TensorDictBase:
+        # Read before sampling, so a concurrent `extend` can only make the
+        # batch look older than it is and never newer.
+        generation = self._generation
+        if num_batches is not None and self._draws:
+            # The oldest draw of the ring is no longer handed out.
+            batch = self._draws.pop(0)
+            self._draws.append(batch)
+            start = 0
+            for buffer, size in self._sources:
+                out = batch.get_sub_tensordict(
+                    (slice(None), slice(start, start + size))
+                )
+                if isinstance(buffer, LatentReplay):
+                    buffer.sample(out=out)
+                else:
+                    sample_into(buffer, out)
+                start += size
+            return batch.fill_(self.generation_key, generation)
+
+        if num_batches is None:
+            batch = self.replay_buffer.sample(batch_size)
+        else:
+            batch = torch.cat(
+                [
+                    buffer.sample(size * num_batches).reshape(num_batches, size)
+                    for buffer, size in self._sources
+                ],
+                dim=1,
+            )
+        batch.set(self.generation_key, torch.full(batch.batch_size, generation))
+        if self.pin_memory:
+            batch = batch.pin_memory()
+        if num_batches is not None and self._reuse_draws:
+            # The first draw gives the entries of the draws reused later.
+            self._draws = [
+                batch.apply(torch.empty_like) for _ in range(self.num_batches + 1)
+            ]
+            if self.pin_memory:
+                self._draws = [draw.pin_memory() for draw in self._draws]
+            self._draws.append(batch)
+        return batch
+
+    def _to_device(self, batch: TensorDictBase) -> TensorDictBase:
+        return batch.to(self.device, non_blocking=self.pin_memory)
+
+    def _prefetch(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batches = self._draw(self.batch_size, self.batches_per_sample)
+            except Exception as e:
+                batches = e
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batches, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batches, Exception):
+                return
+
+
+class LatentReplay:
+    """Keeps the per-frame embeddings of a frozen encoder next to a replay buffer.
+
+    Once `activate` is called with the frozen encoder, the frames of new
+    transitions are encoded when they are written, and sampled batches carry
+    the embeddings of their `frame_keys` under the matching `latent_key`.
+    Each storage index records the encoder version its embeddings were
+    computed with. Indices without embeddings are encoded when they are
+    sampled, while a background job encodes the whole buffer. Activating
+    again with new weights bumps the version: embeddings of older versions
+    keep being served until the background job refreshes them.
+
+    A write made while an index is being encoded takes precedence over the
+    encoded embeddings, which are dropped. All other attributes are
+    forwarded to the wrapped replay buffer.
+
+    Args:
+        replay_buffer: The replay buffer to keep the embeddings of.
+        frame_keys: The keys of the stacked frames to embed.
+        num_channels: The number of channels of a frame.
+        chunk_size: The number of transitions encoded at once.
+    """
+
+    def __init__(
+        self,
+        replay_buffer: TensorDictReplayBuffer,
+        frame_keys: list[tuple[str, ...]],
+        num_channels: int,
+        chunk_size: int = 256,
+    ):
+        self.replay_buffer = replay_buffer
+        self.frame_keys = [tuple(key) for key in frame_keys]
+        self.num_channels = num_channels
+        self.chunk_size = chunk_size
+        self.encoder = None
+        self.version = -1
+        capacity = replay_buffer._storage.max_size
+        self._embeddings = {}
+        self._versions = torch.full((capacity,), -1, dtype=torch.long)
+        self._generation = 0
+        self._written_at = torch.zeros(capacity, dtype=torch.long)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def latent_key(key: tuple[str, ...]) -> tuple[str, ...]:
+        """Returns the key the embeddings of the frames at `key` are set to."""
+        return (*key[:-1], key[-1] + "_latent")
+
+    @property
+    def active(self) -> bool:
+        return self.encoder is not None
+
+    def __getattr__(self, name):
+        return getattr(self.replay_buffer, name)
+
+    def __len__(self) -> int:
+        return len(self.replay_buffer)
+
+    def __getitem__(self, index) -> TensorDictBase:
+        return self.replay_buffer[index]
+
+    def activate(self, encoder: torch.nn.Module) -> None:
+        """Starts embedding the frames with a frozen encoder.
+
+        Args:
+            encoder: The frozen encoder, in eval mode. It is called on batches
+                of single frames.
+        """
+        self._stop_refresh()
+        with self._lock:
+            self.encoder = encoder
+            self.version += 1
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+
+    def extend(self, data: TensorDictBase) -> torch.Tensor:
+        with self._lock:
+            index = self.replay_buffer.extend(data).cpu()
+            self._generation += 1
+            self._written_at[index] = self._generation
+            self._versions[index] = -1
+            generation, version = self._generation, self.version
+        if self.active:
+            self._write(index, self._encode(data), generation, version)
+        return index
+
+    def sample(
+        self, batch_size: int | None = None, out: TensorDictBase | None = None
+    ) -> TensorDictBase:
+        """Samples a batch with the embeddings of its frames.
+
+        Args:
+            batch_size: The size of the batch, defaults to the batch size of
+                the replay buffer.
+            out: A TensorDict to sample the batch into with `sample_into`, in
+                place of `batch_size`.
+
+        Returns:
+            The sampled batch.
+        """
+        if not self.active:
+            return self._sample(batch_size, out)
+        with self._lock:
+            batch = self._sample(batch_size, out)
+            index = batch.get("index").cpu()
+            missing = self._versions[index] < 0
+            embeddings = {
+                key: embeddings[index] for key, embeddings in self._embeddings.items()
+            }
+            generation, version = self._generation, self.version
+        if missing.any():
+            encoded = self._encode(batch[missing.to(batch.device)])
+            self._write(index[missing], encoded, generation, version)
+            if not embeddings:
+                embeddings = {
+                    key: torch.empty(*index.shape, *value.shape[1:], dtype=value.dtype)
+                    for key, value in encoded.items()
+                }
+            for key, value in encoded.items():
+                embeddings[key][missing] = value
+        for key, value in embeddings.items():
+            # Embeddings are stored per transition, the frames may have more
+            # batch dimensions, like the agent dimension.
+            shape = (*batch.get(key).shape[:-3], -1, value.shape[-1])
+            batch.set(
+                self.latent_key(key), value.view(shape).to(batch.device), inplace=True
+            )
+        return batch
+
+    def frame_features(
+        self, batch: TensorDictBase
+    ) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        """Pairs the frames of a sampled batch with their embeddings.
+
+        Args:
+            batch: A batch returned by `sample`, or batches stacked or
+                concatenated from it.
+
+        Returns:
+            The frames of every frame key and their embeddings, one row per
+            frame, as taken by `cache_encoder_features`.
+        """
+        if not self.active:
+            return []
+        return [
+            (batch.get(key), batch.get(self.latent_key(key)).flatten(0, -2))
+            for key in self.frame_keys
+        ]
+
+    def close(self) -> None:
+        """Stops the background encoding."""
+        self._stop_refresh()
+
+    def _sample(
+        self, batch_size: int | None, out: TensorDictBase | None
+    ) -> TensorDictBase:
+        if out is None:
+            return self.replay_buffer.sample(batch_size)
+        return sample_into(self.replay_buffer, out)
+
+    @torch.no_grad()
+    def _encode(self, data: TensorDictBase) -> dict[str, torch.Tensor]:
+        device = next(self.encoder.parameters()).device
+        encoded = {}
+        for key in self.frame_keys:
+            frames = data.get(key)
+            # Every frame of a stack is encoded on its own.
+            frames = frames.reshape(
+                len(data), -1, self.num_channels, *frames.shape[-2:]
+            )
+            encoded[key] = torch.cat(
+                [
+                    self.encoder(chunk.flatten(0, 1).to(device))
+                    .view(*chunk.shape[:2], -1)
+                    .cpu()
+                    for chunk in frames.split(self.chunk_size)
+                ]
+            )
+        return encoded
+
+    def _write(
+        self,
+        index: torch.Tensor,
+        encoded: dict[str, torch.Tensor],
+        generation: int,
+        version: int,
+    ) -> None:
+        with self._lock:
+            # Drop indices written since their frames were read.
+            current = self._written_at[index] <= generation
+            index = index[current]
+            for key, value in encoded.items():
+                if key not in self._embeddings:
+                    self._embeddings[key] = torch.zeros(
+                        len(self._versions), *value.shape[1:], dtype=value.dtype
+                    )
+                self._embeddings[key][index] = value[current]
+            self._versions[index] = version
+
+    def _refresh(self) -> None:
+        version = self.version
+        for start in range(0, len(self.replay_buffer), self.chunk_size):
+            if self._stop.is_set():
+                return
+            index = torch.arange(
+                start, min(start + self.chunk_size, len(self.replay_buffer))
+            )
+            with self._lock:
+                index = index[self._versions[index] < version]
+                generation = self._generation
+            if len(index):
+                data = self.replay_buffer[index]
+                self._write(index, self._encode(data), generation, version)
+
+    def _stop_refresh(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
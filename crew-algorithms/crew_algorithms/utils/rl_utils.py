@@ -6,7 +6,8 @@ import torchvision.transforms.functional as F
 import wandb
 from crew_algorithms.envs.channels import ToggleTimestepChannel, WrittenFeedbackChannel
 from crew_algorithms.envs.configs import EnvironmentConfig
-from crew_algorithms.envs.unity import UnityEnv
+from crew_algorithms.envs.mock import MockUnityEnvironment
+from crew_algorithms.envs.unity import UnityEnv, UnityWrapper
 from crew_algorithms.utils.common_utils import find_free_port
 from mlagents_envs.side_channel.engine_configuration_channel import (
     EngineConfigurationChannel,
@@ -38,8 +39,21 @@ def make_base_env(
             to share written feedback at the end of each episode.
 
     Returns:
-        A `UnityEnv` object that can be used to interact with the environment.
+        A `UnityEnv` object that can be used to interact with the environment,
+        or a `UnityWrapper` around a `MockUnityEnvironment` if `env_cfg.mock`
+        is set.
     """
+    if env_cfg.mock:
+        return UnityWrapper(
+            MockUnityEnvironment.from_config(env_cfg),
+            device=device,
+            frame_skip=env_cfg.frame_skip,
+            batched_decode=env_cfg.batched_decode,
+            batched_actions=env_cfg.batched_actions,
+            static_buffers=env_cfg.static_buffers,
+            uint8_pixels=env_cfg.uint8_pixels,
+        )
+
     # env_cfg.unity_server_build_path = env_cfg.unity_server_build_path_linux
     # env_cfg.unity_server_build_path = env_cfg.unity_server_build_path_osx
     if "Linux" in platform.system():
@@ -120,7 +134,11 @@ def make_base_env(
         base_port=find_free_port(),
         timeout_wait=60 * 60 * 24,
         device=device,
-        frame_skip=1,
+        frame_skip=env_cfg.frame_skip,
+        batched_decode=env_cfg.batched_decode,
+        batched_actions=env_cfg.batched_actions,
+        static_buffers=env_cfg.static_buffers,
+        uint8_pixels=env_cfg.uint8_pixels,
     )
     return base_env
 
@@ -0,0 +1,102 @@
+import torch
+import torch.nn.functional as F
+
+
+def box_sum(x: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    """Sums every window of a given size over the last two dimensions.
+
+    The windows are summed separably, first along the rows and then along
+    the columns, by adding shifted slices. Unlike a summed-area table this
+    only adds values, so that the relative error of non-negative sums stays
+    within a few float epsilons.
+
+    Args:
+        x: The values, of shape (..., H, W).
+        height: The height of the windows.
+        width: The width of the windows.
+
+    Returns:
+        The sum of every window that fits in the input, of shape
+        (..., H - height + 1, W - width + 1).
+    """
+    out_h, out_w = x.shape[-2] - height + 1, x.shape[-1] - width + 1
+    rows = x[..., :out_h, :].clone()
+    for dy in range(1, height):
+        rows += x[..., dy : dy + out_h, :]
+    out = rows[..., :out_w].clone()
+    for dx in range(1, width):
+        out += rows[..., dx : dx + out_w]
+    return out
+
+
+class TemplateMatcher:
+    """Detects a template in frames with normalized cross-correlation.
+
+    A frame contains the template if the correlation of any window with the
+    template, divided by the norms of both, exceeds the threshold. The
+    correlation is a convolution with the template, while the window norms
+    come from `box_sum` over the squared frame instead of a second
+    convolution with a kernel of ones.
+
+    Frames and template are non-negative, so both terms only differ from
+    the reference computation by a relative error of a few float epsilons.
+    Frames whose best score lies within `tolerance` of the threshold are
+    scored again with the reference computation, so that the detections
+    are identical to it.
+
+    Args:
+        template: The template, of shape (channels, height, width) or
+            (1, channels, height, width).
+        threshold: The score above which the template is detected.
+        tolerance: The distance to the threshold under which a detection is
+            checked with the reference computation.
+    """
+
+    def __init__(
+        self, template: torch.Tensor, threshold: float, tolerance: float = 1e-4
+    ):
+        self.template = template.reshape(1, *template.shape[-3:])
+        self.template_norm = (self.template**2).sum() ** 0.5
+        self.threshold = threshold
+        self.tolerance = tolerance
+
+    def scores(self, frames: torch.Tensor) -> torch.Tensor:
+        """Computes the score of every window of a batch of frames.
+
+        Args:
+            frames: The frames, of shape (batch, channels, H, W).
+
+        Returns:
+            The scores, of shape (batch, 1, H - height + 1, W - width + 1).
+        """
+        brightness = box_sum(
+            (frames**2).sum(1, keepdim=True), *self.template.shape[-2:]
+        )
+        heat_map = F.conv2d(frames, self.template)
+        return heat_map / (brightness**0.5 * self.template_norm)
+
+    def reference_scores(self, frames: torch.Tensor) -> torch.Tensor:
+        """Computes the scores with two convolutions, see `scores`."""
+        brightness = F.conv2d(frames**2, torch.ones_like(self.template)) ** 0.5
+        heat_map = F.conv2d(frames, self.template)
+        return heat_map / (brightness * self.template_norm)
+
+    def __call__(self, frames: torch.Tensor) -> torch.Tensor:
+        """Detects the template in a batch of frames.
+
+        Args:
+            frames: The frames, of shape (batch, channels, H, W).
+
+        Returns:
+            Whether each frame contains the template.
+        """
+        best = self.scores(frames).flatten(1).max(dim=1).values
+        found = best > self.threshold
+        unsure = ((best - self.threshold).abs() <= self.tolerance).nonzero()[:, 0]
+        if len(unsure):
+            found[unsure] = (
+                (self.reference_scores(frames[unsure]) > self.threshold)
+                .flatten(1)
+                .any(dim=1)
+            )
+        return found
@@ -1,17 +1,23 @@
+from copy import copy
+from functools import lru_cache
 from typing import Sequence
 
 import torch
+from crew_algorithms.utils.augmentation import BatchedAugmentation
 from tensordict.tensordict import TensorDictBase
-from tensordict.utils import NestedKey
-from torchrl.data.tensor_specs import TensorSpec
+from tensordict.utils import NestedKey, unravel_key
+from torchrl.data.tensor_specs import ContinuousBox, TensorSpec
 from torchrl.data.utils import DEVICE_TYPING
 from torchrl.envs.transforms.transforms import (
+    IMAGE_KEYS,
     Compose,
     FlattenObservation,
     ObservationTransform,
     ToTensorImage,
     _apply_to_composite,
 )
+from torchrl.envs.transforms.utils import _get_reset, _set_missing_tolerance
+from torchvision.transforms.functional import InterpolationMode, resize
 
 
 class CatUnitySensorsAlongChannelDimTransform(Compose):
@@ -69,11 +75,25 @@ class CatUnitySensorsAlongChannelDimTransform(Compose):
         return self._dtype
 
 
-class RandomShift(ObservationTransform):
+class RandomAugment(ObservationTransform):
+    """Randomly shifts and rotates every observation on its own.
+
+    The transform of each observation is drawn by a `BatchedAugmentation`
+    and applied to the whole batch with a single kernel. All the dimensions
+    before the last three are batch dimensions, so frames stacked along the
+    channels share the transform of their observation. Being seeded, the
+    transform is reproducible, and can be used in an environment as well as
+    on the samples of a replay buffer.
+
+    Args:
+        augmentation: The augmentation to apply.
+        in_keys: The keys of the observations to augment.
+        out_keys: The keys to write the augmented observations to.
+    """
+
     def __init__(
         self,
-        a: int,
-        b: int,
+        augmentation: BatchedAugmentation,
         in_keys: Sequence[NestedKey] | None = None,
         out_keys: Sequence[NestedKey] | None = None,
     ):
@@ -82,24 +102,10 @@ class RandomShift(ObservationTransform):
         if out_keys is None:
             out_keys = copy(in_keys)
         super().__init__(in_keys=in_keys, out_keys=out_keys)
-        self.a = a
-        self.b = b
-
-        # self.trans = transforms.Compose([
-        #     transforms.Pad((a, b), padding_mode='edge'),
-        #     transforms.RandomCrop((100, 100))
-        # ])
-
-        self.trans = RandomAffine(
-            degrees=(0, 0),
-            translate=(a, b),
-            scale=(1.0, 1.0),
-            interpolation=InterpolationMode.BILINEAR,
-        )
+        self.augmentation = augmentation
 
     def _apply_transform(self, observation: torch.Tensor) -> torch.Tensor:
-        observation = self.trans(observation)
-        return observation
+        return self.augmentation(observation)
 
     def _reset(
         self, tensordict: TensorDictBase, tensordict_reset: TensorDictBase
@@ -110,28 +116,155 @@ class RandomShift(ObservationTransform):
 
     @_apply_to_composite
     def transform_observation_spec(self, observation_spec: TensorSpec) -> TensorSpec:
-        space = observation_spec.space
-        if isinstance(space, ContinuousBox):
-            space.low = self._apply_transform(space.low)
-            space.high = self._apply_transform(space.high)
-            observation_spec.shape = space.low.shape
-        else:
-            observation_spec.shape = self._apply_transform(
-                torch.zeros(observation_spec.shape)
-            ).shape
+        # Shifts and rotations keep the shape and the range of the pixels.
         return observation_spec
 
     def __repr__(self) -> str:
-        return (
-            f"{self.__class__.__name__}("
-            f"a={float(self.a):4.4f}, b={float(self.b):4.4f}, "
+        return f"{self.__class__.__name__}({self.augmentation})"
+
+
+class RandomShift(RandomAugment):
+    """Randomly translates every observation, like `RandomAffine`.
+
+    Args:
+        a: The maximum translation as a fraction of the width.
+        b: The maximum translation as a fraction of the height.
+        seed: The seed of the translations.
+    """
+
+    def __init__(
+        self,
+        a: float,
+        b: float,
+        in_keys: Sequence[NestedKey] | None = None,
+        out_keys: Sequence[NestedKey] | None = None,
+        seed: int | None = None,
+    ):
+        super().__init__(
+            BatchedAugmentation(translate=(a, b), round_shifts=True, seed=seed),
+            in_keys=in_keys,
+            out_keys=out_keys,
+        )
+        self.a = a
+        self.b = b
+
+
+class RandRotate(RandomAugment):
+    """Randomly rotates every observation, like `RandomRotation`.
+
+    Args:
+        d: The maximum rotation in degrees.
+        seed: The seed of the rotations.
+    """
+
+    def __init__(
+        self,
+        d: float,
+        in_keys: Sequence[NestedKey] | None = None,
+        out_keys: Sequence[NestedKey] | None = None,
+        seed: int | None = None,
+    ):
+        super().__init__(
+            BatchedAugmentation(degrees=d, seed=seed),
+            in_keys=in_keys,
+            out_keys=out_keys,
+        )
+        self.d = d
+
+
+class RandRotateChoice(RandomAugment):
+    """Rotates every observation by an angle chosen at random.
+
+    Args:
+        ds: The angles to choose from, in degrees.
+        seed: The seed of the choices.
+    """
+
+    def __init__(
+        self,
+        ds: Sequence[float],
+        in_keys: Sequence[NestedKey] | None = None,
+        out_keys: Sequence[NestedKey] | None = None,
+        seed: int | None = None,
+    ):
+        super().__init__(
+            BatchedAugmentation(degrees=tuple(ds), seed=seed),
+            in_keys=in_keys,
+            out_keys=out_keys,
         )
+        self.ds = ds
+
+
+@lru_cache
+def coordinate_planes(
+    height: int, width: int, device: torch.device, dtype: torch.dtype
+) -> torch.Tensor:
+    """Returns the coordinate channels of a frame, computed once per layout.
+
+    The first channel goes from 1 to -1 along the height, the second from 10
+    to -10 along the width. The returned tensor is shared between callers
+    and must not be modified.
+
+    Args:
+        height: The height of the frame.
+        width: The width of the frame.
+        device: The device of the channels.
+        dtype: The dtype of the channels.
+
+    Returns:
+        The channels, of shape (2, height, width).
+    """
+    x_lin = torch.linspace(1, -1, steps=height)
+    y_lin = torch.linspace(10, -10, steps=width)
+    grid = torch.stack(torch.meshgrid(x_lin, y_lin, indexing="ij"), dim=0)
+    return grid.to(device, dtype)
+
+
+def add_coordinates(
+    observation: torch.Tensor, out: torch.Tensor | None = None
+) -> torch.Tensor:
+    """Appends the coordinate channels to a batch of frames.
+
+    The observation and the coordinates are written into a single output,
+    without materializing the coordinates for every frame.
+
+    Args:
+        observation: The frames, of shape (*batch, channels, height, width).
+        out: The tensor to write the result to, of shape
+            (*batch, channels + 2, height, width). Allocated if not given.
+
+    Returns:
+        The frames followed by their coordinate channels.
+    """
+    *batch, channels, height, width = observation.shape
+    # Coordinates are floats, integer frames are promoted like `torch.cat`.
+    dtype = torch.promote_types(observation.dtype, torch.float32)
+    if out is None:
+        out = torch.empty(
+            *batch, channels + 2, height, width, device=observation.device, dtype=dtype
+        )
+    out[..., :channels, :, :].copy_(observation)
+    out[..., channels:, :, :].copy_(
+        coordinate_planes(height, width, observation.device, dtype)
+    )
+    return out
+
+
+class AddCoordinates(ObservationTransform):
+    """Appends the pixel coordinates to the channels of an observation.
 
+    The coordinate channels are computed once per frame size, device and
+    dtype, see `coordinate_planes`, and written with the observation into a
+    single output. Observations of shape (batch, 1, C, H, W) are squeezed to
+    (batch, C + 2, H, W).
+
+    Args:
+        in_keys: The keys of the observations.
+        out_keys: The keys to write the observations with coordinates to.
+    """
 
-class RandRotate(ObservationTransform):
     def __init__(
         self,
-        d: int,
         in_keys: Sequence[NestedKey] | None = None,
         out_keys: Sequence[NestedKey] | None = None,
     ):
@@ -140,15 +273,11 @@ class RandRotate(ObservationTransform):
         if out_keys is None:
             out_keys = copy(in_keys)
         super().__init__(in_keys=in_keys, out_keys=out_keys)
-        self.d = d
-
-        self.trans = RandomRotation(
-            degrees=(-d, d), interpolation=InterpolationMode.BILINEAR
-        )
 
     def _apply_transform(self, observation: torch.Tensor) -> torch.Tensor:
-        observation = self.trans(observation)
-        return observation
+        if len(observation.shape) == 5:
+            observation = observation.squeeze(1)
+        return add_coordinates(observation)
 
     def _reset(
         self, tensordict: TensorDictBase, tensordict_reset: TensorDictBase
@@ -161,40 +290,63 @@ class RandRotate(ObservationTransform):
     def transform_observation_spec(self, observation_spec: TensorSpec) -> TensorSpec:
         space = observation_spec.space
         if isinstance(space, ContinuousBox):
+            # The bounds of the coordinate channels are the coordinates.
             space.low = self._apply_transform(space.low)
             space.high = self._apply_transform(space.high)
             observation_spec.shape = space.low.shape
         else:
-            observation_spec.shape = self._apply_transform(
-                torch.zeros(observation_spec.shape)
-            ).shape
+            shape = observation_spec.shape
+            if len(shape) == 5 and shape[1] == 1:
+                shape = shape[:1] + shape[2:]
+            observation_spec.shape = torch.Size(
+                [*shape[:-3], shape[-3] + 2, *shape[-2:]]
+            )
+        observation_spec.dtype = torch.promote_types(
+            observation_spec.dtype, torch.float32
+        )
         return observation_spec
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(" f"d={float(self.d):4.4f}, "
-
+        return (
+            f"{self.__class__.__name__}(in_keys={self.in_keys}, "
+            f"out_keys={self.out_keys})"
+        )
 
-class RandRotateChoice(ObservationTransform):
-    def __init__(
-        self,
-        ds: Sequence[float],
-        in_keys: Sequence[NestedKey] | None = None,
-        out_keys: Sequence[NestedKey] | None = None,
-    ):
-        if in_keys is None:
-            in_keys = IMAGE_KEYS  # default
-        if out_keys is None:
-            out_keys = copy(in_keys)
-        super().__init__(in_keys=in_keys, out_keys=out_keys)
-        self.ds = ds
 
-    def _apply_transform(self, observation: torch.Tensor) -> torch.Tensor:
-        observation = transforms.functional.rotate(
-            observation,
-            random.choice(self.ds),
-            interpolation=InterpolationMode.BILINEAR,
+class SplitVector(ObservationTransform):
+    """Splits a packed vector observation into named fields.
+
+    Every field is a copy of a range of columns of the vector, written next
+    to it under its own name, and the vector itself is removed. Applied before
+    stacking, each field can be stacked on its own, so that metadata that
+    should not be stacked is held once per transition, and consumers read the
+    fields by name instead of slicing the last frame of the stacked vector.
+
+    Args:
+        layout: Maps the name of every field to the [start, end) range of
+            its columns.
+        in_keys: The key of the vector.
+    """
+
+    def __init__(self, layout: dict[str, Sequence[int]], in_keys: Sequence[NestedKey]):
+        in_key = unravel_key(in_keys[0])
+        in_key = in_key if isinstance(in_key, tuple) else (in_key,)
+        self.layout = {name: tuple(span) for name, span in layout.items()}
+        super().__init__(
+            in_keys=[in_key],
+            out_keys=[(*in_key[:-1], name) for name in self.layout],
         )
-        return observation
+
+    def _call(self, tensordict: TensorDictBase) -> TensorDictBase:
+        vector = tensordict.get(self.in_keys[0], None)
+        if vector is None:
+            if self.missing_tolerance:
+                return tensordict
+            raise KeyError(f"{self}: '{self.in_keys[0]}' not found in tensordict")
+        for out_key, (start, end) in zip(self.out_keys, self.layout.values()):
+            tensordict.set(out_key, vector[..., start:end].clone())
+        del tensordict[self.in_keys[0]]
+        return tensordict
 
     def _reset(
         self, tensordict: TensorDictBase, tensordict_reset: TensorDictBase
@@ -203,72 +355,233 @@ class RandRotateChoice(ObservationTransform):
             tensordict_reset = self._call(tensordict_reset)
         return tensordict_reset
 
-    @_apply_to_composite
     def transform_observation_spec(self, observation_spec: TensorSpec) -> TensorSpec:
-        space = observation_spec.space
-        if isinstance(space, ContinuousBox):
-            space.low = self._apply_transform(space.low)
-            space.high = self._apply_transform(space.high)
-            observation_spec.shape = space.low.shape
-        else:
-            observation_spec.shape = self._apply_transform(
-                torch.zeros(observation_spec.shape)
-            ).shape
+        spec = observation_spec[self.in_keys[0]]
+        for out_key, (start, end) in zip(self.out_keys, self.layout.values()):
+            field = spec.clone()
+            if isinstance(field.space, ContinuousBox):
+                field.space.low = field.space.low[..., start:end].clone()
+                field.space.high = field.space.high[..., start:end].clone()
+            columns = len(range(spec.shape[-1])[start:end])
+            field.shape = torch.Size([*spec.shape[:-1], columns])
+            observation_spec[out_key] = field
+        del observation_spec[self.in_keys[0]]
         return observation_spec
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(" f"d={float(self.d):4.4f}, "
+        return (
+            f"{self.__class__.__name__}(layout={self.layout}, in_keys={self.in_keys})"
+        )
 
 
-class AddCoordinates(ObservationTransform):
+def split_stacked_vector(
+    tensordict: TensorDictBase,
+    in_key: NestedKey,
+    layout: dict[str, Sequence[int]],
+    stacked: Sequence[str] = ("state",),
+) -> TensorDictBase:
+    """Splits a vector that was stacked whole, as stored before `SplitVector`.
+
+    Transitions collected before the vector was split hold it stacked along
+    dim -2, under the observation and the ``next`` observation. The stacked
+    fields keep all frames, the others are read from the last frame, so that
+    the result has the layout of the transitions collected with `SplitVector`.
+
+    Args:
+        tensordict: The transitions, modified in place.
+        in_key: The key of the vector under the root and ``next``.
+        layout: Maps the name of every field to the [start, end) range of
+            its columns.
+        stacked: The names of the fields that keep the stacked frames.
+
+    Returns:
+        The transitions, without the vector.
+    """
+    in_key = unravel_key(in_key)
+    in_key = in_key if isinstance(in_key, tuple) else (in_key,)
+    for prefix in ((), ("next",)):
+        vector = tensordict.get((*prefix, *in_key), None)
+        if vector is None:
+            continue
+        for name, (start, end) in layout.items():
+            field = (
+                vector[..., start:end]
+                if name in stacked
+                else vector[..., -1, start:end]
+            )
+            tensordict.set((*prefix, *in_key[:-1], name), field.clone())
+        del tensordict[(*prefix, *in_key)]
+    return tensordict
+
+
+class PreprocessPixels(ObservationTransform):
+    """Turns raw camera frames into stacks of cropped and resized images.
+
+    Fuses `ToTensorImage`, `CenterCrop`, `Resize` and `CatFrames` into a
+    single pass. Each call allocates the stacked output once, copies the
+    previous frames into it and writes the new frame, moved from HWC to CHW,
+    center cropped and resized with antialiasing, into its last channels.
+    When the crop already has the output size, the new frame is copied
+    straight from the input.
+
+    uint8 frames are scaled to [0, 1] when converted to floats, float frames
+    in [0, 1] are scaled to [0, 255] when converted to uint8. Like
+    `CatFrames`, the stacks of the environments being reset are filled with
+    their first frame.
+
+    Args:
+        crop: The height and width of the center crop.
+        size: The height and width of the output frames.
+        num_stacks: The number of most recent frames stacked along the
+            channel dimension.
+        dtype: The dtype of the output frames.
+        in_keys: The keys of the raw frames, with shape `[..., H, W, C]`.
+        out_keys: The keys where the stacked frames will be stored.
+        reset_key: The partial reset key of the environment. Defaults to its
+            only reset key.
+    """
+
     def __init__(
         self,
+        crop: tuple[int, int],
+        size: tuple[int, int] = (100, 100),
+        num_stacks: int = 1,
+        dtype: torch.dtype = torch.float32,
         in_keys: Sequence[NestedKey] | None = None,
         out_keys: Sequence[NestedKey] | None = None,
+        reset_key: NestedKey | None = None,
     ):
         if in_keys is None:
             in_keys = IMAGE_KEYS  # default
         if out_keys is None:
             out_keys = copy(in_keys)
         super().__init__(in_keys=in_keys, out_keys=out_keys)
-        self.d = 1.0
-
-    def _apply_transform(self, observation: torch.Tensor) -> torch.Tensor:
-        x_lin = torch.linspace(1, -1, steps=observation.shape[-2])
-        y_lin = torch.linspace(10, -10, steps=observation.shape[-1])
-
-        X, Y = torch.meshgrid(x_lin, y_lin)
-        grid = torch.stack((X, Y), dim=0)
-
-        batch_grid = (
-            grid.unsqueeze(0)
-            .repeat(observation.shape[0], 1, 1, 1)
-            .to(observation.device)
-        )
-        if len(observation.shape) == 5:
-            observation = observation.squeeze(1)
+        self.crop = tuple(crop)
+        self.size = tuple(size)
+        self.num_stacks = num_stacks
+        self.dtype = dtype
+        self._reset_key = reset_key
+        self._stacks = {}
 
-        return torch.cat((observation, batch_grid), dim=-3)
+    @property
+    def reset_key(self) -> NestedKey:
+        if self._reset_key is None:
+            reset_keys = self.parent.reset_keys
+            if len(reset_keys) > 1:
+                raise RuntimeError(
+                    f"Got more than one reset key in env {self.container}, "
+                    f"provide the reset key to {type(self).__name__}."
+                )
+            self._reset_key = reset_keys[0]
+        return self._reset_key
 
     def _reset(
         self, tensordict: TensorDictBase, tensordict_reset: TensorDictBase
     ) -> TensorDictBase:
+        _reset = _get_reset(self.reset_key, tensordict)
         with _set_missing_tolerance(self, True):
-            tensordict_reset = self._call(tensordict_reset)
+            tensordict_reset = self._call(tensordict_reset, _reset=_reset)
         return tensordict_reset
 
+    def _call(
+        self, tensordict: TensorDictBase, _reset: torch.Tensor | None = None
+    ) -> TensorDictBase:
+        for in_key, out_key in zip(self.in_keys, self.out_keys):
+            pixels = tensordict.get(in_key, None)
+            if pixels is None:
+                if not self.missing_tolerance:
+                    raise KeyError(f"{self}: '{in_key}' not found in tensordict")
+                continue
+            tensordict.set(out_key, self._stack(in_key, pixels, _reset))
+        return tensordict
+
+    def _stack(
+        self, in_key: NestedKey, pixels: torch.Tensor, _reset: torch.Tensor | None
+    ) -> torch.Tensor:
+        frames = self._convert(self._frames(pixels))
+        batch_shape, (c, h, w) = frames.shape[:-3], frames.shape[-3:]
+        stack = torch.empty(
+            *batch_shape,
+            self.num_stacks * c,
+            h,
+            w,
+            dtype=self.dtype,
+            device=frames.device,
+        )
+        new, history = stack[..., -c:, :, :], stack[..., :-c, :, :]
+        new.copy_(frames)
+
+        previous = self._stacks.get(in_key)
+        if previous is None or previous.shape != stack.shape:
+            _reset = torch.ones((), dtype=torch.bool)
+        if _reset is None:
+            history.copy_(previous[..., c:, :, :])
+        else:
+            _reset = _reset.to(stack.device).expand(batch_shape)
+            history.unflatten(-3, (self.num_stacks - 1, c)).copy_(
+                new.unsqueeze(-4).expand(*batch_shape, self.num_stacks - 1, c, h, w)
+            )
+            if not _reset.all():
+                history[~_reset] = previous[~_reset][..., c:, :, :]
+        # The stack is never written to again, so it is not cloned.
+        self._stacks[in_key] = stack
+        return stack
+
+    def _frames(self, pixels: torch.Tensor) -> torch.Tensor:
+        height, width = pixels.shape[-3:-1]
+        crop_h, crop_w = self.crop
+        # Rounded like torchvision's center_crop.
+        top = int(round((height - crop_h) / 2.0))
+        left = int(round((width - crop_w) / 2.0))
+        frames = pixels[..., top : top + crop_h, left : left + crop_w, :]
+        frames = frames.movedim(-1, -3)
+        if self.crop == self.size:
+            return frames
+        if self.dtype.is_floating_point:
+            frames = self._convert(frames)
+        batch_shape = frames.shape[:-3]
+        frames = resize(
+            frames.reshape(-1, *frames.shape[-3:]),
+            list(self.size),
+            interpolation=InterpolationMode.BILINEAR,
+            antialias=True,
+        )
+        return frames.reshape(*batch_shape, *frames.shape[-3:])
+
+    def _convert(self, frames: torch.Tensor) -> torch.Tensor:
+        if frames.dtype == self.dtype:
+            return frames
+        if frames.dtype == torch.uint8:
+            return frames.div(255).to(self.dtype)
+        if self.dtype == torch.uint8:
+            return frames.mul(255).round_().clamp_(0, 255).to(self.dtype)
+        return frames.to(self.dtype)
+
     @_apply_to_composite
     def transform_observation_spec(self, observation_spec: TensorSpec) -> TensorSpec:
         space = observation_spec.space
         if isinstance(space, ContinuousBox):
-            space.low = self._apply_transform(space.low)
-            space.high = self._apply_transform(space.high)
+            space.low = torch.cat(
+                [self._convert(self._frames(space.low))] * self.num_stacks, -3
+            )
+            space.high = torch.cat(
+                [self._convert(self._frames(space.high))] * self.num_stacks, -3
+            )
             observation_spec.shape = space.low.shape
         else:
-            observation_spec.shape = self._apply_transform(
-                torch.zeros(observation_spec.shape)
-            ).shape
+            observation_spec.shape = torch.Size(
+                [
+                    *observation_spec.shape[:-3],
+                    self.num_stacks * observation_spec.shape[-1],
+                    *self.size,
+                ]
+            )
+        observation_spec.dtype = self.dtype
         return observation_spec
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(" f"d={float(self.d):4.4f}, "
+        return (
+            f"{self.__class__.__name__}(crop={self.crop}, size={self.size}, "
+            f"num_stacks={self.num_stacks}, dtype={self.dtype}, "
+            f"keys={self.in_keys})"
+        )
@@ -0,0 +1,220 @@
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Iterable
+
+import torch
+from tensordict import TensorDictBase
+from torchrl.objectives import LossModule, SoftUpdate
+from torchrl.objectives.utils import TargetNetUpdater
+
+UPDATER_MODES = ("eager", "fused", "compiled")
+TARGET_UPDATE_MODES = ("soft", "hard", "periodic_soft")
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in UPDATER_MODES:
+        raise ValueError(
+            f"Unknown updater mode {mode}, expected one of {UPDATER_MODES}."
+        )
+
+
+def optimizer_kernel_kwargs(mode: str, params: Iterable[torch.Tensor]) -> dict:
+    """Selects the multi-tensor optimizer kernels for an updater mode.
+
+    Fused kernels are only available on CUDA, the foreach kernels are used
+    everywhere else.
+
+    Args:
+        mode: The updater mode, see `LossUpdater`.
+        params: The parameters the optimizer will update.
+
+    Returns:
+        The keyword arguments to pass to the optimizer.
+    """
+    _check_mode(mode)
+    if mode == "eager":
+        return {}
+    if all(p.is_cuda for p in params):
+        return {"fused": True}
+    return {"foreach": True}
+
+
+class LossUpdater:
+    """Runs the gradient steps of a loss module.
+
+    A step computes the loss, clips the gradient norm, steps the optimizer
+    and then the target networks. The logged losses are accumulated on the
+    loss device and only read back by `metrics`, so that a step does not wait
+    on the device.
+
+    With the "fused" mode the gradient clipping uses the foreach kernels, and
+    the optimizer should be created with `optimizer_kernel_kwargs`. The
+    "compiled" mode also compiles the optimizer step with `torch.compile`.
+    The loss is always run eagerly, as the functional parameters of torchrl
+    losses cannot be traced by this version of torch.
+
+    Args:
+        loss_module: The loss module to optimize.
+        optimizer: The optimizer over the parameters of the loss module.
+        target_net_updater: The updater of the target networks.
+        clip_params: The parameters whose gradient norm is clipped.
+        max_grad_norm: The maximum norm of the gradients.
+        loss_keys: The loss terms summed into the optimized loss.
+        metric_keys: Maps the logged name of a metric to its loss entry. The
+            optimized loss is always logged as "total_loss".
+        mode: One of "eager", "fused" or "compiled".
+        loss_context: Creates the context to run the loss in from the batch,
+            like `cache_encoder_features`.
+    """
+
+    def __init__(
+        self,
+        loss_module: LossModule,
+        optimizer: torch.optim.Optimizer,
+        target_net_updater: TargetNetUpdater,
+        clip_params: Iterable[torch.Tensor],
+        max_grad_norm: float,
+        loss_keys: tuple[str, ...],
+        metric_keys: dict[str, str],
+        mode: str = "eager",
+        loss_context: Callable[[TensorDictBase], ContextManager] = nullcontext,
+    ):
+        _check_mode(mode)
+        self.loss_module = loss_module
+        self.optimizer = optimizer
+        self.target_net_updater = target_net_updater
+        self.clip_params = list(clip_params)
+        self.max_grad_norm = max_grad_norm
+        self.loss_keys = loss_keys
+        self.metric_keys = metric_keys
+        self.mode = mode
+        self.loss_context = loss_context
+        # None lets torch pick the kernels, as the eager loop did.
+        self._foreach = None if mode == "eager" else True
+        self._optimizer_step = (
+            torch.compile(optimizer.step) if mode == "compiled" else optimizer.step
+        )
+        self._sums = None
+        self._num_steps = 0
+        self.num_updates = 0
+
+    def step(self, tensordict: TensorDictBase) -> TensorDictBase:
+        """Runs one gradient step on a batch.
+
+        Args:
+            tensordict: The sampled batch. The loss module writes the
+                priorities to it.
+
+        Returns:
+            The output of the loss module.
+        """
+        with self.loss_context(tensordict):
+            loss_td = self.loss_module(tensordict)
+        loss = sum(loss_td[key] for key in self.loss_keys)
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(
+            self.clip_params, self.max_grad_norm, foreach=self._foreach
+        )
+        self._optimizer_step()
+        self.target_net_updater.step()
+
+        values = torch.stack(
+            [loss.detach()]
+            + [loss_td[key].detach().float() for key in self.metric_keys.values()]
+        )
+        self._sums = values if self._sums is None else self._sums + values
+        self._num_steps += 1
+        self.num_updates += 1
+        return loss_td
+
+    def metrics(self) -> dict[str, float]:
+        """Returns the mean of every metric since the last call and resets them."""
+        if self._num_steps == 0:
+            return {}
+        means = (self._sums / self._num_steps).tolist()
+        self._sums, self._num_steps = None, 0
+        return dict(zip(["total_loss", *self.metric_keys], means))
+
+
+class ForeachSoftUpdate(SoftUpdate):
+    """A drop-in replacement of `SoftUpdate` that updates all targets at once.
+
+    The floating point targets are updated with a single foreach lerp
+    instead of one update per tensor. Other buffers, like the batch norm
+    counters, are copied from the source.
+
+    To amortize the update at high update-to-data ratios, the targets can
+    also be updated every `interval` steps only. The "hard" mode then copies
+    the source, and the "periodic_soft" mode applies `eps ** interval`, the
+    decay of `interval` soft updates towards a fixed source.
+
+    Args:
+        loss_module: The loss module whose target networks are updated.
+        eps: The decay of the targets at every step. Exclusive with `tau`.
+        tau: The Polyak tau, equal to `1 - eps`. Exclusive with `eps`.
+        mode: One of "soft", "hard" or "periodic_soft".
+        interval: The number of steps between updates, unused with the
+            "soft" mode.
+    """
+
+    def __init__(
+        self,
+        loss_module: LossModule,
+        *,
+        eps: float | None = None,
+        tau: float | None = None,
+        mode: str = "soft",
+        interval: int = 1,
+    ):
+        if mode not in TARGET_UPDATE_MODES:
+            raise ValueError(
+                f"Unknown target update mode {mode}, expected one of "
+                f"{TARGET_UPDATE_MODES}."
+            )
+        if interval < 1:
+            raise ValueError("interval must be a positive integer.")
+        super().__init__(loss_module, eps=eps, tau=tau)
+        self.mode = mode
+        self.interval = 1 if mode == "soft" else interval
+        self.counter = 0
+
+    def init_(self) -> None:
+        super().init_()
+        # The tensors are gathered once, the loss module must not be moved
+        # to another device after the updater is created.
+        self._float_pairs = ([], [])
+        self._other_pairs = ([], [])
+        for key, source in self._sources.items(True, True):
+            if not isinstance(key, tuple):
+                key = (key,)
+            key = ("target_" + key[0], *key[1:])
+            if not self._distinct[key]:
+                continue
+            target = self._targets[key]
+            pairs = (
+                self._float_pairs
+                if target.is_leaf and target.is_floating_point()
+                else self._other_pairs
+            )
+            pairs[0].append(source.data)
+            pairs[1].append(target.data)
+
+    def step(self) -> None:
+        if not self.initialized:
+            raise Exception(
+                f"{self.__class__.__name__} must be initialized "
+                f"(`{self.__class__.__name__}.init_()`) before calling step()"
+            )
+        self.counter += 1
+        if self.counter < self.interval:
+            return
+        self.counter = 0
+
+        sources, targets = self._float_pairs
+        if self.mode == "hard":
+            torch._foreach_copy_(targets, sources)
+        else:
+            torch._foreach_lerp_(targets, sources, 1 - self.eps**self.interval)
+        for source, target in zip(*self._other_pairs):
+            target.copy_(source)
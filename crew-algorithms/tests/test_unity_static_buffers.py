@@ -0,0 +1,80 @@
+import gc
+import tracemalloc
+
+import pytest
+import torch
+from crew_algorithms.benchmark.utils import set_num_agents
+from crew_algorithms.envs.configs import FindTreasureConfig
+from crew_algorithms.utils.rl_utils import make_base_env
+from torchrl.collectors import SyncDataCollector
+from torchrl.envs.utils import step_mdp
+
+
+def make_env(static_buffers):
+    env_cfg = FindTreasureConfig(
+        mock=True,
+        batched_decode=True,
+        batched_actions=True,
+        static_buffers=static_buffers,
+        mock_episode_length=20,
+    )
+    set_num_agents(env_cfg, 4)
+    return make_base_env(env_cfg, "cpu")
+
+
+@pytest.fixture
+def env():
+    env = make_env(static_buffers=True)
+    yield env
+    env.close()
+
+
+def run(env, tensordict, num_steps):
+    for _ in range(num_steps):
+        tensordict = step_mdp(env.rand_step(tensordict))
+        if tensordict["agents", "done"].any():
+            tensordict = env.reset()
+    return tensordict
+
+
+def rollout(static_buffers):
+    env = make_env(static_buffers)
+    torch.manual_seed(0)
+    data = env.rollout(15)
+    env.close()
+    return data
+
+
+def collect(static_buffers):
+    env = make_env(static_buffers)
+    torch.manual_seed(0)
+    collector = SyncDataCollector(env, None, frames_per_batch=30, total_frames=60)
+    batches = [batch.clone() for batch in collector]
+    collector.shutdown()
+    return torch.cat(batches)
+
+
+@pytest.mark.parametrize("run_steps", [rollout, collect])
+def test_steps_match_batched(run_steps):
+    static, batched = run_steps(True), run_steps(False)
+    assert static.shape == batched.shape
+    assert (static == batched).all()
+    # Steps of a batch must not alias each other.
+    obs = static["next", "agents", "observation", "obs_1"]
+    assert not (obs[1:] == obs[:-1]).all()
+
+
+def test_allocations_stay_flat_across_steps(env):
+    tensordict = run(env, env.reset(), 100)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tensordict = run(env, tensordict, 100)
+        gc.collect()
+        before, _ = tracemalloc.get_traced_memory()
+        tensordict = run(env, tensordict, 1000)
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert after - before < 16 * 1024